@@ -2,6 +2,7 @@ DATA = {
     "exclude_images_file": "mediapipe_skipped_faces.txt",
     "annotations_file": "fairset.json",
     "estimations_file": "mediapipe_estimations.json",
+    "bbox_file": "fairset_bbox.json",  # FAIRSET annotations with the face bounding boxes (continuous factors)
 }
 
 FILTERS = {
@@ -16,4 +17,30 @@ MEDIAPIPE = {
     "model_path": "face_landmarker.task",
     "min_iou": 0.4,  # Minimum IoU for association,
     "output_file": "MediaPipe.json",
+    "cache_folder": "mediapipe_cache",  # Raw inference cache (sample_extraction/inference_cache.py), None to disable
+    "cache_only": False,  # Only re-associate and re-map cached inferences, images missing from the cache are skipped
+    "image_cache_folder": None,  # Decoded frames cache (sample_extraction/image_cache.py), None to decode every run
+}
+
+# Perturbation robustness of the extraction (sample_extraction/robustness.py)
+ROBUSTNESS = {
+    "perturbations": {  # Perturbation -> severities, mildest first
+        "brightness": [0.75, 0.5, 0.25],  # Intensity factor
+        "gamma": [1.5, 2.0, 3.0],  # Gamma exponent (darkens the mid-tones)
+        "blur": [1.0, 2.0, 4.0],  # Gaussian blur sigma, in pixels
+        "jpeg": [50, 20, 5],  # JPEG quality
+        "downscale": [0.5, 0.25, 0.125],  # Resolution factor, the image is resized back to its size
+        "occlusion": [0.1, 0.25, 0.4],  # Fraction of every annotated face box hidden by a random patch
+    },
+    "seed": 0,
+    "batch_size": 16,  # Perturbed images sent to the estimator at once
+}
+
+# Stage timing and profiling (see analysis/profiling.py)
+PROFILING = {
+    "enabled": False,
+    "cprofile": False,  # Also capture a cProfile of the run (dumped next to the output file as .prof)
+    "tracemalloc": False,  # Also trace memory allocations (peak and top allocation sites)
+    "format": "json",  # "json" for a summary with all spans, "chrome" for a Chrome/Perfetto trace file
+    "output_file": "profile.json",
 }
@@ -0,0 +1,45 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+from analysis.configs import DATA
+from analysis.data.data_loader import DataLoader
+from analysis.data.normalizers import load_bboxes
+from analysis.profiling import profiled
+
+# Continuous per-sample covariates, see compute_covariates
+COVARIATES = ["iod", "bbox_area", "relative_face_size", "resolution"]
+
+
+@profiled("covariates.compute")
+def compute_covariates(data_loader: DataLoader, bbox_file: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Continuous covariates of every sample of the loader (aligned with DataLoader.get_samples), NaN when unavailable:
+    - iod: inter-ocular distance of the person, in pixels
+    - bbox_area: face bounding box area, in pixels
+    - relative_face_size: square root of the face area over the image area (linear face size relative to the image)
+    - resolution: image area, in megapixels
+    The per-person values are gathered once and broadcast to the samples through their person and image indices.
+    :param bbox_file: FAIRSET file with the face bounding boxes, DATA["bbox_file"] by default
+    """
+    bboxes = load_bboxes(bbox_file or DATA["bbox_file"])
+    person_iod, person_area = [], []
+    image_resolution = []
+    for image in data_loader.get_annotations():
+        image_resolution.append(image.width * image.height / 1e6)
+        image_bboxes = bboxes.get(image.name, {})
+        for person in image.persons:
+            person_iod.append(person.iod or np.nan)
+            bbox = image_bboxes.get(person.id)
+            person_area.append(bbox[2] * bbox[3] if bbox is not None else np.nan)
+
+    samples = data_loader.get_samples()
+    iod = np.array(person_iod, dtype=np.float64)[samples["person"]]
+    bbox_area = np.array(person_area, dtype=np.float64)[samples["person"]]
+    resolution = np.array(image_resolution, dtype=np.float64)[samples["image"]]
+    return {
+        "iod": iod,
+        "bbox_area": bbox_area,
+        "relative_face_size": np.sqrt(bbox_area / (resolution * 1e6)),
+        "resolution": resolution,
+    }
@@ -1,61 +1,85 @@
 import json
-from typing import Any, Dict, List, Optional
+import os
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 
 from analysis.configs import DATA, FILTERS
-from analysis.data.datatypes import Age, Image, Keypoint, Person, Sex, Skintone
+from analysis.data.datatypes import (FACTOR_ATTRIBUTES, FACTORS, Age, Image, Keypoint, Person, Sex, Skintone,
+                                     get_group_code)
+from analysis.data.dataset_store import DatasetStore, is_store
+from analysis.data.error_index import ErrorIndex
 from analysis.data.locations import KEYPOINTS
+from analysis.data.normalizers import NORMALIZERS, Faces, compute_normalizers, gather_faces, load_bboxes, \
+    normalized_errors
+from analysis.data.shared_samples import SharedSamples
+from analysis.profiling import PROFILER, profiled
+
+SAMPLE_COLUMNS_DTYPES = {
+    "nme": np.float64,
+    "dx": np.float64,
+    "dy": np.float64,
+    "kp_id": np.int16,
+    "image": np.int32,
+    "person": np.int32,
+    **{factor: np.int8 for factor in FACTOR_ATTRIBUTES.keys()},
+}
 
 
 class DataLoader:
-    def __init__(self):
+    def __init__(self, estimations_file: Optional[Union[str, Dict[str, dict]]] = None,
+                 annotations_file: Optional[str] = None, statistical_biases: Optional[Dict[int, tuple]] = None):
+        """
+        :param estimations_file: estimations of the model to evaluate, defaults to DATA["estimations_file"]. Either a
+                                 file or its content already in memory (image name -> person id -> keypoint id ->
+                                 {"x", "y"}, e.g. produced by sample_extraction/robustness.py)
+        :param annotations_file: FAIRSET annotations (JSON or store, see dataset_store.py), defaults to
+                                 DATA["annotations_file"]
+        :param statistical_biases: per-keypoint (dx, dy) biases to remove, computed as the medians of the loaded errors
+                                   if None (e.g. given the biases of the whole dataset when loading a shard of it)
+        """
         self._removed_images = []
         if DATA.get("exclude_images_file") is not None:
             self._removed_images = list(np.loadtxt(DATA["exclude_images_file"], dtype=str))
 
-        if DATA.get("annotations_file") is None:
+        self._annotations_file = annotations_file or DATA.get("annotations_file")
+        if self._annotations_file is None:
             raise Exception("Annotations file is not specified in the DATA config. Please check the configuration.")
         self._annotations: List[Image] = []
         self._load_annotations()
 
-        if DATA.get("estimations_file") is None:
+        self._estimations_file = estimations_file if estimations_file is not None else DATA.get("estimations_file")
+        if self._estimations_file is None:
             raise Exception("Estimation file is not specified in the DATA config. Please check the configuration.")
         self._estimations: Dict[str, Dict[int, Dict[int, Keypoint]]] = {}
         self._load_estimations()
 
         self._location_errors: Dict[int, list | np.ndarray] = {kp: [] for kp in KEYPOINTS.keys()}
         self._extract_location_errors()
-        self._statistical_biases: Dict[int, tuple] = {
-            kp_id: (np.median(errors[:, 0]), np.median(errors[:, 1]))
-            for kp_id, errors in self._location_errors.items()
-            if len(errors) > 0
-        }
+        self._statistical_biases: Dict[int, tuple] = statistical_biases
+        if statistical_biases is None:
+            self._statistical_biases = {
+                kp_id: (np.median(errors[:, 0]), np.median(errors[:, 1]))
+                for kp_id, errors in self._location_errors.items()
+                if len(errors) > 0
+            }
 
-        self._error_indexes: Dict[str, Dict[Any, list | np.ndarray]] = {
-            "location": {kp: [] for kp in KEYPOINTS.keys()},
-            "age": {kp: {age: [] for age in Age if age != Age.NotAvailable} for kp in KEYPOINTS.keys()},
-            "sex": {kp: {sex: [] for sex in Sex if sex != Sex.NotAvailable} for kp in KEYPOINTS.keys()},
-            "skintone": {
-                kp: {skintone: [] for skintone in Skintone if skintone != Skintone.NotAvailable}
-                for kp in KEYPOINTS.keys()
-            },
-            "expressions": {kp: {True: [], False: []} for kp in KEYPOINTS.keys()},
-            "lighting": {kp: {True: [], False: []} for kp in KEYPOINTS.keys()},
-            "occlusion": {kp: {True: [], False: []} for kp in KEYPOINTS.keys()},
-        }
-        self._error_indexes["age"]["all"] = {age: [] for age in Age if age != Age.NotAvailable}
-        self._error_indexes["skintone"]["all"] = {
-            skintone: [] for skintone in Skintone if skintone != Skintone.NotAvailable
-        }
-        self._error_indexes["sex"]["all"] = {sex: [] for sex in Sex if sex != Sex.NotAvailable}
-        self._error_indexes["occlusion"]["all"] = {True: [], False: []}
-        self._error_indexes["lighting"]["all"] = {True: [], False: []}
-        self._error_indexes["expressions"]["all"] = {True: [], False: []}
         self._preprocess_errors()
 
+        # Alternative normalizations of the errors, computed on the first set_normalizer
+        self._normalizer = "iod"
+        self._normalized: Dict[str, tuple] = {}
+        self._faces: Optional[Faces] = None
+        self._normalizer_lengths: Dict[str, np.ndarray] = {}
+
+    @profiled("loader.load_annotations")
     def _load_annotations(self):
-        with open(DATA["annotations_file"], "r") as file:
+        if is_store(self._annotations_file):
+            self._annotations = [
+                image for image in DatasetStore(self._annotations_file).images() if image.name not in self._removed_images
+            ]
+            return
+        with open(self._annotations_file, "r") as file:
             annotations_dict = json.load(file)
         for image_name, metadata in annotations_dict.items():
             if image_name not in self._removed_images:
@@ -80,83 +104,175 @@ class DataLoader:
                     )
                 self._annotations.append(Image(image_name, persons, metadata["width"], metadata["height"]))
 
+    @profiled("loader.load_estimations")
     def _load_estimations(self):
-        with open(DATA["estimations_file"], "r") as file:
-            estimations_dict = json.load(file)
-            for image_name, metadata in estimations_dict.items():
-                if image_name not in self._removed_images:
-                    self._estimations[image_name] = {}
-                    for person_id, keypoints in metadata.items():
-                        self._estimations[image_name][int(person_id)] = {
-                            int(kp_id): Keypoint(kp_data["x"], kp_data["y"], int(kp_id))
-                            for kp_id, kp_data in keypoints.items()
-                        }
+        if isinstance(self._estimations_file, dict):
+            estimations_dict = self._estimations_file
+        else:
+            with open(self._estimations_file, "r") as file:
+                estimations_dict = json.load(file)
+        for image_name, metadata in estimations_dict.items():
+            if image_name not in self._removed_images:
+                self._estimations[image_name] = {}
+                for person_id, keypoints in metadata.items():
+                    self._estimations[image_name][int(person_id)] = {
+                        int(kp_id): Keypoint(kp_data["x"], kp_data["y"], int(kp_id))
+                        for kp_id, kp_data in keypoints.items()
+                    }
+
+    def _reset_samples(self):
+        # Flat per-sample columns (one row per kept keypoint error), factor groups are stored as codes
+        self._samples: Dict[str, list | np.ndarray] = {column: [] for column in SAMPLE_COLUMNS_DTYPES.keys()}
 
+    @staticmethod
+    def _build_error_indexes(samples: Dict[str, np.ndarray]) -> Dict[str, ErrorIndex]:
+        """
+        One ErrorIndex per factor (plus location, whose single group is every sample) from the sample columns
+        """
+        keypoint_ids = sorted(KEYPOINTS.keys())
+        nmes, kp_ids = samples["nme"], samples["kp_id"]
+        return {
+            "location": ErrorIndex(nmes, kp_ids, np.zeros(len(nmes), dtype=np.int8), keypoint_ids, 1),
+            **{
+                factor: ErrorIndex(nmes, kp_ids, samples[factor], keypoint_ids, len(FACTORS[factor]))
+                for factor in FACTOR_ATTRIBUTES.keys()
+            },
+        }
+
+    @profiled("loader.preprocess_errors")
     def _preprocess_errors(self):
-        for image in self._annotations:
-            if image.name in self._estimations:
-                for person in image.persons:
-                    if (
-                        person.id in self._estimations.get(image.name, {})
-                        and person.iod
-                        and person.iod > FILTERS.get("min_iod", -1)
-                    ):
-                        estimations = self._estimations.get(image.name, {})[person.id]
-                        for keypoint in person.keypoints:
-                            if keypoint.id in estimations:
-                                if FILTERS.get("remove_statistical_bias", True):
-                                    estimation = estimations[keypoint.id]
-                                    dx = (estimation.x - keypoint.x) / person.iod
-                                    dy = (estimation.y - keypoint.y) / person.iod
-                                    nme = np.sqrt(
-                                        (dx - self._statistical_biases[keypoint.id][0]) ** 2
-                                        + (dy - self._statistical_biases[keypoint.id][1]) ** 2
-                                    )
-                                else:
-                                    nme = keypoint.distance(estimations[keypoint.id]) / person.iod
-                                if nme < FILTERS.get("max_nme", -1) or FILTERS.get("max_nme", -1) == -1:
-                                    self._error_indexes["location"][keypoint.id].append(nme)
-                                    if person.age != Age.NotAvailable:
-                                        self._error_indexes["age"][keypoint.id][person.age].append(nme)
-                                        self._error_indexes["age"]["all"][person.age].append(nme)
-                                    if person.skintone != Skintone.NotAvailable:
-                                        self._error_indexes["skintone"][keypoint.id][person.skintone].append(nme)
-                                        self._error_indexes["skintone"]["all"][person.skintone].append(nme)
-                                    if person.sex != Sex.NotAvailable:
-                                        self._error_indexes["sex"][keypoint.id][person.sex].append(nme)
-                                        self._error_indexes["sex"]["all"][person.sex].append(nme)
-                                    if person.occlusion is not None:
-                                        self._error_indexes["occlusion"][keypoint.id][person.occlusion].append(nme)
-                                        self._error_indexes["occlusion"]["all"][person.occlusion].append(nme)
-                                    if person.lighting is not None:
-                                        self._error_indexes["lighting"][keypoint.id][person.lighting].append(nme)
-                                        self._error_indexes["lighting"]["all"][person.lighting].append(nme)
-                                    if person.expression is not None:
-                                        self._error_indexes["expressions"][keypoint.id][person.expression].append(nme)
-                                        self._error_indexes["expressions"]["all"][person.expression].append(nme)
-
-        for factor, data in self._error_indexes.items():
-            for keypoint_id, kp_data in data.items():
-                if factor == "location":
-                    data[keypoint_id] = np.array(kp_data)
-                else:
-                    for group, nmes in kp_data.items():
-                        data[keypoint_id][group] = np.array(nmes)
+        self._reset_samples()
+        person_index = -1
+        for image_index, image in enumerate(self._annotations):
+            for person in image.persons:
+                person_index += 1
+                if image.name not in self._estimations:
+                    continue
+                if (
+                    person.id in self._estimations.get(image.name, {})
+                    and person.iod
+                    and person.iod > FILTERS.get("min_iod", -1)
+                ):
+                    estimations = self._estimations.get(image.name, {})[person.id]
+                    group_codes = {
+                        factor: get_group_code(factor, getattr(person, attribute))
+                        for factor, attribute in FACTOR_ATTRIBUTES.items()
+                    }
+                    for keypoint in person.keypoints:
+                        if keypoint.id in estimations:
+                            estimation = estimations[keypoint.id]
+                            dx = (estimation.x - keypoint.x) / person.iod
+                            dy = (estimation.y - keypoint.y) / person.iod
+                            if FILTERS.get("remove_statistical_bias", True):
+                                nme = np.sqrt(
+                                    (dx - self._statistical_biases[keypoint.id][0]) ** 2
+                                    + (dy - self._statistical_biases[keypoint.id][1]) ** 2
+                                )
+                            else:
+                                nme = keypoint.distance(estimation) / person.iod
+                            if nme < FILTERS.get("max_nme", -1) or FILTERS.get("max_nme", -1) == -1:
+                                self._samples["nme"].append(nme)
+                                self._samples["dx"].append(dx)
+                                self._samples["dy"].append(dy)
+                                self._samples["kp_id"].append(keypoint.id)
+                                self._samples["image"].append(image_index)
+                                self._samples["person"].append(person_index)
+                                for factor, code in group_codes.items():
+                                    self._samples[factor].append(code)
+                            else:
+                                PROFILER.count("loader.filtered_samples_max_nme")
+
+        for column, dtype in SAMPLE_COLUMNS_DTYPES.items():
+            self._samples[column] = np.array(self._samples[column], dtype=dtype)
+        PROFILER.count("loader.samples", len(self._samples["nme"]))
+        self._error_indexes = self._build_error_indexes(self._samples)
+
+    @profiled("loader.normalize_samples")
+    def _normalize_samples(self, normalizer: str, bbox_file: Optional[str] = None) -> tuple:
+        """
+        Samples, statistical biases and error indexes of the errors normalized by another normalizer, computed for all
+        the faces at once
+        """
+        if self._faces is None:
+            bbox_file = bbox_file or DATA.get("bbox_file")
+            bboxes = load_bboxes(bbox_file) if bbox_file is not None and os.path.exists(bbox_file) else {}
+            self._faces = gather_faces(self._annotations, self._estimations, bboxes)
+            self._normalizer_lengths = compute_normalizers(self._faces)
+        faces = self._faces
+        if normalizer.startswith("bbox") and np.isnan(faces.bbox).all():
+            raise Exception(
+                f"No face bounding box found for the {normalizer} normalizer. Please check DATA['bbox_file']."
+            )
+
+        errors = normalized_errors(faces, normalizer, self._normalizer_lengths)
+        # The persons without IOD are kept, those with a small one are still filtered as in _preprocess_errors
+        kept_faces = ~(faces.iod <= FILTERS.get("min_iod", -1))
+        valid = ~np.isnan(errors[..., 0]) & kept_faces[:, None]
+        face_indices, kp_slots = np.nonzero(valid)
+        dx, dy = errors[face_indices, kp_slots, 0], errors[face_indices, kp_slots, 1]
+
+        # Biases of this normalization: per-keypoint medians of all the kept errors, before the NME filter
+        observed = valid.any(axis=0)
+        medians = np.zeros((len(faces.keypoint_ids), 2))
+        medians[observed] = np.nanmedian(np.where(valid[..., None], errors, np.nan)[:, observed], axis=0)
+        statistical_biases = {int(faces.keypoint_ids[slot]): tuple(medians[slot]) for slot in np.flatnonzero(observed)}
+        if FILTERS.get("remove_statistical_bias", True):
+            nmes = np.hypot(dx - medians[kp_slots, 0], dy - medians[kp_slots, 1])
+        else:
+            nmes = np.hypot(dx, dy)
+        kept = nmes < FILTERS.get("max_nme", -1) if FILTERS.get("max_nme", -1) != -1 else np.ones(len(nmes), bool)
+        PROFILER.count(f"loader.filtered_samples_max_nme_{normalizer}", int((~kept).sum()))
+
+        columns = {
+            "nme": nmes,
+            "dx": dx,
+            "dy": dy,
+            "kp_id": faces.keypoint_ids[kp_slots],
+            "image": faces.image[face_indices],
+            "person": faces.person[face_indices],
+            **{factor: faces.codes[factor][face_indices] for factor in FACTOR_ATTRIBUTES.keys()},
+        }
+        samples = {column: columns[column][kept].astype(dtype) for column, dtype in SAMPLE_COLUMNS_DTYPES.items()}
+        return samples, statistical_biases, self._build_error_indexes(samples)
 
+    def set_normalizer(self, normalizer: str, bbox_file: Optional[str] = None):
+        """
+        Switch the samples, the error indexes and the statistical biases to another normalization of the errors (see
+        NORMALIZERS) without reloading: the faces and the lengths of every normalizer are stacked once, and each
+        normalization is cached, so any analysis run after the switch uses the new metric.
+        "iod" is the normalization of the loaded samples. The other normalizers keep the persons without IOD (e.g.
+        profile faces missing an eye corner) and remove their own per-keypoint median biases.
+        :param bbox_file: FAIRSET file with the face bounding boxes, DATA["bbox_file"] by default
+        """
+        if normalizer not in NORMALIZERS:
+            raise ValueError(f"Unknown normalizer {normalizer}, expected one of {NORMALIZERS}")
+        self._normalized.setdefault(self._normalizer, (self._samples, self._statistical_biases, self._error_indexes))
+        if normalizer not in self._normalized:
+            self._normalized[normalizer] = self._normalize_samples(normalizer, bbox_file)
+        self._samples, self._statistical_biases, self._error_indexes = self._normalized[normalizer]
+        self._normalizer = normalizer
+
+    def get_normalizer(self) -> str:
+        return self._normalizer
+
+    @profiled("loader.extract_location_errors")
     def _extract_location_errors(self) -> Dict[str, Dict[Any, float]]:
         for image in self._annotations:
             if image.name not in self._estimations:
                 print(f"Image {image.name} not found in estimations.")
+                PROFILER.count("loader.skipped_images_missing_estimations")
                 continue
             for person in image.persons:
                 if person.id not in self._estimations.get(image.name, {}):
                     print(f"Person {person.id} not found in estimations for image {image.name}.")
+                    PROFILER.count("loader.skipped_persons_missing_estimations")
                     continue
 
                 if person.iod is None or person.iod < FILTERS.get("min_iod", -1):
                     print(
                         f"Person {person.id} was removed from the analysis because of a small or missing iod in image {image.name}."
                     )
+                    PROFILER.count("loader.skipped_persons_iod")
                     continue
                 estimations = self._estimations.get(image.name, {}).get(person.id, {})
 
@@ -171,49 +287,67 @@ class DataLoader:
             self._location_errors[kp_id] = np.array(nmes)
 
     def get_errors_by_factor(self, factor: str, kp_id: Optional[int] = None) -> np.ndarray:
+        """
+        :return: the errors of every group of the factor (on the keypoint if given), as a view
+        """
         if kp_id is not None:
-            return np.array(
-                [
-                    error
-                    for kp_data in self._error_indexes[factor].values()
-                    for kp_errors in kp_data.values()
-                    for error in kp_errors
-                    if len(kp_errors) > 0
-                ]
-            )
-        return np.array(
-            [
-                error
-                for kp_id, kp_errors in self._error_indexes[factor].items()
-                for error in kp_errors
-                if len(kp_errors) > 0 and kp_id != "all"
-            ]
-        )
+            return self._error_indexes[factor].keypoint(kp_id)
+        return self._error_indexes[factor].all()
 
     def get_errors_by_group(self, factor: str, group: Any, kp_id: Optional[int] = None) -> np.ndarray:
+        """
+        :return: the errors of the group (on the keypoint if given, else on every keypoint in keypoint order), as a
+                 view
+        """
         if kp_id is not None:
-            return self._error_indexes[factor][kp_id][group]
-        return np.array(
-            [
-                nme
-                for kp_errors, kp_id in self._error_indexes[factor].items()
-                if group in kp_errors
-                for nme in kp_errors[group]
-                if kp_id != "all"
-            ]
-        )
+            return self._error_indexes[factor].keypoint_group(kp_id, get_group_code(factor, group))
+        return self._error_indexes[factor].group(get_group_code(factor, group))
 
-    def get_all_group_errors(self, factor: str) -> Dict[str, np.ndarray]:
-        return self._error_indexes[factor]["all"]
+    def get_all_group_errors(self, factor: str) -> Dict[Any, np.ndarray]:
+        return {group: self._error_indexes[factor].group(code) for code, group in enumerate(FACTORS[factor])}
 
     def get_group_error_by_keypoint_dict(self, factor: str, group: str):
-        return {kp_id: self._error_indexes[factor][kp_id][group] for kp_id in self._error_indexes[factor].keys()}
+        code = get_group_code(factor, group)
+        return {
+            **{kp_id: self._error_indexes[factor].keypoint_group(kp_id, code) for kp_id in KEYPOINTS.keys()},
+            "all": self._error_indexes[factor].group(code),
+        }
 
     def get_errors_by_location(self, keypoint_id: int) -> np.ndarray:
-        return self._error_indexes["location"][keypoint_id]
+        return self._error_indexes["location"].keypoint(keypoint_id)
 
     def get_keypoint_ids(self) -> List[int]:
-        return list(k for k, v in self._error_indexes["location"].items() if len(v) > 0)
+        counts = self._error_indexes["location"].counts()[:, 0]
+        return [kp_id for kp_id, count in zip(sorted(KEYPOINTS.keys()), counts) if count > 0]
+
+    def get_annotations(self) -> List[Image]:
+        return self._annotations
+
+    def get_estimations(self) -> Dict[str, Dict[int, Dict[int, Keypoint]]]:
+        return self._estimations
+
+    def get_location_errors(self) -> Dict[int, np.ndarray]:
+        """
+        :return: keypoint id -> (n, 2) raw (dx, dy) errors normalized by the IOD, before bias removal and NME filtering
+        """
+        return self._location_errors
+
+    def get_statistical_biases(self) -> Dict[int, tuple]:
+        return self._statistical_biases
+
+    def get_samples(self) -> Dict[str, np.ndarray]:
+        return self._samples
+
+    def publish_samples(self) -> SharedSamples:
+        """
+        Copy the per-sample columns into shared memory blocks that pool workers can attach to by name.
+        The caller owns the blocks: use the returned object as a context manager or call close() when done, which
+        also unlinks them.
+        """
+        return SharedSamples.publish(self._samples)
 
-    def get_all_errors(self) -> Dict[str, Dict[int, np.ndarray]]:
-        return [error for errors in self._error_indexes["location"].values() for error in errors if len(errors) > 0]
+    def get_all_errors(self) -> np.ndarray:
+        """
+        :return: every error, in keypoint order
+        """
+        return self._error_indexes["location"].all()
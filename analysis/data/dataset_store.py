@@ -0,0 +1,230 @@
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from analysis.data.datatypes import Age, Image, Keypoint, Person, Sex, Skintone
+from analysis.profiling import profiled
+
+# Person attributes stored as codes into a vocabulary of their JSON values, -1 when the attribute is absent
+PERSON_ATTRIBUTES = ["age", "sex", "skintone", "occlusion", "lighting", "expression"]
+HEAD_POSE_ANGLES = ["roll", "pitch", "yaw"]
+BBOX_FIELDS = ["x", "y", "w", "h"]
+# Normalized tables of the store: every row of a child table points to its parent row (image or person index)
+STORE_TABLES = {
+    "images": ["name", "width", "height"],
+    "persons": ["image", "id", *PERSON_ATTRIBUTES],
+    "keypoints": ["person", "id", "x", "y"],
+    "bboxes": ["person", *BBOX_FIELDS],
+    "head_poses": ["person", *HEAD_POSE_ANGLES],
+}
+# Field order of an exported person
+PERSON_FIELDS = ["age", "sex", "skintone", "keypoints", "head_pose", "occlusion", "lighting", "expression", "bbox"]
+
+
+def is_store(path: str) -> bool:
+    return str(path).endswith(".npz")
+
+
+def _strip_bboxes(annotations: dict) -> dict:
+    return {
+        image_name: {
+            **metadata,
+            "persons": {
+                person_id: {field: value for field, value in person.items() if field != "bbox"}
+                for person_id, person in metadata["persons"].items()
+            },
+        }
+        for image_name, metadata in annotations.items()
+    }
+
+
+@profiled("dataset_store.build")
+def build_store(annotations: dict) -> Dict[str, np.ndarray]:
+    """
+    Normalize FAIRSET annotations (either JSON schema) into the columns of the store tables, named "table.column".
+    The images, persons and keypoints keep the order of the file.
+    """
+    columns = {f"{table}.{column}": [] for table, table_columns in STORE_TABLES.items() for column in table_columns}
+    vocabularies = {attribute: {} for attribute in PERSON_ATTRIBUTES}
+    person_index = 0
+    for image_index, (image_name, metadata) in enumerate(annotations.items()):
+        unknown = set(metadata.keys()) - {"width", "height", "persons"}
+        if unknown:
+            raise Exception(f"Image {image_name} has unknown fields {sorted(unknown)}, it cannot be stored.")
+        columns["images.name"].append(image_name)
+        columns["images.width"].append(metadata["width"])
+        columns["images.height"].append(metadata["height"])
+        for person_id, person in metadata["persons"].items():
+            unknown = set(person.keys()) - set(PERSON_FIELDS)
+            if unknown:
+                raise Exception(f"Person {person_id} of image {image_name} has unknown fields {sorted(unknown)}.")
+            columns["persons.image"].append(image_index)
+            columns["persons.id"].append(int(person_id))
+            for attribute in PERSON_ATTRIBUTES:
+                code = -1
+                if attribute in person:
+                    code = vocabularies[attribute].setdefault(json.dumps(person[attribute]),
+                                                              len(vocabularies[attribute]))
+                columns[f"persons.{attribute}"].append(code)
+            for kp_id, keypoint in person["keypoints"].items():
+                columns["keypoints.person"].append(person_index)
+                columns["keypoints.id"].append(int(kp_id))
+                columns["keypoints.x"].append(keypoint["x"])
+                columns["keypoints.y"].append(keypoint["y"])
+            if "bbox" in person:
+                columns["bboxes.person"].append(person_index)
+                for field in BBOX_FIELDS:
+                    columns[f"bboxes.{field}"].append(person["bbox"][field])
+            if "head_pose" in person:
+                columns["head_poses.person"].append(person_index)
+                for angle in HEAD_POSE_ANGLES:
+                    columns[f"head_poses.{angle}"].append(person["head_pose"][angle])
+            person_index += 1
+
+    dtypes = {"images.name": np.str_, "persons.id": np.int16, "keypoints.id": np.int16,
+              **{f"persons.{attribute}": np.int8 for attribute in PERSON_ATTRIBUTES},
+              **{f"head_poses.{angle}": np.float64 for angle in HEAD_POSE_ANGLES}}
+    store = {name: np.array(values, dtype=dtypes.get(name, np.int32)) for name, values in columns.items()}
+    for attribute, vocabulary in vocabularies.items():
+        store[f"vocabularies.{attribute}"] = np.array(list(vocabulary.keys()), dtype=np.str_)
+    return store
+
+
+def write_store(annotations_file: str, store_file: str, reference_file: Optional[str] = None):
+    """
+    :param annotations_file: FAIRSET annotations with the bounding boxes
+    :param reference_file: FAIRSET annotations without the bounding boxes, checked to hold exactly the same data
+    """
+    with open(annotations_file, "r") as file:
+        annotations = json.load(file)
+    if reference_file is not None:
+        with open(reference_file, "r") as file:
+            reference = json.load(file)
+        stripped = _strip_bboxes(annotations)
+        drifted = [name for name in stripped.keys() | reference.keys() if stripped.get(name) != reference.get(name)]
+        if drifted:
+            raise Exception(f"{reference_file} and {annotations_file} differ on {len(drifted)} images "
+                            f"(e.g. {sorted(drifted)[0]}), fix them before merging.")
+    np.savez_compressed(store_file, **build_store(annotations))
+
+
+class DatasetStore:
+    """
+    FAIRSET annotations in a compressed columnar file (see STORE_TABLES). The columns are decompressed on access, so
+    each consumer only reads the columns it needs.
+    """
+
+    def __init__(self, store_file: str):
+        self._columns = np.load(store_file)
+
+    def table(self, table: str, columns: Optional[List[str]] = None) -> Dict[str, np.ndarray]:
+        return {column: self._columns[f"{table}.{column}"] for column in columns or STORE_TABLES[table]}
+
+    def vocabulary(self, attribute: str) -> list:
+        return [json.loads(value) for value in self._columns[f"vocabularies.{attribute}"]]
+
+    def bboxes(self) -> Dict[str, Dict[int, tuple]]:
+        """
+        :return: image name -> person id -> (x, y, w, h), as load_bboxes, without reading the keypoints
+        """
+        names = self.table("images", ["name"])["name"]
+        persons = self.table("persons", ["image", "id"])
+        bboxes = self.table("bboxes")
+        result = {str(name): {} for name in names}
+        for person, *bbox in zip(*(bboxes[column].tolist() for column in STORE_TABLES["bboxes"])):
+            result[str(names[persons["image"][person]])][int(persons["id"][person])] = tuple(bbox)
+        return result
+
+    @profiled("dataset_store.images")
+    def images(self) -> List[Image]:
+        """
+        :return: the annotated images as datatypes (as DataLoader), built from the columns without the bounding boxes
+                 and without going through the JSON schema
+        """
+        converters = {"age": Age.from_label, "sex": Sex.from_label, "skintone": Skintone.from_label}
+        # Every attribute value is converted once per vocabulary entry, the last entry (code -1) is the absent value
+        values = {
+            attribute: [converters.get(attribute, lambda label: label)(label)
+                        for label in [*self.vocabulary(attribute), None]]
+            for attribute in PERSON_ATTRIBUTES
+        }
+        persons = self.table("persons")
+        keypoints = self.table("keypoints")
+        # The keypoints of a person and the persons of an image are contiguous
+        kp_bounds = np.searchsorted(keypoints["person"], np.arange(len(persons["id"]) + 1)).tolist()
+        all_keypoints = list(map(Keypoint, *(keypoints[column].tolist() for column in ["x", "y", "id"])))
+        codes = {attribute: persons[attribute].tolist() for attribute in PERSON_ATTRIBUTES}
+        person_list = [
+            Person(
+                person_id,
+                all_keypoints[kp_bounds[index]:kp_bounds[index + 1]],
+                values["skintone"][codes["skintone"][index]],
+                values["age"][codes["age"][index]],
+                values["sex"][codes["sex"][index]],
+                values["occlusion"][codes["occlusion"][index]],
+                values["lighting"][codes["lighting"][index]],
+                values["expression"][codes["expression"][index]],
+            )
+            for index, person_id in enumerate(persons["id"].tolist())
+        ]
+        image_columns = self.table("images")
+        person_bounds = np.searchsorted(persons["image"], np.arange(len(image_columns["name"]) + 1)).tolist()
+        return [
+            Image(name, person_list[person_bounds[index]:person_bounds[index + 1]], width, height)
+            for index, (name, width, height) in enumerate(zip(*(image_columns[column].tolist()
+                                                                for column in STORE_TABLES["images"])))
+        ]
+
+    @profiled("dataset_store.annotations")
+    def annotations(self, with_bboxes: bool = True) -> dict:
+        """
+        :return: the annotations in the FAIRSET JSON schema, with or without the bounding boxes (fairset_bbox.json or
+                 fairset.json)
+        """
+        images = {column: values.tolist() for column, values in self.table("images").items()}
+        persons = {column: values.tolist() for column, values in self.table("persons").items()}
+        keypoints = {column: values.tolist() for column, values in self.table("keypoints").items()}
+        vocabularies = {attribute: self.vocabulary(attribute) for attribute in PERSON_ATTRIBUTES}
+
+        person_records = []
+        for index in range(len(persons["id"])):
+            record = {}
+            for attribute in PERSON_ATTRIBUTES:
+                code = persons[attribute][index]
+                if code >= 0:
+                    record[attribute] = vocabularies[attribute][code]
+            record["keypoints"] = {}
+            person_records.append(record)
+        for person, kp_id, x, y in zip(keypoints["person"], keypoints["id"], keypoints["x"], keypoints["y"]):
+            person_records[person]["keypoints"][str(kp_id)] = {"x": x, "y": y}
+        head_poses = {column: values.tolist() for column, values in self.table("head_poses").items()}
+        for person, *angles in zip(*(head_poses[column] for column in STORE_TABLES["head_poses"])):
+            person_records[person]["head_pose"] = dict(zip(HEAD_POSE_ANGLES, angles))
+        if with_bboxes:
+            bboxes = {column: values.tolist() for column, values in self.table("bboxes").items()}
+            for person, *bbox in zip(*(bboxes[column] for column in STORE_TABLES["bboxes"])):
+                person_records[person]["bbox"] = dict(zip(BBOX_FIELDS, bbox))
+
+        annotations = {
+            name: {"width": width, "height": height, "persons": {}}
+            for name, width, height in zip(images["name"], images["width"], images["height"])
+        }
+        for record, image, person_id in zip(person_records, persons["image"], persons["id"]):
+            ordered = {field: record[field] for field in PERSON_FIELDS if field in record}
+            annotations[images["name"][image]]["persons"][str(person_id)] = ordered
+        return annotations
+
+    def export_json(self, output_file: str, with_bboxes: bool = True):
+        with open(output_file, "w") as file:
+            json.dump(self.annotations(with_bboxes), file, indent=4)
+
+
+def read_annotations(annotations_file: str, with_bboxes: bool = True) -> dict:
+    """
+    FAIRSET annotations in the JSON schema, read from a JSON file or a store
+    """
+    if is_store(annotations_file):
+        return DatasetStore(annotations_file).annotations(with_bboxes)
+    with open(annotations_file, "r") as file:
+        return json.load(file)
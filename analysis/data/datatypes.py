@@ -3,7 +3,6 @@ from dataclasses import dataclass
 from enum import Enum, auto
 from typing import Any, Dict, List, Optional, Tuple
 
-import cv2
 import numpy as np
 
 from analysis.data.locations import KEYPOINTS
@@ -144,7 +143,7 @@ class Skintone(DiscreteFactorEnum):
             "5": cls.Type5,
             "6": cls.Type6
         }
-        return label_map.get(label, cls.NotAvailable)
+        return label_map.get(str(label), cls.NotAvailable)
 
     @classmethod
     def get_property_str(cls) -> str:
@@ -187,6 +186,8 @@ class Keypoint:
         kp_color: Tuple[int, int, int] = (0, 0, 255),
         id_color: Tuple[int, int, int] = (0, 0, 0),
     ):
+        import cv2
+
         image = cv2.circle(image, (self.x, self.y), 5, kp_color, -1)
         image = cv2.putText(image, str(self.id), (self.x + 10, self.y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.3, id_color, 1)
         return image
@@ -270,6 +271,8 @@ class BoundingBox:
         self.w, self.h = self.h, self.w
 
     def annotate_image(self, image: np.ndarray, color: Tuple[int, int, int] = (255, 0, 0)):
+        import cv2
+
         return cv2.rectangle(image, (self.x, self.y), (self.x + self.w, self.y + self.h), color, 2)
 
     def get_intersection(self, bbox: "BoundingBox"):
@@ -314,3 +317,23 @@ FACTORS = {
     "lighting": [True, False],
     "occlusion": [True, False],
 }
+
+# Person attribute holding the group of each discrete factor
+FACTOR_ATTRIBUTES = {
+    "age": "age",
+    "sex": "sex",
+    "skintone": "skintone",
+    "expressions": "expression",
+    "lighting": "lighting",
+    "occlusion": "occlusion",
+}
+
+
+def get_group_code(factor: str, group: Any) -> int:
+    """
+    Integer code of a group within FACTORS[factor], -1 if the group is not available
+    """
+    try:
+        return FACTORS[factor].index(group)
+    except ValueError:
+        return -1
@@ -0,0 +1,66 @@
+from typing import List
+
+import numpy as np
+
+
+class ErrorIndex:
+    """
+    Errors of one factor in a CSR layout: a single flat array sorted by (keypoint, group) with the offsets of every
+    (keypoint, group) segment, and a copy sorted by (group, keypoint) with its own offsets. Any keypoint, group,
+    (keypoint, group) or whole factor retrieval is then a contiguous slice, returned as a view without copying.
+    Within a segment the errors keep the order of the samples.
+    """
+
+    def __init__(self, values: np.ndarray, kp_ids: np.ndarray, codes: np.ndarray, keypoint_ids: List[int],
+                 n_groups: int):
+        """
+        :param values: per-sample errors
+        :param kp_ids: keypoint id of every sample
+        :param codes: group code of every sample in [0, n_groups), -1 for the samples without a group
+        :param keypoint_ids: every indexable keypoint id, empty keypoints included
+        """
+        self._keypoint_slots = {kp_id: slot for slot, kp_id in enumerate(keypoint_ids)}
+        self._n_keypoints = len(keypoint_ids)
+        self._n_groups = n_groups
+
+        valid = codes >= 0
+        values = values[valid]
+        codes = codes[valid].astype(np.int64)
+        kp_slots = np.searchsorted(np.asarray(keypoint_ids), kp_ids[valid])
+        n_segments = self._n_keypoints * n_groups
+        self._values, self._offsets = self._segment(values, kp_slots * n_groups + codes, n_segments)
+        self._group_values, self._group_offsets = self._segment(values, codes * self._n_keypoints + kp_slots,
+                                                                n_segments)
+
+    @staticmethod
+    def _segment(values: np.ndarray, keys: np.ndarray, n_segments: int):
+        order = np.argsort(keys, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=n_segments))))
+        return values[order], offsets
+
+    def keypoint_group(self, kp_id: int, code: int) -> np.ndarray:
+        segment = self._keypoint_slots[kp_id] * self._n_groups + code
+        return self._values[self._offsets[segment]:self._offsets[segment + 1]]
+
+    def keypoint(self, kp_id: int) -> np.ndarray:
+        """
+        :return: the errors of every group on the keypoint
+        """
+        slot = self._keypoint_slots[kp_id]
+        return self._values[self._offsets[slot * self._n_groups]:self._offsets[(slot + 1) * self._n_groups]]
+
+    def group(self, code: int) -> np.ndarray:
+        """
+        :return: the errors of the group on every keypoint, in keypoint order
+        """
+        return self._group_values[self._group_offsets[code * self._n_keypoints]:
+                                  self._group_offsets[(code + 1) * self._n_keypoints]]
+
+    def all(self) -> np.ndarray:
+        return self._values
+
+    def counts(self) -> np.ndarray:
+        """
+        :return: (n_keypoints, n_groups) number of errors of every segment
+        """
+        return np.diff(self._offsets).reshape(self._n_keypoints, self._n_groups)
@@ -0,0 +1,242 @@
+import json
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from analysis.configs import FILTERS
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTOR_ATTRIBUTES, FACTORS, get_group_code
+from analysis.profiling import PROFILER, profiled
+
+# Statistical result key: (factor, group, keypoint id)
+ResultKey = Tuple[str, Any, int]
+
+
+class OrderStatistics:
+    """
+    Sorted multiset of values supporting batched insertions/removals (binary search + block moves) and O(1) median
+    """
+
+    def __init__(self, values: np.ndarray):
+        self._values = np.sort(np.asarray(values, dtype=np.float64))
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def insert(self, values: np.ndarray):
+        if len(values):
+            values = np.sort(values)
+            self._values = np.insert(self._values, np.searchsorted(self._values, values), values)
+
+    def remove(self, values: np.ndarray):
+        if len(values):
+            values = np.sort(values)
+            positions = np.searchsorted(self._values, values)
+            # Equal values to remove must map to consecutive positions
+            first = np.searchsorted(values, values)
+            positions += np.arange(len(values)) - first
+            if np.any(positions >= len(self._values)) or np.any(self._values[positions] != values):
+                raise ValueError("Removing values that are not in the order statistics")
+            self._values = np.delete(self._values, positions)
+
+    def median(self) -> float:
+        n = len(self._values)
+        if n == 0:
+            return np.nan
+        return 0.5 * (self._values[(n - 1) // 2] + self._values[n // 2])
+
+
+class IncrementalEvaluator:
+    """
+    Persisted per-sample evaluation keyed by (image, person, keypoint): ground truth, IOD, groups and the current
+    estimations. A new estimation file is diffed against the stored one and only the changed samples are updated:
+    the per-keypoint median biases are maintained with order statistics and the NMEs are only recomputed for the
+    keypoints whose bias moved. The affected (factor, group, keypoint) results are marked dirty.
+    Implements the DataLoader sample accessors so the summaries and statistical analyses can run on it.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self._columns = columns
+        self._row_index: Dict[Tuple[str, int, int], int] = {
+            key: row
+            for row, key in enumerate(zip(columns["image_name"].tolist(), columns["person_id"].tolist(),
+                                          columns["kp_id"].tolist()))
+        }
+        self._kp_ids = np.unique(columns["kp_id"])
+        self._dirty: Set[ResultKey] = set()
+        self._samples: Optional[Dict[str, np.ndarray]] = None
+
+        dx, dy = self._location_errors()
+        estimated = ~np.isnan(dx)
+        self._dx_statistics = {kp_id: OrderStatistics(dx[estimated & (columns["kp_id"] == kp_id)])
+                               for kp_id in self._kp_ids}
+        self._dy_statistics = {kp_id: OrderStatistics(dy[estimated & (columns["kp_id"] == kp_id)])
+                               for kp_id in self._kp_ids}
+        self._biases = self._compute_biases()
+        self._nme = self._compute_nme(np.ones(len(dx), dtype=bool), np.full(len(dx), np.nan))
+
+    @classmethod
+    def build(cls, data_loader: DataLoader) -> "IncrementalEvaluator":
+        """
+        Initial store from a loaded DataLoader: one row per annotated keypoint of every person passing the IOD filter
+        """
+        rows: Dict[str, list] = {column: [] for column in
+                                 ["image_name", "person_id", "kp_id", "gt_x", "gt_y", "iod", "est_x", "est_y",
+                                  "image", "person", *FACTOR_ATTRIBUTES.keys()]}
+        estimations = data_loader.get_estimations()
+        person_index = -1
+        for image_index, image in enumerate(data_loader.get_annotations()):
+            for person in image.persons:
+                person_index += 1
+                if not person.iod or person.iod <= FILTERS.get("min_iod", -1):
+                    continue
+                person_estimations = estimations.get(image.name, {}).get(person.id, {})
+                codes = [get_group_code(factor, getattr(person, attribute))
+                         for factor, attribute in FACTOR_ATTRIBUTES.items()]
+                for keypoint in person.keypoints:
+                    estimation = person_estimations.get(keypoint.id)
+                    values = [image.name, person.id, keypoint.id, keypoint.x, keypoint.y, person.iod,
+                              np.nan if estimation is None else estimation.x,
+                              np.nan if estimation is None else estimation.y, image_index, person_index, *codes]
+                    for column, value in zip(rows.keys(), values):
+                        rows[column].append(value)
+
+        columns = {column: np.array(values) for column, values in rows.items()}
+        for column in ["gt_x", "gt_y", "iod", "est_x", "est_y"]:
+            columns[column] = columns[column].astype(np.float64)
+        for column in ["image", "person"]:
+            columns[column] = columns[column].astype(np.int32)
+        for factor in FACTOR_ATTRIBUTES.keys():
+            columns[factor] = columns[factor].astype(np.int8)
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path: str) -> "IncrementalEvaluator":
+        with np.load(path) as store:
+            return cls({column: store[column] for column in store.files})
+
+    def save(self, path: str):
+        np.savez(path, **self._columns)
+
+    def _location_errors(self, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        est_x, est_y, gt_x, gt_y, iod = (self._columns[c] for c in ["est_x", "est_y", "gt_x", "gt_y", "iod"])
+        if rows is not None:
+            est_x, est_y, gt_x, gt_y, iod = est_x[rows], est_y[rows], gt_x[rows], gt_y[rows], iod[rows]
+        return (est_x - gt_x) / iod, (est_y - gt_y) / iod
+
+    def _compute_biases(self) -> Dict[int, Tuple[float, float]]:
+        return {kp_id: (self._dx_statistics[kp_id].median(), self._dy_statistics[kp_id].median())
+                for kp_id in self._kp_ids if len(self._dx_statistics[kp_id])}
+
+    def _compute_nme(self, rows: np.ndarray, nme: np.ndarray) -> np.ndarray:
+        """
+        Recompute the NME of the selected rows (boolean mask) in `nme`
+        """
+        dx, dy = self._location_errors(rows)
+        if FILTERS.get("remove_statistical_bias", True):
+            kp_ids = self._columns["kp_id"][rows]
+            bias_x = np.array([self._biases.get(kp_id, (np.nan, np.nan))[0] for kp_id in self._kp_ids])
+            bias_y = np.array([self._biases.get(kp_id, (np.nan, np.nan))[1] for kp_id in self._kp_ids])
+            slots = np.searchsorted(self._kp_ids, kp_ids)
+            dx = dx - bias_x[slots]
+            dy = dy - bias_y[slots]
+        nme[rows] = np.sqrt(dx ** 2 + dy ** 2)
+        return nme
+
+    def _read_estimations(self, estimations_file: str) -> Tuple[np.ndarray, np.ndarray]:
+        est_x = np.full(len(self._row_index), np.nan)
+        est_y = np.full(len(self._row_index), np.nan)
+        with open(estimations_file, "r") as file:
+            estimations = json.load(file)
+        for image_name, persons in estimations.items():
+            for person_id, keypoints in persons.items():
+                for kp_id, kp_data in keypoints.items():
+                    row = self._row_index.get((image_name, int(person_id), int(kp_id)))
+                    if row is not None:
+                        est_x[row] = kp_data["x"]
+                        est_y[row] = kp_data["y"]
+        return est_x, est_y
+
+    @profiled("incremental.update")
+    def update(self, estimations_file: str) -> Set[ResultKey]:
+        """
+        Diff a new estimation file against the stored estimations and update only the changed samples
+        :return: the (factor, group, keypoint id) statistical results made dirty by this update
+        """
+        est_x, est_y = self._read_estimations(estimations_file)
+        old_x, old_y = self._columns["est_x"], self._columns["est_y"]
+        changed = ~(((est_x == old_x) | (np.isnan(est_x) & np.isnan(old_x)))
+                    & ((est_y == old_y) | (np.isnan(est_y) & np.isnan(old_y))))
+        PROFILER.count("incremental.changed_samples", int(changed.sum()))
+        if not changed.any():
+            return set()
+
+        kp_ids = self._columns["kp_id"]
+        old_dx, old_dy = self._location_errors(changed)
+        self._columns["est_x"] = est_x
+        self._columns["est_y"] = est_y
+        new_dx, new_dy = self._location_errors(changed)
+
+        changed_kps = kp_ids[changed]
+        for kp_id in np.unique(changed_kps):
+            in_kp = changed_kps == kp_id
+            for statistics, old, new in [(self._dx_statistics[kp_id], old_dx, new_dx),
+                                         (self._dy_statistics[kp_id], old_dy, new_dy)]:
+                statistics.remove(old[in_kp & ~np.isnan(old)])
+                statistics.insert(new[in_kp & ~np.isnan(new)])
+
+        previous_biases = self._biases
+        self._biases = self._compute_biases()
+        moved = [kp_id for kp_id in self._kp_ids if self._biases.get(kp_id) != previous_biases.get(kp_id)]
+
+        # Every NME of a keypoint depends on its bias, otherwise only the changed samples need to be recomputed
+        recompute = changed | (np.isin(kp_ids, moved) if FILTERS.get("remove_statistical_bias", True) else False)
+        self._nme = self._compute_nme(recompute, self._nme)
+        self._samples = None
+
+        dirty = set()
+        for factor in FACTOR_ATTRIBUTES.keys():
+            codes = self._columns[factor]
+            affected = np.unique(np.stack((codes[recompute], kp_ids[recompute]), axis=1), axis=0)
+            dirty.update((factor, FACTORS[factor][code], int(kp_id)) for code, kp_id in affected if code >= 0)
+        self._dirty |= dirty
+        return dirty
+
+    @property
+    def dirty(self) -> Set[ResultKey]:
+        return self._dirty
+
+    def mark_clean(self, keys: Optional[Set[ResultKey]] = None):
+        self._dirty = set() if keys is None else self._dirty - keys
+
+    def get_statistical_biases(self) -> Dict[int, Tuple[float, float]]:
+        return self._biases
+
+    def get_samples(self) -> Dict[str, np.ndarray]:
+        """
+        Same columns as DataLoader.get_samples, for the estimated samples passing the NME filter
+        """
+        if self._samples is None:
+            kept = ~np.isnan(self._nme)
+            if FILTERS.get("max_nme", -1) != -1:
+                kept &= self._nme < FILTERS["max_nme"]
+            dx, dy = self._location_errors(kept)
+            self._samples = {"nme": self._nme[kept], "dx": dx, "dy": dy,
+                             "kp_id": self._columns["kp_id"][kept].astype(np.int16)}
+            for column in ["image", "person", *FACTOR_ATTRIBUTES.keys()]:
+                self._samples[column] = self._columns[column][kept]
+        return self._samples
+
+    def get_errors_by_group(self, factor: str, group: Any, kp_id: Optional[int] = None) -> np.ndarray:
+        samples = self.get_samples()
+        mask = samples[factor] == get_group_code(factor, group)
+        if kp_id is not None:
+            mask &= samples["kp_id"] == kp_id
+        return samples["nme"][mask]
+
+    def get_errors_by_location(self, keypoint_id: int) -> np.ndarray:
+        samples = self.get_samples()
+        return samples["nme"][samples["kp_id"] == keypoint_id]
+
+    def get_keypoint_ids(self) -> List[int]:
+        return [int(kp_id) for kp_id in np.unique(self.get_samples()["kp_id"])]
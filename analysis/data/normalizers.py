@@ -0,0 +1,189 @@
+import json
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from analysis.data.dataset_store import DatasetStore, is_store
+from analysis.data.datatypes import FACTOR_ATTRIBUTES, Image, Keypoint, get_group_code
+from analysis.data.locations import KEYPOINTS
+from analysis.profiling import profiled
+
+# Normalizations of the keypoint errors, see compute_normalizers
+NORMALIZERS = ["iod", "bbox_diagonal", "bbox_size", "procrustes"]
+# Minimum number of keypoints of a face to solve its similarity alignment
+MIN_ALIGNED_KEYPOINTS = 3
+
+
+def load_bboxes(bbox_file: str) -> Dict[str, Dict[int, tuple]]:
+    """
+    :return: image name -> person id -> (x, y, w, h) of the FAIRSET face bounding boxes
+    """
+    if is_store(bbox_file):
+        return DatasetStore(bbox_file).bboxes()
+    with open(bbox_file, "r") as file:
+        annotations = json.load(file)
+    bboxes = {}
+    for image_name, metadata in annotations.items():
+        bboxes[image_name] = {}
+        for person_id, person_data in metadata["persons"].items():
+            bbox = person_data.get("bbox")
+            if bbox is not None:
+                bboxes[image_name][int(person_id)] = (bbox["x"], bbox["y"], bbox["w"], bbox["h"])
+    return bboxes
+
+
+@dataclass
+class Faces:
+    """
+    Ground truth and estimated keypoints of every annotated person with estimations, stacked as (n_faces,
+    n_keypoints, 2) pixel arrays (NaN where a keypoint is not annotated or not estimated, keypoints in sorted id order)
+    """
+
+    keypoint_ids: np.ndarray
+    ground_truth: np.ndarray
+    estimations: np.ndarray
+    image: np.ndarray  # Index of the image in the annotations
+    person: np.ndarray  # Index of the person over all the annotated persons, as DataLoader samples
+    iod: np.ndarray  # NaN when an eye corner is missing
+    bbox: np.ndarray  # (n_faces, 4) x, y, w, h, NaN without a bounding box
+    codes: Dict[str, np.ndarray]  # Factor -> group code of every face, -1 for NA
+
+    @property
+    def valid(self) -> np.ndarray:
+        """
+        :return: (n_faces, n_keypoints) mask of the keypoints both annotated and estimated
+        """
+        return ~np.isnan(self.ground_truth[..., 0]) & ~np.isnan(self.estimations[..., 0])
+
+
+@profiled("normalizers.gather_faces")
+def gather_faces(annotations: List[Image], estimations: Dict[str, Dict[int, Dict[int, Keypoint]]],
+                 bboxes: Dict[str, Dict[int, tuple]]) -> Faces:
+    """
+    Stack the keypoints of every person with estimations, whatever its IOD
+    :param bboxes: image name -> person id -> (x, y, w, h), see load_bboxes (may be empty)
+    """
+    keypoint_ids = np.array(sorted(KEYPOINTS.keys()))
+    slots = {kp_id: slot for slot, kp_id in enumerate(keypoint_ids)}
+    ground_truth, estimated, image_indices, person_indices, iods, boxes = [], [], [], [], [], []
+    codes = {factor: [] for factor in FACTOR_ATTRIBUTES.keys()}
+    person_index = -1
+    for image_index, image in enumerate(annotations):
+        for person in image.persons:
+            person_index += 1
+            person_estimations = estimations.get(image.name, {}).get(person.id)
+            if person_estimations is None:
+                continue
+            face = np.full((2, len(keypoint_ids), 2), np.nan)
+            for keypoint in person.keypoints:
+                face[0, slots[keypoint.id]] = keypoint.x, keypoint.y
+            for kp_id, estimation in person_estimations.items():
+                face[1, slots[kp_id]] = estimation.x, estimation.y
+            ground_truth.append(face[0])
+            estimated.append(face[1])
+            image_indices.append(image_index)
+            person_indices.append(person_index)
+            iods.append(person.iod or np.nan)
+            boxes.append(bboxes.get(image.name, {}).get(person.id, (np.nan,) * 4))
+            for factor, attribute in FACTOR_ATTRIBUTES.items():
+                codes[factor].append(get_group_code(factor, getattr(person, attribute)))
+
+    shape = (-1, len(keypoint_ids), 2)
+    return Faces(
+        keypoint_ids,
+        np.array(ground_truth, dtype=np.float64).reshape(shape),
+        np.array(estimated, dtype=np.float64).reshape(shape),
+        np.array(image_indices, dtype=np.int32),
+        np.array(person_indices, dtype=np.int32),
+        np.array(iods, dtype=np.float64),
+        np.array(boxes, dtype=np.float64).reshape(-1, 4),
+        {factor: np.array(values, dtype=np.int8) for factor, values in codes.items()},
+    )
+
+
+def similarity_align(ground_truth: np.ndarray, estimations: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    Closed form least squares similarity (rotation, uniform scale, translation) of every estimated face onto its
+    ground truth (Umeyama), solved for all the faces at once with a stacked SVD of the 2x2 cross-covariances
+    :param ground_truth: (n_faces, n_keypoints, 2)
+    :param estimations: (n_faces, n_keypoints, 2)
+    :param valid: (n_faces, n_keypoints) keypoints used for the fit, the others are NaN in the output
+    :return: (n_faces, n_keypoints, 2) aligned estimations, NaN for the faces with less than MIN_ALIGNED_KEYPOINTS
+    """
+    weights = valid.astype(np.float64)
+    counts = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        gt_mean = np.einsum("fk,fkd->fd", weights, np.nan_to_num(ground_truth)) / counts[:, None]
+        est_mean = np.einsum("fk,fkd->fd", weights, np.nan_to_num(estimations)) / counts[:, None]
+    gt_centered = np.where(valid[..., None], ground_truth - gt_mean[:, None], 0.0)
+    est_centered = np.where(valid[..., None], estimations - est_mean[:, None], 0.0)
+
+    solvable = counts >= MIN_ALIGNED_KEYPOINTS
+    covariances = np.einsum("fki,fkj->fij", gt_centered, est_centered)
+    u, singular, vt = np.linalg.svd(covariances[solvable])
+    # Reflections are not similarities: flip the last axis when the best orthogonal map has a negative determinant
+    signs = np.ones((len(u), 2))
+    signs[:, 1] = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+    rotations = np.einsum("fij,fj,fjk->fik", u, signs, vt)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scales = (singular * signs).sum(axis=1) / (est_centered[solvable] ** 2).sum(axis=(1, 2))
+
+    aligned = np.full(estimations.shape, np.nan)
+    aligned[solvable] = (
+        scales[:, None, None] * np.einsum("fij,fkj->fki", rotations, est_centered[solvable])
+        + gt_mean[solvable][:, None]
+    )
+    aligned[~valid] = np.nan
+    return aligned
+
+
+def centroid_size(points: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    :return: root mean square distance of the valid points of every face to their centroid (n_faces,)
+    """
+    weights = valid.astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        counts = weights.sum(axis=1)
+        means = np.einsum("fk,fkd->fd", weights, np.nan_to_num(points)) / counts[:, None]
+        squared = np.where(valid, ((points - means[:, None]) ** 2).sum(axis=-1), 0.0)
+        return np.sqrt(squared.sum(axis=1) / counts)
+
+
+@profiled("normalizers.compute")
+def compute_normalizers(faces: Faces) -> Dict[str, np.ndarray]:
+    """
+    Normalization length of every face for all the NORMALIZERS at once (n_faces,), NaN when unavailable:
+    - iod: inter-ocular distance (outer eye corners), missing for the faces without both eyes
+    - bbox_diagonal: diagonal of the face bounding box
+    - bbox_size: square root of the face bounding box area
+    - procrustes: centroid size of the ground truth keypoints, which normalizes the errors left after the similarity
+      alignment (see normalized_errors)
+    """
+    widths, heights = faces.bbox[:, 2], faces.bbox[:, 3]
+    return {
+        "iod": faces.iod,
+        "bbox_diagonal": np.hypot(widths, heights),
+        "bbox_size": np.sqrt(widths * heights),
+        "procrustes": centroid_size(faces.ground_truth, faces.valid),
+    }
+
+
+@profiled("normalizers.errors")
+def normalized_errors(faces: Faces, normalizer: str, lengths: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    :param lengths: compute_normalizers of the faces
+    :return: (n_faces, n_keypoints, 2) signed errors (estimation - ground truth) over the normalization length, NaN
+             for the keypoints not both annotated and estimated and for the faces without that normalization.
+             The procrustes errors are measured after the similarity alignment of the estimations on the ground truth.
+    """
+    if normalizer not in NORMALIZERS:
+        raise ValueError(f"Unknown normalizer {normalizer}, expected one of {NORMALIZERS}")
+    valid = faces.valid
+    if normalizer == "procrustes":
+        estimations = similarity_align(faces.ground_truth, faces.estimations, valid)
+    else:
+        estimations = np.where(valid[..., None], faces.estimations, np.nan)
+    length = lengths[normalizer]
+    length = np.where(length > 0, length, np.nan)
+    return (estimations - faces.ground_truth) / length[:, None, None]
@@ -0,0 +1,86 @@
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis.data.datatypes import get_group_code
+
+
+@dataclass(frozen=True)
+class SharedColumn:
+    block_name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+class SharedSamples:
+    """
+    Per-sample error columns (see DataLoader.get_samples) living in multiprocessing shared memory blocks.
+    The publishing process owns the blocks, workers attach to them by name through the picklable handle.
+    Implements the DataLoader group accessors so the statistical analyses can run on it directly.
+    """
+
+    def __init__(self, columns: Dict[str, SharedColumn], blocks: List[shared_memory.SharedMemory], owner: bool):
+        self._columns = columns
+        self._blocks = blocks
+        self._owner = owner
+        self._arrays: Optional[Dict[str, np.ndarray]] = {
+            name: np.ndarray(column.shape, dtype=column.dtype, buffer=block.buf)
+            for (name, column), block in zip(columns.items(), blocks)
+        }
+
+    @classmethod
+    def publish(cls, samples: Dict[str, np.ndarray]) -> "SharedSamples":
+        columns, blocks = {}, []
+        for name, values in samples.items():
+            values = np.ascontiguousarray(values)
+            # Zero-sized blocks are not allowed
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+            columns[name] = SharedColumn(block.name, values.shape, values.dtype.str)
+            blocks.append(block)
+        return cls(columns, blocks, owner=True)
+
+    @classmethod
+    def attach(cls, handle: Dict[str, SharedColumn]) -> "SharedSamples":
+        blocks = [shared_memory.SharedMemory(name=column.block_name) for column in handle.values()]
+        return cls(handle, blocks, owner=False)
+
+    @property
+    def handle(self) -> Dict[str, SharedColumn]:
+        return self._columns
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self._arrays[column]
+
+    def get_samples(self) -> Dict[str, np.ndarray]:
+        return self._arrays
+
+    def get_errors_by_group(self, factor: str, group: Any, kp_id: Optional[int] = None) -> np.ndarray:
+        mask = self._arrays[factor] == get_group_code(factor, group)
+        if kp_id is not None:
+            mask &= self._arrays["kp_id"] == kp_id
+        return self._arrays["nme"][mask]
+
+    def get_errors_by_location(self, keypoint_id: int) -> np.ndarray:
+        return self._arrays["nme"][self._arrays["kp_id"] == keypoint_id]
+
+    def get_keypoint_ids(self) -> List[int]:
+        return [int(kp_id) for kp_id in np.unique(self._arrays["kp_id"])]
+
+    def close(self):
+        # The arrays must be released before the underlying buffers can be closed
+        self._arrays = None
+        for block in self._blocks:
+            block.close()
+        if self._owner:
+            for block in self._blocks:
+                block.unlink()
+        self._blocks = []
+
+    def __enter__(self) -> "SharedSamples":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,181 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+from analysis.configs import PROFILING
+
+_NULL_SPAN = nullcontext()
+
+
+class Profiler:
+    """
+    Named timing spans and counters for the loader, statistics and extraction stages.
+    Disabled by default: span() then returns a shared no-op context manager and count() returns immediately.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._spans: List[Dict[str, Any]] = []
+        self._counters: Counter = Counter()
+        self._origin = time.perf_counter()
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._tracemalloc = False
+
+    def enable(self, cprofile: bool = False, trace_memory: bool = False):
+        self.reset()
+        self.enabled = True
+        if cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc = True
+
+    def disable(self):
+        self.enabled = False
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def reset(self):
+        self._spans.clear()
+        self._counters.clear()
+        self._origin = time.perf_counter()
+        self._cprofile = None
+        if self._tracemalloc:
+            tracemalloc.stop()
+            self._tracemalloc = False
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._record_span(name, args)
+
+    @contextmanager
+    def _record_span(self, name: str, args: Dict[str, Any]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._spans.append(
+                {
+                    "name": name,
+                    "start": start - self._origin,
+                    "duration": time.perf_counter() - start,
+                    "thread": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self._counters[name] += n
+
+    def summary(self) -> Dict[str, Any]:
+        stages: Dict[str, Dict[str, float]] = {}
+        for span in self._spans:
+            stage = stages.setdefault(span["name"], {"calls": 0, "total": 0.0, "max": 0.0})
+            stage["calls"] += 1
+            stage["total"] += span["duration"]
+            stage["max"] = max(stage["max"], span["duration"])
+        for stage in stages.values():
+            stage["mean"] = stage["total"] / stage["calls"]
+
+        summary = {"stages": stages, "counters": dict(self._counters)}
+        if self._tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            summary["memory"] = {
+                "current": current,
+                "peak": peak,
+                "top": [str(stat) for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]],
+            }
+        if self._cprofile is not None:
+            stream = io.StringIO()
+            pstats.Stats(self._cprofile, stream=stream).sort_stats("cumulative").print_stats(20)
+            summary["cprofile"] = stream.getvalue()
+        return summary
+
+    def export_json(self, path: str):
+        with open(path, "w") as file:
+            json.dump({**self.summary(), "spans": self._spans}, file, indent=4, default=str)
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(os.path.splitext(path)[0] + ".prof")
+
+    def export_chrome_trace(self, path: str):
+        """
+        Write the spans and counters in the Chrome trace event format (chrome://tracing, Perfetto)
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": pid,
+                "tid": span["thread"],
+                "args": {key: str(value) for key, value in span["args"].items()},
+            }
+            for span in self._spans
+        ]
+        end = max((span["start"] + span["duration"] for span in self._spans), default=0.0)
+        events.extend(
+            {"name": name, "ph": "C", "ts": end * 1e6, "pid": pid, "args": {name: value}}
+            for name, value in self._counters.items()
+        )
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def export(self, path: str, trace_format: str = "json"):
+        if trace_format == "chrome":
+            self.export_chrome_trace(path)
+        else:
+            self.export_json(path)
+
+
+PROFILER = Profiler()
+
+
+def profiled(name: Optional[str] = None) -> Callable:
+    """
+    Decorator recording each call of the function as a span, named after the function by default
+    """
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            with PROFILER.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def enable_from_config(output_file: Optional[str] = None) -> bool:
+    """
+    Enable the profiler according to the PROFILING config, `output_file` (e.g. from a CLI flag) forces it on
+    """
+    if output_file is not None:
+        PROFILING["output_file"] = output_file
+    if PROFILING.get("enabled", False) or output_file is not None:
+        PROFILER.enable(cprofile=PROFILING.get("cprofile", False), trace_memory=PROFILING.get("tracemalloc", False))
+    return PROFILER.enabled
+
+
+def export_from_config():
+    if PROFILER.enabled:
+        PROFILER.disable()
+        PROFILER.export(PROFILING.get("output_file", "profile.json"), PROFILING.get("format", "json"))
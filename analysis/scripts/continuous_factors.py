@@ -0,0 +1,63 @@
+import argparse
+
+from termcolor import colored
+
+from analysis.data.covariates import COVARIATES
+from analysis.data.data_loader import DataLoader
+from analysis.profiling import enable_from_config, export_from_config
+from analysis.stats.continuous_factors import ContinuousFactorAnalysis
+from analysis.stats.summaries import ALL_KEYPOINTS
+
+DEMOGRAPHIC_FACTORS = ["age", "sex", "skintone"]
+
+
+def main(args):
+    enable_from_config(args.profile)
+    data_loader = DataLoader()
+    analysis = ContinuousFactorAnalysis(data_loader)
+
+    binned = analysis.binned_summaries(args.covariate, args.bins)
+    print(f"NME per {args.covariate} quantile bin (all keypoints):")
+    print(binned[binned["kp_id"] == ALL_KEYPOINTS].drop(columns="kp_id").to_string(index=False))
+
+    regression = analysis.regression(args.covariates, args.factors)
+    for kp_id, terms in regression.groupby("kp_id"):
+        significant = terms[(terms["term"] != "intercept") & (terms["p"] <= args.alpha)]
+        color = "red" if len(significant) else "green"
+        print(colored(f"\nKeypoint {kp_id}| n: {terms['n'].iloc[0]} R2: {terms['r2'].iloc[0]:.4f}", color))
+        for row in significant.itertuples():
+            print(colored(f"{row.term} coef: {row.coef:.4f} p: {row.p:.4f} partial r: {row.partial_r:.3f}", "yellow"))
+
+    if args.output is not None:
+        regression.to_csv(args.output, index=False)
+    export_from_config()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="NME against continuous covariates (face size, resolution), jointly with the demographic factors"
+    )
+    parser.add_argument(
+        "-c", "--covariate", choices=COVARIATES, default="relative_face_size", help="Covariate of the binned summary"
+    )
+    parser.add_argument("-b", "--bins", type=int, default=4, help="Number of quantile bins (default: 4)")
+    parser.add_argument(
+        "-r",
+        "--covariates",
+        nargs="+",
+        choices=COVARIATES,
+        default=["iod", "relative_face_size", "resolution"],
+        help="Covariates of the per keypoint regression",
+    )
+    parser.add_argument(
+        "-f",
+        "--factors",
+        nargs="*",
+        choices=DEMOGRAPHIC_FACTORS,
+        default=DEMOGRAPHIC_FACTORS,
+        help="Demographic factors of the per keypoint regression",
+    )
+    parser.add_argument("--alpha", type=float, default=0.05, help="Significance level (default: 0.05)")
+    parser.add_argument("-o", "--output", default=None, help="Write the regression table to this CSV file")
+    parser.add_argument("--profile", default=None, help="Record the stage timings and write them to this file")
+    main(parser.parse_args())
@@ -0,0 +1,54 @@
+import argparse
+import os
+
+from termcolor import colored
+
+from analysis.configs import DATA
+from analysis.data.dataset_store import DatasetStore, write_store
+
+
+def pack(args):
+    write_store(args.annotations, args.output, args.reference)
+    sizes = {path: os.path.getsize(path) for path in [args.annotations, args.reference, args.output] if path}
+    for path, size in sizes.items():
+        print(f"{path}: {size / 1e6:.2f} MB")
+    print(colored(f"Store written to {args.output}", "green"))
+
+
+def export(args):
+    store = DatasetStore(args.store)
+    if args.annotations:
+        store.export_json(args.annotations, with_bboxes=False)
+        print(colored(f"Annotations without bounding boxes written to {args.annotations}", "green"))
+    if args.bbox:
+        store.export_json(args.bbox, with_bboxes=True)
+        print(colored(f"Annotations with bounding boxes written to {args.bbox}", "green"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack the FAIRSET annotations in a normalized columnar store, or export the store back to the JSON "
+                    "files"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = commands.add_parser("pack", help="Build the store from the JSON annotations")
+    pack_parser.add_argument("-a", "--annotations", default=DATA["bbox_file"],
+                             help="FAIRSET annotations with the bounding boxes (default: DATA['bbox_file'])")
+    pack_parser.add_argument(
+        "-r", "--reference", default=DATA["annotations_file"],
+        help="FAIRSET annotations without the bounding boxes, checked to match (default: DATA['annotations_file'])"
+    )
+    pack_parser.add_argument("-o", "--output", default="fairset.npz", help="Store file (default: fairset.npz)")
+    pack_parser.set_defaults(run=pack)
+
+    export_parser = commands.add_parser("export", help="Write the JSON annotations from the store")
+    export_parser.add_argument("-s", "--store", default="fairset.npz", help="Store file (default: fairset.npz)")
+    export_parser.add_argument("-a", "--annotations", default=None,
+                               help="Output of the annotations without the bounding boxes (fairset.json schema)")
+    export_parser.add_argument("-b", "--bbox", default=None,
+                               help="Output of the annotations with the bounding boxes (fairset_bbox.json schema)")
+    export_parser.set_defaults(run=export)
+
+    parsed = parser.parse_args()
+    parsed.run(parsed)
@@ -1,12 +1,13 @@
 import argparse
 
-import numpy as np
 from termcolor import colored
 
 from analysis.data.data_loader import DataLoader
 from analysis.data.datatypes import Age, Sex, Skintone
+from analysis.profiling import enable_from_config, export_from_config
 from analysis.stats.discrete_groups.n_group_analysis import NGroupAnalysis
-from analysis.utils import display_demog_box_plot
+from analysis.stats.summaries import BoxSummaries
+from analysis.utils import display_demog_box_plot_from_summaries
 
 demographics_datatypes = {
     "age": Age,
@@ -16,10 +17,12 @@ demographics_datatypes = {
 
 
 def main(args):
+    enable_from_config(args.profile)
     factor = args.factor
 
     data_loader = DataLoader()
     analysis = NGroupAnalysis(data_loader, factor)
+    tukey = None  # Post-hoc of all keypoints, computed in one batch on the first significant keypoint
 
     for kp_id in data_loader.get_keypoint_ids():
         anova = analysis.one_way_anova(kp_id)
@@ -36,19 +39,27 @@ def main(args):
                 print(n_samples)
             if anova["p"] <= 0.05:
                 print(colored(f"\nANOVA for keypoint {kp_id}| F: {anova['F']} p: {anova['p']}", "red"))
-                post_hoc = analysis.tukey_post_hoc(kp_id)
+                if tukey is None:
+                    tukey = analysis.tukey_post_hoc()
+                post_hoc = tukey[(tukey["kp_id"] == kp_id) & (tukey["p_adj"] <= 0.05)]
 
                 tukey_str = "Tukey: \n"
-                for g1, g2, meandiff, p, _, _, reject in post_hoc:
-                    if p.data != "p-adj" and p.data <= 0.05:
-                        tukey_str += f"{g1.data}->{g2.data} diff: {meandiff.data:.4f} p: {p.data:.4f} reject: {reject.data}\n"
+                for row in post_hoc.itertuples():
+                    g1, g2 = (getattr(group, "name", group) for group in (row.group1, row.group2))
+                    tukey_str += f"{g1}->{g2} diff: {row.meandiff:.4f} p: {row.p_adj:.4f} reject: {row.reject}\n"
                 print(colored(tukey_str, "yellow"))
             else:
                 print(colored(f"ANOVA for keypoint {kp_id}| F: {anova['F']} p: {anova['p']}", "green"))
 
+    export_from_config()
+
     if args.descriptive:
-        data = data_loader.get_all_group_errors(factor)
-        display_demog_box_plot(data, demographics_datatypes[factor])
+        summaries = BoxSummaries({"estimations": data_loader})
+        ax = display_demog_box_plot_from_summaries(
+            summaries.bxp_stats("estimations", factor), demographics_datatypes[factor], show=args.save is None
+        )
+        if args.save is not None:
+            ax.figure.savefig(args.save)
 
 
 if __name__ == "__main__":
@@ -56,7 +67,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "-f",
         "--factor",
-        action="store_true",
+        action="store",
+        choices=list(demographics_datatypes.keys()),
         default="age",
         help="The demographic factor on which to run the analysis (default is 'age', options are 'age', 'sex' and 'skintone')",
     )
@@ -78,5 +90,23 @@ if __name__ == "__main__":
         help="Runs and displays the descriptive statistics for the analysis",
     )
 
+    parser.add_argument(
+        "-s",
+        "--save",
+        action="store",
+        default=None,
+        help="Save the box plot to this file instead of displaying it (non-interactive)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store",
+        default=None,
+        help="Record the stage timings and write them to this file (format and options from PROFILING in configs.py)",
+    )
+
     args = parser.parse_args()
+    if args.save is not None:
+        import matplotlib
+
+        matplotlib.use("Agg")
     main(args)
@@ -0,0 +1,77 @@
+import argparse
+from pathlib import Path
+
+from termcolor import colored
+
+from analysis.configs import MEDIAPIPE
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS, Age
+from analysis.profiling import enable_from_config, export_from_config
+from analysis.stats.error_field import ErrorField, reference_face
+
+DISCRETE_FACTORS = [factor for factor in FACTORS.keys() if factor != "location"]
+
+
+def load_background(images_folder: str, image_name: str):
+    import matplotlib.pyplot as plt
+
+    path = Path(images_folder) / image_name
+    if not path.exists():
+        print(colored(f"Reference image {path} not found, drawing the keypoints only", "yellow"))
+        return None
+    return plt.imread(path)
+
+
+def main(args):
+    enable_from_config(args.profile)
+    data_loader = DataLoader()
+    field = ErrorField({"model": data_loader}, [args.factor])
+
+    tests = field.hotelling(args.alpha)
+    for kp_id, kp_tests in tests[tests["reject"]].groupby("kp_id"):
+        print(colored(f"\nKeypoint {kp_id}| Hotelling T2 between groups:", "red"))
+        for row in kp_tests.itertuples():
+            print(colored(f"{row.group1} vs {row.group2}| diff: ({row.diff_dx:.4f}, {row.diff_dy:.4f}) "
+                          f"T2: {row.t2:.2f} p: {row.p:.4f}", "yellow"))
+
+    import matplotlib
+
+    if args.save:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from analysis.utils import display_error_field, group_label
+
+    ellipses = field.ellipses(args.confidence, of_mean=True)
+    # Every age group is drawn on its own reference face, the groups of the other factors on the adult face
+    panels = [[group] for group in FACTORS["age"]] if args.factor == "age" else [FACTORS[args.factor]]
+    fig, axes = plt.subplots(1, len(panels), figsize=(7 * len(panels), 7), squeeze=False)
+    for ax, groups in zip(axes[0], panels):
+        reference = groups[0].reference_image if args.factor == "age" else Age.Adult.reference_image
+        keypoints, iod = reference_face(data_loader, reference)
+        rows = ellipses[ellipses["group"].isin(groups)]
+        title = group_label(groups[0]) if len(groups) == 1 else args.factor.capitalize()
+        display_error_field(keypoints, iod, rows, load_background(args.images, reference), args.exaggeration, title,
+                            ax=ax, show=False)
+    fig.suptitle(f"Mean error vectors and {args.confidence:.0%} confidence ellipses")
+    if args.save:
+        fig.savefig(args.save, dpi=100)
+    else:
+        plt.show()
+    export_from_config()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Direction of the keypoint errors per group, drawn on reference faces")
+    parser.add_argument("-f", "--factor", choices=DISCRETE_FACTORS, default="age", help="Demographic factor")
+    parser.add_argument(
+        "-i", "--images", default=MEDIAPIPE["images_folder"], help="Folder of the FAIRSET images (reference faces)"
+    )
+    parser.add_argument(
+        "-x", "--exaggeration", type=float, default=10.0, help="Magnification of the error vectors (default: 10)"
+    )
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence of the mean ellipses")
+    parser.add_argument("--alpha", type=float, default=0.05, help="Significance level (default: 0.05)")
+    parser.add_argument("-s", "--save", default=None, help="Save the figure to this file instead of displaying it")
+    parser.add_argument("--profile", default=None, help="Record the stage timings and write them to this file")
+    main(parser.parse_args())
@@ -0,0 +1,426 @@
+import argparse
+import html
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from analysis.configs import DATA
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS, Age, Sex, Skintone
+from analysis.data.normalizers import NORMALIZERS
+from analysis.profiling import PROFILER, enable_from_config, export_from_config
+from analysis.stats.ced import AUC_LIMIT, CED_THRESHOLDS, FAILURE_THRESHOLD, CEDCurves
+from analysis.stats.discrete_groups.n_group_analysis import NGroupAnalysis
+from analysis.stats.discrete_groups.non_parametric_analysis import non_parametric_report
+from analysis.stats.parallel import run_statistics
+from analysis.stats.ranks import P_VALUE_CORRECTIONS
+from analysis.stats.summaries import ALL_KEYPOINTS, BoxSummaries
+
+DISCRETE_FACTORS = [factor for factor in FACTORS.keys() if factor != "location"]
+FACTOR_DATATYPES = {
+    "age": Age,
+    "sex": Sex,
+    "skintone": Skintone,
+}
+PREREQUISITES = ["one_way_anova", "shapiro_wilk", "levene_test"]
+# Shapiro-Wilk needs at least 3 samples per group
+MIN_GROUP_SAMPLES = 3
+
+
+def group_name(group: Any) -> str:
+    return getattr(group, "name", str(group))
+
+
+def run_jobs(data_loader: DataLoader, jobs: List[tuple], n_jobs: int) -> Dict[tuple, Any]:
+    if n_jobs == 1:
+        results = {}
+        analyses = {}
+        for job in jobs:
+            analysis_cls, factor, method, kp_id = job
+            analysis = analyses.setdefault((analysis_cls, factor), analysis_cls(data_loader, factor))
+            results[job] = getattr(analysis, method)(kp_id)
+        return results
+    return run_statistics(data_loader, jobs, n_jobs or None)
+
+
+def testable_keypoints(summaries: BoxSummaries, model: str, factor: str) -> List[int]:
+    """
+    Keypoints where every group of the factor has enough samples for the tests
+    """
+    frame = summaries.get(factor)
+    frame = frame[(frame["model"] == model) & (frame["kp_id"] != ALL_KEYPOINTS)]
+    counts = frame.groupby("kp_id")["n"].agg(["min", "count"])
+    valid = (counts["min"] >= MIN_GROUP_SAMPLES) & (counts["count"] == len(FACTORS[factor]))
+    return [int(kp_id) for kp_id in counts.index[valid]]
+
+
+def compute_statistics(model: str, data_loader: DataLoader, summaries: BoxSummaries, factors: List[str],
+                       n_jobs: int, alpha: float) -> Dict[str, pd.DataFrame]:
+    """
+    ANOVA, prerequisites and Tukey post-hoc (significant keypoints only, batched over the keypoints of each factor)
+    for every factor and keypoint of a model
+    """
+    keypoints = {factor: testable_keypoints(summaries, model, factor) for factor in factors}
+    jobs = [
+        (NGroupAnalysis, factor, method, kp_id)
+        for factor in factors
+        for kp_id in keypoints[factor]
+        for method in PREREQUISITES
+    ]
+    results = run_jobs(data_loader, jobs, n_jobs)
+
+    anova_rows, normality_rows = [], []
+    for factor in factors:
+        for kp_id in keypoints[factor]:
+            anova = results[(NGroupAnalysis, factor, "one_way_anova", kp_id)]
+            levene = results[(NGroupAnalysis, factor, "levene_test", kp_id)]
+            anova_rows.append(
+                {
+                    "model": model, "factor": factor, "kp_id": kp_id, "F": anova["F"], "p": anova["p"],
+                    "significant": anova["p"] <= alpha, "levene_stat": levene["stat"], "levene_p": levene["p_value"],
+                }
+            )
+            for group, shapiro in results[(NGroupAnalysis, factor, "shapiro_wilk", kp_id)].items():
+                normality_rows.append(
+                    {
+                        "model": model, "factor": factor, "kp_id": kp_id, "group": group_name(group),
+                        "shapiro_stat": shapiro["stat"], "shapiro_p": shapiro["p_value"],
+                    }
+                )
+    anova = pd.DataFrame(anova_rows, columns=["model", "factor", "kp_id", "F", "p", "significant", "levene_stat",
+                                              "levene_p"])
+
+    tukey_frames = []
+    for factor in factors:
+        significant = anova.loc[(anova["factor"] == factor) & anova["significant"], "kp_id"]
+        if len(significant):
+            table = NGroupAnalysis(data_loader, factor).tukey_post_hoc(alpha=alpha)
+            table = table[table["kp_id"].isin(significant)].copy()
+            for column in ["group1", "group2"]:
+                table[column] = [group_name(group) for group in table[column]]
+            table.insert(0, "factor", factor)
+            table.insert(0, "model", model)
+            tukey_frames.append(table)
+    columns = ["model", "factor", "kp_id", "group1", "group2", "meandiff", "p_adj", "lower", "upper", "reject"]
+    tukey = pd.concat(tukey_frames, ignore_index=True) if tukey_frames else pd.DataFrame(columns=columns)
+
+    return {"anova": anova, "normality": pd.DataFrame(normality_rows), "tukey": tukey}
+
+
+def compute_non_parametric(model: str, data_loader: DataLoader, factors: List[str], correction: str,
+                           alpha: float) -> Dict[str, pd.DataFrame]:
+    """
+    Kruskal-Wallis, Dunn and pairwise Mann-Whitney tables of every factor and keypoint, from one ranking of the errors
+    """
+    tables: Dict[str, List[pd.DataFrame]] = {"kruskal_wallis": [], "dunn": [], "mann_whitney": []}
+    for factor, results in non_parametric_report(data_loader, factors, correction, alpha).items():
+        for name, table in results.items():
+            table = table.copy()
+            for column in ["group1", "group2"]:
+                if column in table:
+                    table[column] = [group_name(group) for group in table[column]]
+            table.insert(0, "factor", factor)
+            table.insert(0, "model", model)
+            tables[name].append(table)
+    return {name: pd.concat(frames, ignore_index=True) for name, frames in tables.items()}
+
+
+def compute_effect_sizes(model: str, data_loader: DataLoader, factors: List[str], n_bootstrap: int) -> pd.DataFrame:
+    """
+    Effect sizes of every pair of groups, for every factor and keypoint
+    """
+    frames = []
+    for factor in factors:
+        table = NGroupAnalysis(data_loader, factor).effect_sizes(n_bootstrap=n_bootstrap)
+        for column in ["group1", "group2"]:
+            table[column] = [group_name(group) for group in table[column]]
+        table.insert(0, "factor", factor)
+        table.insert(0, "model", model)
+        frames.append(table)
+    return pd.concat(frames, ignore_index=True)
+
+
+def compute_mixed_effects(model: str, data_loader: DataLoader, factors: List[str], alpha: float) -> pd.DataFrame:
+    """
+    Wald test of every factor in a mixed-effects model over all keypoints, with random intercepts per image and person
+    """
+    rows = []
+    for factor in factors:
+        fit = NGroupAnalysis(data_loader, factor).mixed_effects()
+        test = fit.factor_tests().set_index("factor").loc[factor]
+        rows.append({
+            "model": model, "factor": factor, "df": int(test["df"]), "chi2": test["chi2"], "p": test["p"],
+            "significant": test["p"] <= alpha, "n": fit.n, "n_persons": fit.n_persons,
+            **{f"var_{effect}": variance for effect, variance in fit.variances.items()},
+        })
+    return pd.DataFrame(rows)
+
+
+def _init_figure_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def _render_figures(job: Tuple[str, str, Dict[Any, dict], Dict[int, Dict[Any, dict]], Path]) -> List[str]:
+    import matplotlib.pyplot as plt
+
+    from analysis.utils import display_demog_box_plot_from_summaries, display_keypoint_box_plots
+
+    model, factor, overall, per_keypoint, figures_dir = job
+    demographic_factor = FACTOR_DATATYPES.get(factor, factor)
+
+    overview_path = figures_dir / f"{model}_{factor}.png"
+    ax = display_demog_box_plot_from_summaries(overall, demographic_factor, show=False)
+    ax.figure.savefig(overview_path, dpi=100)
+    plt.close(ax.figure)
+
+    keypoints_path = figures_dir / f"{model}_{factor}_keypoints.png"
+    fig = display_keypoint_box_plots(per_keypoint, demographic_factor)
+    fig.savefig(keypoints_path, dpi=80)
+    plt.close(fig)
+    return [str(overview_path), str(keypoints_path)]
+
+
+def render_figures(summaries: BoxSummaries, models: List[str], factors: List[str], figures_dir: Path, n_jobs: int):
+    """
+    Render the box plots off-screen in worker processes, only the precomputed summaries are sent to the workers
+    """
+    figures_dir.mkdir(parents=True, exist_ok=True)
+    jobs = []
+    for model in models:
+        for factor in factors:
+            frame = summaries.get(factor)
+            kp_ids = sorted(set(frame.loc[frame["model"] == model, "kp_id"]) - {ALL_KEYPOINTS})
+            per_keypoint = {kp_id: summaries.bxp_stats(model, factor, kp_id) for kp_id in kp_ids}
+            jobs.append((model, factor, summaries.bxp_stats(model, factor), per_keypoint, figures_dir))
+
+    if n_jobs == 1:
+        _init_figure_worker()
+        return [_render_figures(job) for job in jobs]
+    with ProcessPoolExecutor(n_jobs or None, initializer=_init_figure_worker) as pool:
+        return list(pool.map(_render_figures, jobs))
+
+
+def render_ced_figures(ced: CEDCurves, factors: List[str], figures_dir: Path) -> List[str]:
+    """
+    One CED figure per factor (all keypoints), with the curves of every model and group
+    """
+    import matplotlib.pyplot as plt
+
+    from analysis.utils import display_ced_curves
+
+    _init_figure_worker()
+    figures_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for factor in factors:
+        path = figures_dir / f"ced_{factor}.png"
+        ax = display_ced_curves(CED_THRESHOLDS, ced.select(factor), FACTOR_DATATYPES.get(factor, factor), show=False)
+        ax.figure.savefig(path, dpi=100)
+        plt.close(ax.figure)
+        paths.append(str(path))
+    return paths
+
+
+def write_tables(tables: Dict[str, pd.DataFrame], output_dir: Path, table_format: str):
+    tables_dir = output_dir / "tables"
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    for name, table in tables.items():
+        if table_format == "parquet":
+            table.to_parquet(tables_dir / f"{name}.parquet", index=False)
+        else:
+            table.to_csv(tables_dir / f"{name}.csv", index=False)
+
+
+def markdown_table(frame: pd.DataFrame) -> str:
+    if frame.empty:
+        return "_None_\n"
+    formatted = frame.apply(lambda column: column.map(lambda v: f"{v:.4g}" if isinstance(v, (float, np.floating))
+                                                      else str(v)))
+    lines = ["| " + " | ".join(frame.columns) + " |", "|" + "---|" * len(frame.columns)]
+    lines.extend("| " + " | ".join(row) + " |" for row in formatted.itertuples(index=False))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(tables: Dict[str, pd.DataFrame], models: List[str], factors: List[str], output_dir: Path,
+                 report_format: str, alpha: float) -> Path:
+    anova, tukey, kruskal, dunn = tables["anova"], tables["tukey"], tables["kruskal_wallis"], tables["dunn"]
+    ced, mixed = tables["ced"], tables["mixed_effects"]
+    sections = []
+    for model in models:
+        for factor in factors:
+            factor_anova = anova[(anova["model"] == model) & (anova["factor"] == factor)]
+            factor_tukey = tukey[(tukey["model"] == model) & (tukey["factor"] == factor) & tukey["reject"].astype(bool)]
+            factor_kruskal = kruskal[(kruskal["model"] == model) & (kruskal["factor"] == factor)]
+            factor_dunn = dunn[(dunn["model"] == model) & (dunn["factor"] == factor) & dunn["reject"].astype(bool)]
+            factor_ced = ced[(ced["model"] == model) & (ced["factor"] == factor) & (ced["kp_id"] == ALL_KEYPOINTS)]
+            factor_mixed = mixed[(mixed["model"] == model) & (mixed["factor"] == factor)]
+            sections.append(
+                {
+                    "title": f"{model} - {factor}",
+                    "figures": [f"figures/{model}_{factor}.png", f"figures/{model}_{factor}_keypoints.png",
+                                f"figures/ced_{factor}.png"],
+                    "significant": factor_anova[factor_anova["significant"]][["kp_id", "F", "p"]],
+                    "tukey": factor_tukey[["kp_id", "group1", "group2", "meandiff", "p_adj"]],
+                    "n_tested": len(factor_anova),
+                    "kruskal": factor_kruskal[factor_kruskal["p"] <= alpha][["kp_id", "H", "p"]],
+                    "n_kruskal": len(factor_kruskal),
+                    "dunn": factor_dunn[["kp_id", "group1", "group2", "z", "p_adj"]],
+                    "ced": factor_ced[["group", "n", "auc", "failure_rate"]],
+                    "mixed": factor_mixed[["df", "chi2", "p", "var_image", "var_person", "var_residual"]],
+                }
+            )
+
+    if report_format == "html":
+        path = output_dir / "report.html"
+        body = [f"<h1>FAIRSET demographic bias report</h1><p>Significance level: {alpha}</p>"]
+        for section in sections:
+            body.append(f"<h2>{html.escape(section['title'])}</h2>")
+            body.extend(f'<img src="{figure}" style="max-width:100%">' for figure in section["figures"])
+            body.append(f"<h3>Significant ANOVA ({len(section['significant'])}/{section['n_tested']} keypoints)</h3>")
+            body.append(section["significant"].to_html(index=False, float_format="{:.4g}".format))
+            body.append("<h3>Tukey HSD rejected pairs</h3>")
+            body.append(section["tukey"].to_html(index=False, float_format="{:.4g}".format))
+            body.append(f"<h3>Significant Kruskal-Wallis ({len(section['kruskal'])}/{section['n_kruskal']} "
+                        f"keypoints)</h3>")
+            body.append(section["kruskal"].to_html(index=False, float_format="{:.4g}".format))
+            body.append("<h3>Dunn rejected pairs</h3>")
+            body.append(section["dunn"].to_html(index=False, float_format="{:.4g}".format))
+            body.append("<h3>CED AUC and failure rate (all keypoints)</h3>")
+            body.append(section["ced"].to_html(index=False, float_format="{:.4g}".format))
+            body.append("<h3>Mixed-effects Wald test (all keypoints, random image and person intercepts)</h3>")
+            body.append(section["mixed"].to_html(index=False, float_format="{:.4g}".format))
+        path.write_text("<html><head><meta charset='utf-8'><title>FAIRSET report</title></head><body>"
+                        + "\n".join(body) + "</body></html>")
+    else:
+        path = output_dir / "report.md"
+        lines = ["# FAIRSET demographic bias report", "", f"Significance level: {alpha}", ""]
+        for section in sections:
+            lines.extend([f"## {section['title']}", ""])
+            lines.extend(f"![{section['title']}]({figure})" for figure in section["figures"])
+            lines.extend(["", f"### Significant ANOVA ({len(section['significant'])}/{section['n_tested']} keypoints)",
+                          "", markdown_table(section["significant"]), "### Tukey HSD rejected pairs", "",
+                          markdown_table(section["tukey"]),
+                          f"### Significant Kruskal-Wallis ({len(section['kruskal'])}/{section['n_kruskal']} "
+                          "keypoints)", "", markdown_table(section["kruskal"]), "### Dunn rejected pairs", "",
+                          markdown_table(section["dunn"]), "### CED AUC and failure rate (all keypoints)", "",
+                          markdown_table(section["ced"]),
+                          "### Mixed-effects Wald test (all keypoints, random image and person intercepts)", "",
+                          markdown_table(section["mixed"])])
+        path.write_text("\n".join(lines))
+    return path
+
+
+def parse_models(estimations: List[str]) -> Dict[str, str]:
+    models = {}
+    for estimation in estimations:
+        name, _, path = estimation.rpartition("=")
+        models[name or Path(path).stem] = path
+    return models
+
+
+def main(args):
+    enable_from_config(args.profile)
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    models = parse_models(args.estimations or [DATA["estimations_file"]])
+
+    data_loaders = {}
+    for model, estimations_file in models.items():
+        with PROFILER.span("report.load", model=model):
+            data_loaders[model] = DataLoader(estimations_file)
+            data_loaders[model].set_normalizer(args.normalizer)
+    summaries = BoxSummaries(data_loaders)
+
+    tables: Dict[str, List[pd.DataFrame]] = {"anova": [], "normality": [], "tukey": [], "kruskal_wallis": [],
+                                             "dunn": [], "mann_whitney": [], "effect_sizes": [], "mixed_effects": []}
+    for model, data_loader in data_loaders.items():
+        with PROFILER.span("report.statistics", model=model):
+            for name, table in compute_statistics(model, data_loader, summaries, args.factors, args.jobs,
+                                                  args.alpha).items():
+                tables[name].append(table)
+        with PROFILER.span("report.non_parametric", model=model):
+            for name, table in compute_non_parametric(model, data_loader, args.factors, args.correction,
+                                                      args.alpha).items():
+                tables[name].append(table)
+        with PROFILER.span("report.effect_sizes", model=model):
+            tables["effect_sizes"].append(compute_effect_sizes(model, data_loader, args.factors, args.bootstrap))
+        with PROFILER.span("report.mixed_effects", model=model):
+            tables["mixed_effects"].append(compute_mixed_effects(model, data_loader, args.factors, args.alpha))
+    tables = {name: pd.concat(frames, ignore_index=True) for name, frames in tables.items()}
+    tables["summaries"] = summaries.to_frame(args.factors)
+    with PROFILER.span("report.ced"):
+        ced = CEDCurves(data_loaders, args.factors)
+        tables["ced"] = ced.metrics(args.auc_limit, args.failure_threshold)
+        tables["ced"]["group"] = [group_name(group) for group in tables["ced"]["group"]]
+
+    with PROFILER.span("report.figures"):
+        render_figures(summaries, list(models.keys()), args.factors, output_dir / "figures", args.jobs)
+        render_ced_figures(ced, args.factors, output_dir / "figures")
+    with PROFILER.span("report.write"):
+        write_tables(tables, output_dir, args.tables)
+        report_path = write_report(tables, list(models.keys()), args.factors, output_dir, args.format, args.alpha)
+
+    export_from_config()
+    print(f"Report written to {report_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless report of all factors and keypoints, for one or more models")
+    parser.add_argument(
+        "-e",
+        "--estimations",
+        nargs="+",
+        help="Estimation files to evaluate, as PATH or NAME=PATH (default: DATA['estimations_file'])",
+    )
+    parser.add_argument(
+        "-f",
+        "--factors",
+        nargs="+",
+        choices=DISCRETE_FACTORS,
+        default=DISCRETE_FACTORS,
+        help="Factors to analyse (default: all)",
+    )
+    parser.add_argument("-o", "--output", default="report", help="Output directory (default: report)")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of worker processes, 0 for one per CPU (default: 1)"
+    )
+    parser.add_argument("--format", choices=["markdown", "html"], default="markdown", help="Report format")
+    parser.add_argument(
+        "--tables", choices=["csv", "parquet"], default="csv", help="Tables format, parquet requires pyarrow"
+    )
+    parser.add_argument("--alpha", type=float, default=0.05, help="Significance level (default: 0.05)")
+    parser.add_argument(
+        "--correction",
+        choices=P_VALUE_CORRECTIONS,
+        default="holm",
+        help="Multiple comparison correction of the Dunn and Mann-Whitney pairs (default: holm)",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap resamples of the effect size confidence intervals, none if 0 (default: 0)",
+    )
+    parser.add_argument(
+        "--auc-limit", type=float, default=AUC_LIMIT, help=f"NME limit of the CED AUC (default: {AUC_LIMIT})"
+    )
+    parser.add_argument(
+        "--failure-threshold",
+        type=float,
+        default=FAILURE_THRESHOLD,
+        help=f"NME above which a keypoint is a failure (default: {FAILURE_THRESHOLD})",
+    )
+    parser.add_argument(
+        "-n",
+        "--normalizer",
+        choices=NORMALIZERS,
+        default="iod",
+        help="Normalization of the keypoint errors (default: iod)",
+    )
+    parser.add_argument("--profile", default=None, help="Record the stage timings and write them to this file")
+
+    main(parser.parse_args())
@@ -0,0 +1,48 @@
+import argparse
+import os
+
+from termcolor import colored
+
+from analysis.data.data_loader import DataLoader
+from analysis.data.incremental import IncrementalEvaluator
+from analysis.profiling import PROFILER
+from analysis.stats.discrete_groups.n_group_analysis import NGroupAnalysis
+
+
+def main(args):
+    PROFILER.enable()
+    if os.path.exists(args.store):
+        evaluator = IncrementalEvaluator.load(args.store)
+    else:
+        print(f"Building the evaluation store {args.store}...")
+        evaluator = IncrementalEvaluator.build(DataLoader())
+
+    dirty = evaluator.update(args.estimations)
+    dirty_keypoints = sorted({kp_id for factor, _, kp_id in dirty if factor == args.factor})
+    print(f"{PROFILER.summary()['counters'].get('incremental.changed_samples', 0)} changed samples, "
+          f"{len(dirty_keypoints)} keypoints to re-evaluate for {args.factor}")
+
+    analysis = NGroupAnalysis(evaluator, args.factor)
+    for kp_id in dirty_keypoints:
+        anova = analysis.one_way_anova(kp_id)
+        color = "red" if anova["p"] <= 0.05 else "green"
+        print(colored(f"ANOVA for keypoint {kp_id}| F: {anova['F']} p: {anova['p']}", color))
+
+    evaluator.mark_clean()
+    evaluator.save(args.store)
+    print(f"Update took {PROFILER.summary()['stages']['incremental.update']['total']:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental re-evaluation of a modified estimation file")
+    parser.add_argument("-e", "--estimations", required=True, help="New version of the estimation file")
+    parser.add_argument(
+        "-s",
+        "--store",
+        default="evaluation_store.npz",
+        help="Persisted per-sample evaluation, built from the DATA config files if missing",
+    )
+    parser.add_argument(
+        "-f", "--factor", choices=["age", "sex", "skintone"], default="age", help="Factor to re-evaluate"
+    )
+    main(parser.parse_args())
@@ -0,0 +1,53 @@
+import argparse
+import tempfile
+from pathlib import Path
+
+from analysis.configs import DATA
+from analysis.profiling import enable_from_config, export_from_config
+from analysis.stats.sharded import evaluate_shards, split_dataset, summary_frame
+
+
+def parse_shard(value: str):
+    annotations_file, _, estimations_file = value.partition(",")
+    if not estimations_file:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {value}, expected ANNOTATIONS,ESTIMATIONS")
+    return annotations_file, estimations_file
+
+
+def main(args):
+    enable_from_config(args.profile)
+    with tempfile.TemporaryDirectory(prefix="fairset_shards_") as shards_dir:
+        shards = args.shards
+        if not shards:
+            shards = split_dataset(DATA["annotations_file"], DATA["estimations_file"], args.split, Path(shards_dir))
+        biases, summary = evaluate_shards(shards, args.jobs or None, args.sketch_size)
+
+    print(f"Evaluated {len(shards)} shards, per keypoint biases (dx, dy):")
+    for kp_id, (dx, dy) in biases.items():
+        print(f"Keypoint {kp_id}| {dx:.5f}, {dy:.5f}")
+    frame = summary_frame(summary)
+    frame.to_csv(args.output, index=False)
+    print(f"NME summaries of {len(frame)} (factor, keypoint, group) cells written to {args.output}")
+    export_from_config()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate a dataset split in shards with mergeable accumulators, without gathering the errors"
+    )
+    parser.add_argument(
+        "-s",
+        "--shards",
+        nargs="+",
+        type=parse_shard,
+        default=[],
+        help="Shards as ANNOTATIONS,ESTIMATIONS file pairs (default: split the DATA files)",
+    )
+    parser.add_argument(
+        "--split", type=int, default=4, help="Number of shards the DATA files are split in without --shards"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Number of worker processes, 0 for one per CPU")
+    parser.add_argument("-k", "--sketch-size", type=int, default=1024, help="Quantile sketch size (default: 1024)")
+    parser.add_argument("-o", "--output", default="sharded_summary.csv", help="Output CSV of the NME summaries")
+    parser.add_argument("--profile", default=None, help="Record the stage timings and write them to this file")
+    main(parser.parse_args())
@@ -0,0 +1,145 @@
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from analysis.data.locations import KEYPOINTS
+from analysis.profiling import profiled
+from analysis.stats.summaries import ALL_KEYPOINTS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# NME thresholds of the CED curves, the AUC and the failure rate
+CED_THRESHOLDS = np.linspace(0, 0.1, 101)
+AUC_LIMIT = 0.1
+FAILURE_THRESHOLD = 0.1
+
+
+class CumulativeErrors:
+    """
+    Sorted values of many segments (a single sort of integer keys: segment, then dense value rank), from which the
+    cumulative distribution of every segment is evaluated at any thresholds with binary searches
+    """
+
+    def __init__(self, values: np.ndarray, segments: np.ndarray, n_segments: int):
+        self._unique = np.unique(values)
+        self._stride = len(self._unique) + 1
+        keys = np.sort(segments.astype(np.int64) * self._stride + np.searchsorted(self._unique, values))
+        self._keys = keys
+        self.n = np.bincount(segments, minlength=n_segments)
+        self._starts = np.concatenate(([0], np.cumsum(self.n)[:-1]))
+        self._prefix = np.concatenate(([0], np.cumsum(self._unique[keys % self._stride])))
+
+    def counts(self, thresholds: np.ndarray) -> np.ndarray:
+        """
+        :return: (n_segments, n_thresholds) number of values <= each threshold
+        """
+        ranks = np.searchsorted(self._unique, np.asarray(thresholds, dtype=np.float64), side="right")
+        segments = np.arange(len(self.n), dtype=np.int64)
+        needles = segments[:, None] * self._stride + ranks[None, :]
+        return np.searchsorted(self._keys, needles, side="left") - self._starts[:, None]
+
+    def ced(self, thresholds: np.ndarray) -> np.ndarray:
+        """
+        :return: (n_segments, n_thresholds) fraction of the values <= each threshold, NaN for empty segments
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.counts(thresholds) / self.n[:, None]
+
+    def auc(self, limit: float) -> np.ndarray:
+        """
+        Exact area under the CED curve over [0, limit], normalized by the limit: mean of max(0, 1 - value / limit)
+        """
+        below = self.counts(np.array([limit]))[:, 0]
+        below_sums = self._prefix[self._starts + below] - self._prefix[self._starts]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (below * limit - below_sums) / (self.n * limit)
+
+    def failure_rate(self, threshold: float) -> np.ndarray:
+        """
+        :return: fraction of the values > threshold
+        """
+        return 1 - self.ced(np.array([threshold]))[:, 0]
+
+
+class CEDCurves:
+    """
+    Cumulative error distributions per (model, factor, group, keypoint and ALL_KEYPOINTS), with their AUC and failure
+    rates. The NMEs of all the models and factors are sorted once, any threshold grid is then evaluated in one batch.
+    """
+
+    @profiled("ced.compute")
+    def __init__(self, data_loaders: Dict[str, DataLoader], factors: Optional[List[str]] = None):
+        """
+        :param factors: factors to split the errors by (default: all but location), "location" gives the curve of
+                        every keypoint over all the samples
+        """
+        import pandas as pd
+
+        factors = factors or [factor for factor in FACTORS.keys() if factor != "location"]
+        kp_labels = np.array(sorted(KEYPOINTS.keys()))
+        n_slots = len(kp_labels) + 1  # Last slot of every group is ALL_KEYPOINTS
+        values, segments, cells = [], [], []
+        offset = 0
+        for model, data_loader in data_loaders.items():
+            samples = data_loader.get_samples()
+            kp_slots = np.searchsorted(kp_labels, samples["kp_id"])
+            for factor in factors:
+                if factor == "location":
+                    groups = [None]
+                    codes = np.zeros(len(kp_slots), dtype=np.int64)
+                else:
+                    groups = FACTORS[factor]
+                    codes = samples[factor].astype(np.int64)
+                valid = codes >= 0
+                nmes = samples["nme"][valid]
+                factor_segments = offset + codes[valid] * n_slots
+                values.extend((nmes, nmes))
+                segments.extend((factor_segments + kp_slots[valid], factor_segments + len(kp_labels)))
+                cells.append(pd.DataFrame({
+                    "model": model,
+                    "factor": factor,
+                    "group": np.repeat(np.array(groups, dtype=object), n_slots),
+                    "kp_id": np.tile(np.append(kp_labels, ALL_KEYPOINTS), len(groups)),
+                }))
+                offset += len(groups) * n_slots
+
+        self._errors = CumulativeErrors(np.concatenate(values), np.concatenate(segments), offset)
+        self._cells = pd.concat(cells, ignore_index=True)
+        self._cells["n"] = self._errors.n
+        self._kept = np.flatnonzero(self._errors.n > 0)
+
+    def cells(self) -> "pd.DataFrame":
+        """
+        :return: model, factor, group (None for location), kp_id and n of every non empty cell, in the row order of
+                 curves()
+        """
+        return self._cells.iloc[self._kept].reset_index(drop=True)
+
+    def curves(self, thresholds: np.ndarray = CED_THRESHOLDS) -> np.ndarray:
+        """
+        :return: (n_cells, n_thresholds) fraction of the NMEs <= each threshold, rows aligned with cells()
+        """
+        return self._errors.ced(thresholds)[self._kept]
+
+    def metrics(self, auc_limit: float = AUC_LIMIT, failure_threshold: float = FAILURE_THRESHOLD) -> "pd.DataFrame":
+        """
+        :return: cells() with the auc (normalized area under the CED up to auc_limit) and the failure_rate (fraction
+                 of NMEs above failure_threshold) of every cell
+        """
+        frame = self.cells()
+        frame["auc"] = self._errors.auc(auc_limit)[self._kept]
+        frame["failure_rate"] = self._errors.failure_rate(failure_threshold)[self._kept]
+        return frame
+
+    def select(self, factor: str, kp_id: int = ALL_KEYPOINTS,
+               thresholds: np.ndarray = CED_THRESHOLDS) -> Dict[Tuple[str, Any], np.ndarray]:
+        """
+        :return: (model, group) -> CED curve of the factor on the keypoint, in FACTORS order
+        """
+        frame = self.cells()
+        rows = np.flatnonzero((frame["factor"] == factor).to_numpy() & (frame["kp_id"] == kp_id).to_numpy())
+        curves = self._errors.ced(thresholds)[self._kept[rows]]
+        return {(frame["model"].iloc[row], frame["group"].iloc[row]): curve for row, curve in zip(rows, curves)}
@@ -0,0 +1,158 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis.data.covariates import compute_covariates
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from analysis.profiling import profiled
+from analysis.stats.summaries import ALL_KEYPOINTS, summarize_segments
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def quantile_bins(values: np.ndarray, n_bins: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the quantile bin of every value in [0, n_bins), -1 for NaN values, and the (n_bins + 1) bin edges
+    """
+    valid = ~np.isnan(values)
+    edges = np.quantile(values[valid], np.linspace(0, 1, n_bins + 1))
+    bins = np.full(len(values), -1, dtype=np.int64)
+    bins[valid] = np.clip(np.searchsorted(edges, values[valid], side="right") - 1, 0, n_bins - 1)
+    return bins, edges
+
+
+class ContinuousFactorAnalysis:
+    """
+    Analysis of the NME against continuous covariates (face size, resolution, see analysis.data.covariates), alone
+    or jointly with the demographic factors, for every keypoint at once
+    """
+
+    def __init__(self, data_loader: DataLoader, covariates: Optional[Dict[str, np.ndarray]] = None):
+        """
+        :param covariates: per-sample covariates aligned with the loader samples, computed from DATA["bbox_file"]
+                           if None
+        """
+        self.data_loader = data_loader
+        self._covariates = covariates if covariates is not None else compute_covariates(data_loader)
+
+    def _covariate(self, covariate: str) -> np.ndarray:
+        if covariate not in self._covariates:
+            raise ValueError(f"Invalid covariate: {covariate}, expected one of {list(self._covariates.keys())}")
+        return self._covariates[covariate]
+
+    @profiled("stats.binned_summaries")
+    def binned_summaries(self, covariate: str, n_bins: int = 4) -> "pd.DataFrame":
+        """
+        NME distribution of every keypoint (and ALL_KEYPOINTS) within the quantile bins of the covariate
+        :return: kp_id, bin, low, high (bin edges), n, mean, q1, med, q3
+        """
+        import pandas as pd
+
+        samples = self.data_loader.get_samples()
+        bins, edges = quantile_bins(self._covariate(covariate), n_bins)
+        valid = bins >= 0
+        kp_labels, kp_slots = np.unique(samples["kp_id"][valid], return_inverse=True)
+        n_slots = len(kp_labels) + 1  # Last slot is ALL_KEYPOINTS
+        nmes = samples["nme"][valid]
+        segments = np.concatenate((bins[valid] * n_slots + kp_slots, bins[valid] * n_slots + len(kp_labels)))
+        summaries = summarize_segments(np.concatenate((nmes, nmes)), segments, n_bins * n_slots)
+
+        frame = pd.DataFrame({key: summaries[key] for key in ["n", "mean", "q1", "med", "q3"]})
+        frame.insert(0, "high", np.repeat(edges[1:], n_slots))
+        frame.insert(0, "low", np.repeat(edges[:-1], n_slots))
+        frame.insert(0, "bin", np.repeat(np.arange(n_bins), n_slots))
+        frame.insert(0, "kp_id", np.tile(np.append(kp_labels, ALL_KEYPOINTS), n_bins))
+        return frame[frame["n"] > 0].sort_values(["kp_id", "bin"], ignore_index=True)
+
+    def _design(self, covariates: List[str], factors: List[str]):
+        """
+        Design matrix: intercept, standardized covariates and one dummy per non reference group of each factor
+        :return: the matrix of the complete samples, their mask and the term names
+        """
+        samples = self.data_loader.get_samples()
+        columns = [np.ones(len(samples["nme"]))]
+        terms = ["intercept"]
+        complete = np.ones(len(samples["nme"]), dtype=bool)
+        for covariate in covariates:
+            values = self._covariate(covariate)
+            complete &= ~np.isnan(values)
+            columns.append(values)
+            terms.append(covariate)
+        for factor in factors:
+            codes = samples[factor]
+            complete &= codes >= 0
+            # The first group of FACTORS is the reference
+            for code, group in enumerate(FACTORS[factor][1:], start=1):
+                columns.append((codes == code).astype(np.float64))
+                terms.append(f"{factor}[{getattr(group, 'name', group)}]")
+        design = np.stack(columns, axis=1)[complete]
+        if covariates:
+            scaled = design[:, 1:len(covariates) + 1]
+            design[:, 1:len(covariates) + 1] = (scaled - scaled.mean(axis=0)) / scaled.std(axis=0)
+        return design, complete, terms
+
+    @profiled("stats.covariate_regression")
+    def regression(self, covariates: Optional[List[str]] = None,
+                   factors: Optional[List[str]] = None) -> "pd.DataFrame":
+        """
+        OLS of the NME on the standardized covariates and the demographic factors (dummy coded), for every keypoint.
+        The per-keypoint normal equations are accumulated from the keypoint segments and solved in one batched solve.
+        The partial correlation of each term with the NME, controlling for all other terms, follows from its t value:
+        r = t / sqrt(t^2 + df).
+        :param covariates: covariates of the model (default: iod, relative_face_size, resolution)
+        :param factors: demographic factors of the model (default: age, sex, skintone)
+        :return: kp_id, term, coef (NME per standard deviation for covariates, difference with the reference group
+                 for factors), se, t, p, partial_r, and the n, df and r2 of the keypoint model
+        """
+        import pandas as pd
+        from scipy.stats import t as student
+
+        covariates = ["iod", "relative_face_size", "resolution"] if covariates is None else covariates
+        factors = ["age", "sex", "skintone"] if factors is None else factors
+        design, complete, terms = self._design(covariates, factors)
+        samples = self.data_loader.get_samples()
+        nmes = samples["nme"][complete]
+        kp_ids = samples["kp_id"][complete]
+
+        order = np.argsort(kp_ids, kind="stable")
+        design, nmes, kp_ids = design[order], nmes[order], kp_ids[order]
+        kp_labels, starts, counts = np.unique(kp_ids, return_index=True, return_counts=True)
+        n_terms = design.shape[1]
+        gram = np.empty((len(kp_labels), n_terms, n_terms))
+        moments = np.empty((len(kp_labels), n_terms))
+        for slot, (start, count) in enumerate(zip(starts, counts)):
+            segment = design[start:start + count]
+            gram[slot] = segment.T @ segment
+            moments[slot] = segment.T @ nmes[start:start + count]
+
+        # Groups absent from a keypoint make its system singular, the pseudo-inverse gives them a null coefficient
+        inverse = np.linalg.pinv(gram, hermitian=True)
+        coefficients = np.einsum("kij,kj->ki", inverse, moments)
+        slots = np.repeat(np.arange(len(kp_labels)), counts)
+        residuals = nmes - np.einsum("ni,ni->n", design, coefficients[slots])
+        rss = np.bincount(slots, weights=residuals ** 2, minlength=len(kp_labels))
+        ranks = np.linalg.matrix_rank(gram, hermitian=True)
+        df = counts - ranks
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sigma2 = rss / df
+            se = np.sqrt(sigma2[:, None] * np.diagonal(inverse, axis1=1, axis2=2))
+            t_values = coefficients / se
+            p_values = 2 * student.sf(np.abs(t_values), df[:, None])
+            partial_r = t_values / np.sqrt(t_values ** 2 + df[:, None])
+            tss = np.bincount(slots, weights=(nmes - (np.bincount(slots, weights=nmes) / counts)[slots]) ** 2)
+            r2 = 1 - rss / tss
+
+        return pd.DataFrame({
+            "kp_id": np.repeat(kp_labels, n_terms),
+            "term": np.tile(terms, len(kp_labels)),
+            "coef": coefficients.ravel(),
+            "se": se.ravel(),
+            "t": t_values.ravel(),
+            "p": p_values.ravel(),
+            "partial_r": partial_r.ravel(),
+            "n": np.repeat(counts, n_terms),
+            "df": np.repeat(df, n_terms),
+            "r2": np.repeat(r2, n_terms),
+        })
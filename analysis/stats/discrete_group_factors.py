@@ -1,10 +1,15 @@
-import numpy as np
-import pandas as pd
-from scipy.stats import kurtosis, levene, shapiro, skew
-from statsmodels.stats.multicomp import pairwise_tukeyhsd
+from typing import TYPE_CHECKING, List, Optional
 
 from analysis.data.data_loader import DataLoader
 from analysis.data.datatypes import FACTORS
+from analysis.profiling import profiled
+from analysis.stats.effect_sizes import effect_sizes
+from analysis.stats.mixed_effects import MixedModelFit, mixed_effects
+from analysis.stats.resampling import balanced_means
+from analysis.stats.tukey import tukey_hsd
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 class DiscreteGroupFactors:
@@ -14,14 +19,20 @@ class DiscreteGroupFactors:
         self.data_loader = data_loader
         self._factor = factor
 
+    @profiled("stats.skew_and_kurtosis")
     def skew_and_kurtosis(self, kp_id):
+        from scipy.stats import kurtosis, skew
+
         results = {}
         for group in FACTORS[self._factor]:
             group_nmes = self.data_loader.get_errors_by_group(self._factor, group, kp_id)
             results[group] = {"skew": skew(group_nmes), "kurtosis": kurtosis(group_nmes)}
         return results
 
+    @profiled("stats.shapiro_wilk")
     def shapiro_wilk(self, kp_id):
+        from scipy.stats import shapiro
+
         results = {}
         for group in FACTORS[self._factor]:
             group_nmes = self.data_loader.get_errors_by_group(self._factor, group, kp_id)
@@ -29,6 +40,7 @@ class DiscreteGroupFactors:
             results[group] = {"stat": stat, "p_value": p_value}
         return results
 
+    @profiled("stats.n_samples")
     def n_samples(self, kp_id):
         results = {}
         for group in FACTORS[self._factor]:
@@ -36,16 +48,48 @@ class DiscreteGroupFactors:
             results[group] = len(group_nmes)
         return results
 
+    @profiled("stats.levene_test")
     def levene_test(self, kp_id):
+        from scipy.stats import levene
+
         stat, p_value = levene(*[self.data_loader.get_errors_by_group(self._factor, group, kp_id)
                                for group in FACTORS[self._factor]])
         return {"stat": stat, "p_value": p_value}
 
-    def tukey_post_hoc(self, kp_id):
-        values, groups = [], []
-        for group in FACTORS[self._factor]:
-            group_values = self.data_loader.get_errors_by_group(self._factor, group, kp_id)
-            values.extend(group_values)
-            groups.extend([group.name] * len(group_values))
-        tukey = pairwise_tukeyhsd(endog=np.array(values), groups=np.array(groups), alpha=0.05)
-        return tukey.summary()
+    @profiled("stats.tukey_post_hoc")
+    def tukey_post_hoc(self, kp_id: Optional[int] = None, alpha: float = 0.05) -> "pd.DataFrame":
+        """
+        Tukey HSD of every pair of groups, batched over all keypoints (see analysis.stats.tukey.tukey_hsd)
+        :param kp_id: only this keypoint if given, all keypoints otherwise
+        """
+        return tukey_hsd(self.data_loader.get_samples(), self._factor, alpha, kp_id)
+
+    @profiled("stats.effect_sizes")
+    def effect_sizes(self, kp_id: Optional[int] = None, n_bootstrap: int = 0) -> "pd.DataFrame":
+        """
+        Cliff's delta, Cohen's d and Hedges' g of every pair of groups, batched over all keypoints
+        (see analysis.stats.effect_sizes.effect_sizes)
+        :param kp_id: only this keypoint if given, all keypoints otherwise
+        :param n_bootstrap: number of bootstrap resamples of the 95% confidence intervals, none if 0
+        """
+        return effect_sizes(self.data_loader.get_samples(), self._factor, kp_id, n_bootstrap)
+
+    @profiled("stats.balanced_means")
+    def balanced_means(self, adjust_for: Optional[List[str]] = None, n_draws: int = 200) -> "pd.DataFrame":
+        """
+        Mean NME of every group over repeated balanced subsamples, batched over all keypoints
+        (see analysis.stats.resampling.balanced_means)
+        :param adjust_for: factors also balanced within every group, e.g. ["age"] to compare the groups at the same age
+                           distribution
+        """
+        return balanced_means(self.data_loader.get_samples(), self._factor, adjust_for, n_draws)
+
+    @profiled("stats.mixed_effects_factor")
+    def mixed_effects(self, adjust_for: Optional[List[str]] = None) -> MixedModelFit:
+        """
+        Mixed-effects model of the NME over all keypoints, with random intercepts per image and person, so the
+        correlated keypoint errors of a person are not counted as independent samples
+        (see analysis.stats.mixed_effects.MixedEffectsModel). factor_tests() gives the Wald test of the factor.
+        :param adjust_for: other factors added to the fixed effects
+        """
+        return mixed_effects(self.data_loader.get_samples(), [self._factor, *(adjust_for or [])])
@@ -1,9 +1,6 @@
-import pandas as pd
-from statsmodels.formula.api import ols
-from statsmodels.stats.anova import anova_lm
-
 from analysis.data.data_loader import DataLoader
 from analysis.data.datatypes import FACTORS, DiscreteFactorEnum
+from analysis.profiling import profiled
 from analysis.stats.discrete_group_factors import DiscreteGroupFactors
 
 
@@ -11,7 +8,12 @@ class NGroupAnalysis(DiscreteGroupFactors):
     def __init__(self, data_loader: DataLoader, factor: str):
         super().__init__(data_loader, factor)
 
+    @profiled("stats.one_way_anova")
     def one_way_anova(self, kp_id: int):
+        import pandas as pd
+        from statsmodels.formula.api import ols
+        from statsmodels.stats.anova import anova_lm
+
         records = []
         for group in FACTORS[self._factor]:
             errors = self.data_loader.get_errors_by_group(self._factor, group, kp_id)
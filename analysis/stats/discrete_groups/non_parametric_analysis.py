@@ -0,0 +1,160 @@
+from itertools import combinations
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import numpy as np
+
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from analysis.profiling import profiled
+from analysis.stats.discrete_group_factors import DiscreteGroupFactors
+from analysis.stats.ranks import SharedRanks, adjust_p_values
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class NonParametricAnalysis(DiscreteGroupFactors):
+    """
+    Kruskal-Wallis, Dunn post-hoc and pairwise Mann-Whitney U tests of every keypoint at once, all computed from one
+    shared ranking of the errors (see SharedRanks). Every test returns a DataFrame with one row per keypoint (and per
+    pair of groups for the post-hoc tests), restricted to `kp_id` when given.
+    """
+
+    def __init__(self, data_loader: DataLoader, factor: str, ranks: Optional[SharedRanks] = None,
+                 correction: str = "holm", alpha: float = 0.05):
+        """
+        :param ranks: ranking shared between the analyses of several factors, computed from the loader if None
+        :param correction: multiple comparison correction of the post-hoc tests, see adjust_p_values
+        """
+        super().__init__(data_loader, factor)
+        self._ranks = ranks or SharedRanks(data_loader.get_samples())
+        self._correction = correction
+        self._alpha = alpha
+        self._groups = FACTORS[factor]
+        self._codes = self._ranks.sorted_column(data_loader.get_samples()[factor])
+        self._pooled: Optional[Dict[str, np.ndarray]] = None
+
+    def _rank_sums(self, mask: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Rank sums and counts of each (keypoint, group) within the samples of `mask`
+        """
+        ranks, total, ties = self._ranks.ranks(mask)
+        segments = self._ranks.slots[mask] * len(self._groups) + self._codes[mask]
+        shape = (self._ranks.n_keypoints, len(self._groups))
+        size = shape[0] * shape[1]
+        return {
+            "sums": np.bincount(segments, weights=ranks[mask], minlength=size).reshape(shape),
+            "n": np.bincount(segments, minlength=size).reshape(shape),
+            "total": total,
+            "ties": ties,
+        }
+
+    def _pooled_rank_sums(self) -> Dict[str, np.ndarray]:
+        if self._pooled is None:
+            self._pooled = self._rank_sums(self._codes >= 0)
+        return self._pooled
+
+    def _pairs(self) -> List[tuple]:
+        return list(combinations(range(len(self._groups)), 2))
+
+    def _frame(self, columns: Dict[str, np.ndarray], kp_id: Optional[int]) -> "pd.DataFrame":
+        import pandas as pd
+
+        frame = pd.DataFrame(columns)
+        if kp_id is not None:
+            frame = frame[frame["kp_id"] == kp_id].reset_index(drop=True)
+        return frame
+
+    def _pair_columns(self, statistics: Dict[str, np.ndarray], p_values: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Flattened (keypoint, pair) columns of the post-hoc statistics with corrected p-values
+        """
+        pairs = self._pairs()
+        adjusted = adjust_p_values(p_values, self._correction)
+        return {
+            "kp_id": np.repeat(self._ranks.kp_labels, len(pairs)),
+            "group1": np.tile(np.array([self._groups[i] for i, _ in pairs], dtype=object), self._ranks.n_keypoints),
+            "group2": np.tile(np.array([self._groups[j] for _, j in pairs], dtype=object), self._ranks.n_keypoints),
+            **{name: values.ravel() for name, values in statistics.items()},
+            "p": p_values.ravel(),
+            "p_adj": adjusted.ravel(),
+            "reject": adjusted.ravel() <= self._alpha,
+        }
+
+    @profiled("stats.kruskal_wallis")
+    def kruskal_wallis(self, kp_id: Optional[int] = None) -> "pd.DataFrame":
+        """
+        Kruskal-Wallis H test with tie correction, same as scipy.stats.kruskal
+        """
+        from scipy.stats import chi2
+
+        pooled = self._pooled_rank_sums()
+        n, total = pooled["n"], pooled["total"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            h = (12 / (total * (total + 1)) * np.where(n > 0, pooled["sums"] ** 2 / n, 0).sum(axis=1)
+                 - 3 * (total + 1))
+            h /= 1 - pooled["ties"] / (total ** 3 - total)
+        df = (n > 0).sum(axis=1) - 1
+        p_values = np.where(df > 0, chi2.sf(h, np.maximum(df, 1)), np.nan)
+        return self._frame({"kp_id": self._ranks.kp_labels, "n": total.astype(int), "df": df, "H": h,
+                            "p": p_values}, kp_id)
+
+    @profiled("stats.dunn_post_hoc")
+    def dunn_post_hoc(self, kp_id: Optional[int] = None) -> "pd.DataFrame":
+        """
+        Dunn's test of every pair of groups on the pooled ranks, with tie correction and the multiple comparison
+        correction applied within each keypoint
+        """
+        from scipy.stats import norm
+
+        pooled = self._pooled_rank_sums()
+        n, total = pooled["n"], pooled["total"][:, None]
+        first, second = (np.array(indices) for indices in zip(*self._pairs()))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_ranks = pooled["sums"] / n
+            variance = total * (total + 1) / 12 - pooled["ties"][:, None] / (12 * (total - 1))
+            z = (mean_ranks[:, first] - mean_ranks[:, second]) / np.sqrt(
+                variance * (1 / n[:, first] + 1 / n[:, second]))
+        p_values = 2 * norm.sf(np.abs(z))
+        return self._frame(self._pair_columns({"z": z}, p_values), kp_id)
+
+    @profiled("stats.mann_whitney")
+    def mann_whitney(self, kp_id: Optional[int] = None) -> "pd.DataFrame":
+        """
+        Two-sided Mann-Whitney U test of every pair of groups (normal approximation with tie and continuity
+        corrections, as scipy.stats.mannwhitneyu(method="asymptotic")), U is the statistic of group1. The pairs are
+        ranked from the shared sort, restricted to their two groups.
+        """
+        from scipy.stats import norm
+
+        pairs = self._pairs()
+        u = np.full((self._ranks.n_keypoints, len(pairs)), np.nan)
+        z = np.full_like(u, np.nan)
+        for column, (i, j) in enumerate(pairs):
+            pair = self._rank_sums((self._codes == i) | (self._codes == j))
+            n1, n2, total = pair["n"][:, i], pair["n"][:, j], pair["total"]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                u[:, column] = pair["sums"][:, i] - n1 * (n1 + 1) / 2
+                sigma = np.sqrt(n1 * n2 / 12 * ((total + 1) - pair["ties"] / (total * (total - 1))))
+                z[:, column] = (np.maximum(u[:, column], n1 * n2 - u[:, column]) - n1 * n2 / 2 - 0.5) / sigma
+            u[(n1 == 0) | (n2 == 0), column] = np.nan
+        p_values = np.minimum(2 * norm.sf(z), 1)
+        return self._frame(self._pair_columns({"U": u, "z": z}, p_values), kp_id)
+
+
+def non_parametric_report(data_loader: DataLoader, factors: List[str], correction: str = "holm",
+                          alpha: float = 0.05) -> Dict[str, Dict[str, "pd.DataFrame"]]:
+    """
+    Every non-parametric test of every keypoint for each factor, from a single ranking of the errors
+    :return: factor -> {"kruskal_wallis", "dunn", "mann_whitney"} -> DataFrame
+    """
+    ranks = SharedRanks(data_loader.get_samples())
+    report = {}
+    for factor in factors:
+        analysis = NonParametricAnalysis(data_loader, factor, ranks, correction, alpha)
+        report[factor] = {
+            "kruskal_wallis": analysis.kruskal_wallis(),
+            "dunn": analysis.dunn_post_hoc(),
+            "mann_whitney": analysis.mann_whitney(),
+        }
+    return report
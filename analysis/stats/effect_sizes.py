@@ -0,0 +1,132 @@
+import warnings
+from itertools import combinations
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis.data.datatypes import FACTORS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+EFFECT_SIZES = ["cliffs_delta", "cohens_d", "hedges_g"]
+
+
+def _hedges_correction(df: np.ndarray) -> np.ndarray:
+    """
+    Exact small sample bias correction J(df) = Γ(df / 2) / (sqrt(df / 2) Γ((df - 1) / 2))
+    """
+    from scipy.special import gammaln
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.exp(gammaln(df / 2) - gammaln((df - 1) / 2)) / np.sqrt(df / 2)
+
+
+def _pair_effect_sizes(keys: np.ndarray, stride: int, values: np.ndarray, kp_slots: np.ndarray, codes: np.ndarray,
+                       n_keypoints: int, n_groups: int, pairs: List[Tuple[int, int]]) -> Dict[str, np.ndarray]:
+    """
+    Effect sizes of every (keypoint, pair of groups) at once
+    :param keys: integer sort keys kp_slot * stride + dense value rank (ties share their key)
+    :return: (n_keypoints, n_pairs) arrays of n1, n2 and every EFFECT_SIZES
+    """
+    size = n_keypoints * n_groups
+    segments = kp_slots * n_groups + codes
+    n = np.bincount(segments, minlength=size).reshape(n_keypoints, n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.bincount(segments, weights=values, minlength=size).reshape(n_keypoints, n_groups) / n
+        squares = np.bincount(segments, weights=(values - means.ravel()[segments]) ** 2, minlength=size)
+        variances = squares.reshape(n_keypoints, n_groups) / (n - 1)
+
+    # Sorted keys of each group, and where each keypoint starts in them
+    keypoint_keys = np.arange(n_keypoints + 1, dtype=np.int64) * stride
+    group_keys = []
+    for code in range(n_groups):
+        sorted_keys = np.sort(keys[codes == code])
+        group_keys.append((sorted_keys, np.searchsorted(sorted_keys, keypoint_keys)))
+
+    results = {name: np.full((n_keypoints, len(pairs)), np.nan) for name in ["n1", "n2", *EFFECT_SIZES]}
+    for column, (i, j) in enumerate(pairs):
+        n1, n2 = n[:, i], n[:, j]
+        # Sorted needles keep the binary searches cache friendly
+        x_keys = group_keys[i][0]
+        x_slots = x_keys // stride
+        y_keys, y_starts = group_keys[j]
+        # Number of y below / above each x, within the keypoint of the x
+        below = np.searchsorted(y_keys, x_keys, side="left") - y_starts[x_slots]
+        above = y_starts[x_slots + 1] - np.searchsorted(y_keys, x_keys, side="right")
+        dominance = np.bincount(x_slots, weights=below - above, minlength=n_keypoints)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pooled = np.sqrt(((n1 - 1) * variances[:, i] + (n2 - 1) * variances[:, j]) / (n1 + n2 - 2))
+            cohens_d = (means[:, i] - means[:, j]) / pooled
+            results["cliffs_delta"][:, column] = dominance / (n1 * n2)
+        results["n1"][:, column] = n1
+        results["n2"][:, column] = n2
+        results["cohens_d"][:, column] = cohens_d
+        results["hedges_g"][:, column] = cohens_d * _hedges_correction(n1 + n2 - 2)
+    return results
+
+
+def effect_sizes(samples: Dict[str, np.ndarray], factor: str, kp_id: Optional[int] = None, n_bootstrap: int = 0,
+                 confidence: float = 0.95, seed: int = 0) -> "pd.DataFrame":
+    """
+    Cliff's delta, Cohen's d and Hedges' g of every pair of groups of the factor, for every keypoint in one batch.
+    Positive values mean larger errors for group1.
+    :param samples: per-sample columns, see DataLoader.get_samples
+    :param kp_id: only this keypoint if given
+    :param n_bootstrap: number of bootstrap resamples (within each keypoint and group) of the percentile confidence
+                        intervals, none if 0
+    :param confidence: confidence level of the intervals
+    :return: one row per (keypoint, pair): kp_id, group1, group2, n1, n2, the EFFECT_SIZES and their <name>_low and
+             <name>_high bounds when bootstrapped
+    """
+    import pandas as pd
+
+    groups = FACTORS[factor]
+    valid = samples[factor] >= 0
+    if kp_id is not None:
+        valid &= samples["kp_id"] == kp_id
+    values = samples["nme"][valid].astype(np.float64)
+    codes = samples[factor][valid].astype(np.int64)
+    kp_labels, kp_slots = np.unique(samples["kp_id"][valid], return_inverse=True)
+    pairs = list(combinations(range(len(groups)), 2))
+
+    # Exact integer keys ordered by (keypoint, value): dense value ranks offset by keypoint
+    value_ranks, dense = np.unique(values, return_inverse=True)
+    keys = kp_slots.astype(np.int64) * len(value_ranks) + dense
+
+    results = _pair_effect_sizes(keys, len(value_ranks), values, kp_slots, codes, len(kp_labels), len(groups), pairs)
+
+    if n_bootstrap > 0:
+        rng = np.random.default_rng(seed)
+        segments = kp_slots * len(groups) + codes
+        order = np.argsort(segments, kind="stable")
+        counts = np.bincount(segments, minlength=len(kp_labels) * len(groups))
+        starts = (np.cumsum(counts) - counts)[segments[order]]
+        sizes = counts[segments[order]]
+        replicates = {name: [] for name in EFFECT_SIZES}
+        for _ in range(n_bootstrap):
+            resampled = order[starts + (rng.random(len(order)) * sizes).astype(np.int64)]
+            replicate = _pair_effect_sizes(keys[resampled], len(value_ranks), values[resampled], kp_slots[order],
+                                           codes[order], len(kp_labels), len(groups), pairs)
+            for name in EFFECT_SIZES:
+                replicates[name].append(replicate[name])
+        tail = (1 - confidence) / 2 * 100
+        with warnings.catch_warnings():
+            # Pairs with a single sample in a group have no Cohen's d in any replicate
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for name in EFFECT_SIZES:
+                low, high = np.nanpercentile(np.stack(replicates[name]), [tail, 100 - tail], axis=0)
+                results[f"{name}_low"], results[f"{name}_high"] = low, high
+
+    first, second = (np.array(indices) for indices in zip(*pairs))
+    testable = (results["n1"] > 0) & (results["n2"] > 0)
+    rows, columns = np.nonzero(testable)
+    frame = pd.DataFrame({
+        "kp_id": kp_labels[rows],
+        "group1": np.array([groups[i] for i in first[columns]], dtype=object),
+        "group2": np.array([groups[j] for j in second[columns]], dtype=object),
+    })
+    for name, result in results.items():
+        frame[name] = result[rows, columns].astype(int) if name in ["n1", "n2"] else result[rows, columns]
+    return frame
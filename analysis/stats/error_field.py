@@ -0,0 +1,195 @@
+from itertools import combinations
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis.configs import FILTERS
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from analysis.data.locations import KEYPOINTS
+from analysis.profiling import profiled
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Number of dimensions of the error vectors
+N_DIMENSIONS = 2
+
+
+def ellipse_axes(covariances: np.ndarray, scale: float = 1.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Closed form eigen decomposition of a batch of 2x2 covariance matrices
+    :param covariances: (..., 2, 2) covariance matrices
+    :param scale: multiplier of the standard deviations (e.g. sqrt of a chi2(2) quantile for a confidence region)
+    :return: the semi-major and semi-minor axes, and the angle of the major axis (radians, from the x axis)
+    """
+    a, b, c = covariances[..., 0, 0], covariances[..., 1, 1], covariances[..., 0, 1]
+    spread = np.sqrt(((a - b) / 2) ** 2 + c ** 2)
+    major = np.sqrt(np.maximum((a + b) / 2 + spread, 0)) * scale
+    minor = np.sqrt(np.maximum((a + b) / 2 - spread, 0)) * scale
+    return major, minor, 0.5 * np.arctan2(2 * c, a - b)
+
+
+class ErrorField:
+    """
+    Signed 2D error vectors (dx, dy, normalized by the IOD) per (model, factor, group, keypoint): mean vectors,
+    covariance matrices, their ellipses, and Hotelling's T² tests of the mean vector between every pair of groups.
+    The moments of all the cells are accumulated in one pass over the samples, the tests of all the keypoints and
+    pairs are batched.
+    """
+
+    @profiled("error_field.compute")
+    def __init__(self, data_loaders: Dict[str, DataLoader], factors: Optional[List[str]] = None,
+                 remove_bias: Optional[bool] = None):
+        """
+        :param factors: factors to split the errors by (default: all but location)
+        :param remove_bias: subtract the per-keypoint median biases from the vectors, as for the NMEs
+                            (default: FILTERS["remove_statistical_bias"])
+        """
+        self._models = list(data_loaders.keys())
+        self._factors = factors or [factor for factor in FACTORS.keys() if factor != "location"]
+        if remove_bias is None:
+            remove_bias = FILTERS.get("remove_statistical_bias", True)
+        self._kp_labels = np.array(sorted(KEYPOINTS.keys()))
+        n_keypoints = len(self._kp_labels)
+        self._n_groups = max(len(FACTORS[factor]) for factor in self._factors)
+        # Cells: (model, factor, keypoint, group), padded to the largest factor
+        shape = (len(self._models), len(self._factors), n_keypoints, self._n_groups)
+        self._shape = shape
+        n_cells = int(np.prod(shape))
+
+        cells, vectors = [], []
+        for model_index, data_loader in enumerate(data_loaders.values()):
+            samples = data_loader.get_samples()
+            kp_slots = np.searchsorted(self._kp_labels, samples["kp_id"])
+            sample_vectors = np.stack((samples["dx"], samples["dy"]), axis=1)
+            if remove_bias:
+                biases = data_loader.get_statistical_biases()
+                bias_table = np.array([biases.get(kp_id, (0.0, 0.0)) for kp_id in self._kp_labels])
+                sample_vectors = sample_vectors - bias_table[kp_slots]
+            for factor_index, factor in enumerate(self._factors):
+                valid = samples[factor] >= 0
+                codes = samples[factor][valid].astype(np.int64)
+                cells.append(np.ravel_multi_index((model_index, factor_index, kp_slots[valid], codes), shape))
+                vectors.append(sample_vectors[valid])
+        cells, vectors = np.concatenate(cells), np.concatenate(vectors)
+
+        self.n = np.bincount(cells, minlength=n_cells).reshape(shape)
+        sums = np.stack([np.bincount(cells, weights=vectors[:, i], minlength=n_cells) for i in range(2)], axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.means = sums.reshape(*shape, 2) / self.n[..., None]
+        centered = vectors - self.means.reshape(-1, 2)[cells]
+        products = np.einsum("ni,nj->nij", centered, centered).reshape(-1, 4)
+        scatter = np.stack([np.bincount(cells, weights=products[:, i], minlength=n_cells) for i in range(4)], axis=-1)
+        self._scatter = scatter.reshape(*shape, 2, 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.covariances = self._scatter / (self.n - 1)[..., None, None]
+
+    def _cells_frame(self, values: Dict[str, np.ndarray]) -> "pd.DataFrame":
+        """
+        :param values: (models, factors, keypoints, groups) arrays
+        :return: one row per non empty cell: model, factor, group, kp_id and the values
+        """
+        import pandas as pd
+
+        model, factor, kp_slot, code = np.nonzero(self.n > 0)
+        frame = pd.DataFrame({
+            "model": np.array(self._models, dtype=object)[model],
+            "factor": np.array(self._factors, dtype=object)[factor],
+            "group": [FACTORS[self._factors[f]][c] for f, c in zip(factor, code)],
+            "kp_id": self._kp_labels[kp_slot],
+            "n": self.n[model, factor, kp_slot, code],
+        })
+        for name, array in values.items():
+            frame[name] = array[model, factor, kp_slot, code]
+        return frame
+
+    def vectors(self) -> "pd.DataFrame":
+        """
+        :return: model, factor, group, kp_id, n, the mean error vector (mean_dx, mean_dy) and its covariance (var_dx,
+                 var_dy, cov_dxdy), in IOD units
+        """
+        return self._cells_frame({
+            "mean_dx": self.means[..., 0],
+            "mean_dy": self.means[..., 1],
+            "var_dx": self.covariances[..., 0, 0],
+            "var_dy": self.covariances[..., 1, 1],
+            "cov_dxdy": self.covariances[..., 0, 1],
+        })
+
+    def ellipses(self, confidence: float = 0.95, of_mean: bool = False) -> "pd.DataFrame":
+        """
+        :param confidence: probability mass of the ellipses (chi2 with 2 degrees of freedom)
+        :param of_mean: confidence region of the mean vector (covariance / n) instead of the error distribution
+        :return: vectors() with the semi-major and semi-minor axes and the angle (radians) of every ellipse
+        """
+        from scipy.stats import chi2
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            covariances = self.covariances / self.n[..., None, None] if of_mean else self.covariances
+            major, minor, angle = ellipse_axes(covariances, np.sqrt(chi2.ppf(confidence, N_DIMENSIONS)))
+        frame = self.vectors()
+        model, factor, kp_slot, code = np.nonzero(self.n > 0)
+        frame["major"] = major[model, factor, kp_slot, code]
+        frame["minor"] = minor[model, factor, kp_slot, code]
+        frame["angle"] = angle[model, factor, kp_slot, code]
+        return frame
+
+    def hotelling(self, alpha: float = 0.05) -> "pd.DataFrame":
+        """
+        Two-sample Hotelling's T² of the mean error vectors of every pair of groups, for every model, factor and
+        keypoint at once (pooled covariance, exact F transformation)
+        :return: model, factor, kp_id, group1, group2, n1, n2, diff_dx, diff_dy (group2 - group1), t2, F, p, reject
+        """
+        import pandas as pd
+        from scipy.stats import f
+
+        frames = []
+        for factor_index, factor in enumerate(self._factors):
+            groups = FACTORS[factor]
+            first, second = (np.array(indices) for indices in zip(*combinations(range(len(groups)), 2)))
+            n = self.n[:, factor_index].astype(np.float64)
+            n1, n2 = n[..., first], n[..., second]
+            means, scatter = self.means[:, factor_index], self._scatter[:, factor_index]
+            diff = means[..., second, :] - means[..., first, :]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                pooled = (scatter[..., first, :, :] + scatter[..., second, :, :]) / (n1 + n2 - 2)[..., None, None]
+                determinant = pooled[..., 0, 0] * pooled[..., 1, 1] - pooled[..., 0, 1] ** 2
+                # Closed form inverse of the 2x2 pooled covariances
+                inverse = np.stack((np.stack((pooled[..., 1, 1], -pooled[..., 0, 1]), axis=-1),
+                                    np.stack((-pooled[..., 1, 0], pooled[..., 0, 0]), axis=-1)), axis=-2)
+                inverse /= determinant[..., None, None]
+                t2 = n1 * n2 / (n1 + n2) * np.einsum("...i,...ij,...j->...", diff, inverse, diff)
+                df2 = n1 + n2 - N_DIMENSIONS - 1
+                f_values = df2 / (N_DIMENSIONS * (n1 + n2 - 2)) * t2
+            testable = (n1 > 0) & (n2 > 0) & (df2 > 0) & (determinant > 0)
+            model, kp_slot, pair = np.nonzero(testable)
+            p_values = f.sf(f_values[model, kp_slot, pair], N_DIMENSIONS, df2[model, kp_slot, pair])
+            frames.append(pd.DataFrame({
+                "model": np.array(self._models, dtype=object)[model],
+                "factor": factor,
+                "kp_id": self._kp_labels[kp_slot],
+                "group1": np.array(groups, dtype=object)[first[pair]],
+                "group2": np.array(groups, dtype=object)[second[pair]],
+                "n1": n1[model, kp_slot, pair].astype(int),
+                "n2": n2[model, kp_slot, pair].astype(int),
+                "diff_dx": diff[model, kp_slot, pair, 0],
+                "diff_dy": diff[model, kp_slot, pair, 1],
+                "t2": t2[model, kp_slot, pair],
+                "F": f_values[model, kp_slot, pair],
+                "p": p_values,
+                "reject": p_values <= alpha,
+            }))
+        return pd.concat(frames, ignore_index=True)
+
+
+def reference_face(data_loader: DataLoader, image_name: str) -> Tuple[Dict[int, Tuple[float, float]], float]:
+    """
+    :return: the ground truth keypoints (kp id -> (x, y), in pixels) and the IOD of the first person of an annotated
+             image, on which an error field is drawn
+    """
+    image = next((image for image in data_loader.get_annotations() if image.name == image_name), None)
+    if image is None or not image.persons:
+        raise ValueError(f"Reference image {image_name} is not in the annotations")
+    person = image.persons[0]
+    return {keypoint.id: (keypoint.x, keypoint.y) for keypoint in person.keypoints}, person.iod
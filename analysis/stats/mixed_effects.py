@@ -0,0 +1,223 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis.data.datatypes import FACTOR_ATTRIBUTES, FACTORS
+from analysis.profiling import profiled
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Random intercepts of the model, the persons being nested in the images
+RANDOM_EFFECTS = ["image", "person"]
+# Bounds of the log variance ratios searched by REML, exp(-20) being a null variance for any NME scale
+LOG_RATIO_BOUNDS = (-20.0, 10.0)
+
+
+def _fixed_design(samples: Dict[str, np.ndarray], factors: List[str]) -> Tuple[np.ndarray, np.ndarray, List[str],
+                                                                                 Dict[str, List[int]]]:
+    """
+    Fixed effects: intercept, one dummy per non reference keypoint and per non reference group of every factor (the
+    first keypoint and the first group of FACTORS are the references). Dummies without any complete sample are
+    dropped so the design has full rank.
+    :return: the design of the complete samples, their mask, the term names and the columns of every factor
+    """
+    complete = np.ones(len(samples["nme"]), dtype=bool)
+    for factor in factors:
+        complete &= samples[factor] >= 0
+    kp_ids = samples["kp_id"][complete]
+    columns = [np.ones(complete.sum())]
+    terms = ["intercept"]
+    term_factors = ["intercept"]
+    for kp_id in np.unique(kp_ids)[1:]:
+        columns.append((kp_ids == kp_id).astype(np.float64))
+        terms.append(f"kp_id[{kp_id}]")
+        term_factors.append("kp_id")
+    for factor in factors:
+        codes = samples[factor][complete]
+        for code, group in enumerate(FACTORS[factor][1:], start=1):
+            if (codes == code).any():
+                columns.append((codes == code).astype(np.float64))
+                terms.append(f"{factor}[{getattr(group, 'name', group)}]")
+                term_factors.append(factor)
+    factor_columns = {}
+    for column, factor in enumerate(term_factors):
+        factor_columns.setdefault(factor, []).append(column)
+    return np.stack(columns, axis=1), complete, terms, factor_columns
+
+
+@dataclass
+class MixedModelFit:
+    """
+    REML fit of NME = fixed effects + image intercept + person intercept + residual
+    """
+    terms: List[str]
+    factor_columns: Dict[str, List[int]]
+    coefficients: np.ndarray
+    covariance: np.ndarray
+    variances: Dict[str, float]  # Variance of every random intercept and of the residual
+    n: int
+    n_persons: int
+    n_images: int
+    reml: float  # Restricted log-likelihood
+    converged: bool
+
+    def coefficients_frame(self) -> "pd.DataFrame":
+        """
+        :return: term, coef, se, z, p (Wald z test of every fixed effect)
+        """
+        import pandas as pd
+        from scipy.stats import norm
+
+        se = np.sqrt(np.diagonal(self.covariance))
+        z = self.coefficients / se
+        return pd.DataFrame({"term": self.terms, "coef": self.coefficients, "se": se, "z": z,
+                             "p": 2 * norm.sf(np.abs(z))})
+
+    def factor_tests(self) -> "pd.DataFrame":
+        """
+        Joint Wald chi-squared test of all the groups of every factor (and of the keypoint), the mixed-effects
+        counterpart of the one-way ANOVA
+        :return: factor, df, chi2, p
+        """
+        import pandas as pd
+        from scipy.stats import chi2
+
+        rows = []
+        for factor, columns in self.factor_columns.items():
+            if factor == "intercept":
+                continue
+            coefficients = self.coefficients[columns]
+            statistic = coefficients @ np.linalg.solve(self.covariance[np.ix_(columns, columns)], coefficients)
+            rows.append({"factor": factor, "df": len(columns), "chi2": statistic,
+                         "p": chi2.sf(statistic, len(columns))})
+        return pd.DataFrame(rows, columns=["factor", "df", "chi2", "p"])
+
+    def intraclass_correlations(self) -> Dict[str, float]:
+        """
+        :return: share of the NME variance of every random intercept
+        """
+        total = sum(self.variances.values())
+        return {effect: self.variances[effect] / total for effect in RANDOM_EFFECTS if effect in self.variances}
+
+
+class MixedEffectsModel:
+    """
+    Linear mixed-effects model of the NME with a random intercept per image and per person nested in it, and fixed
+    effects for the keypoint and the demographic factors. All the keypoint errors of a person are correlated through
+    the intercepts, instead of being independent samples as in the ANOVA and t-tests.
+
+    The covariance of the errors of an image is sigma^2 (I + tau_p Z_p Z_p^T + tau_i 1 1^T), block diagonal over the
+    persons within a rank one image term. Its inverse and determinant follow from two nested Sherman-Morrison updates
+    (person blocks, then image), so every quadratic form X^T V^-1 X of the REML criterion is a correction of the
+    plain cross products by the per-person sums of the design. These sums are computed once; every evaluation of the
+    criterion is then O(n_persons * n_terms^2), independent of the number of samples, and sigma^2 is profiled out.
+    """
+
+    def __init__(self, samples: Dict[str, np.ndarray], factors: List[str],
+                 random_effects: Optional[List[str]] = None):
+        """
+        :param samples: per-sample columns, see DataLoader.get_samples
+        :param factors: demographic factors of the fixed effects, only the samples with a group for all of them are used
+        :param random_effects: random intercepts among RANDOM_EFFECTS (default: both)
+        """
+        unknown = set(factors) - set(FACTOR_ATTRIBUTES.keys())
+        if unknown:
+            # The keypoint (location) is always a fixed effect of the model
+            raise ValueError(f"Invalid factors: {sorted(unknown)}, expected some of {list(FACTOR_ATTRIBUTES.keys())}")
+        self.random_effects = list(RANDOM_EFFECTS if random_effects is None else random_effects)
+        if set(self.random_effects) - set(RANDOM_EFFECTS):
+            raise ValueError(f"Invalid random effects: {self.random_effects}, expected some of {RANDOM_EFFECTS}")
+        design, complete, self.terms, self.factor_columns = _fixed_design(samples, factors)
+        nmes = samples["nme"][complete]
+        persons = samples["person"][complete]
+        images = samples["image"][complete]
+
+        self.n, self.n_terms = design.shape
+        # Cross products of the design augmented with the NME column: [X y]^T [X y]
+        augmented = np.column_stack((design, nmes))
+        self._cross = augmented.T @ augmented
+        # Per-person sums of the augmented columns, persons ordered by image
+        order = np.lexsort((persons, images))
+        persons, images = persons[order], images[order]
+        person_starts = np.flatnonzero(np.concatenate(([True], persons[1:] != persons[:-1])))
+        self._person_sums = np.add.reduceat(augmented[order], person_starts, axis=0)
+        self.person_counts = np.diff(np.append(person_starts, self.n)).astype(np.float64)
+        person_images = images[person_starts]
+        self._image_starts = np.flatnonzero(np.concatenate(([True], person_images[1:] != person_images[:-1])))
+        self.n_persons, self.n_images = len(person_starts), len(self._image_starts)
+
+    def _ratios(self, log_ratios: np.ndarray) -> Tuple[float, float]:
+        """
+        :return: tau_image, tau_person, the variance ratios of the intercepts to the residual variance
+        """
+        ratios = dict(zip(self.random_effects, np.exp(log_ratios)))
+        return ratios.get("image", 0.0), ratios.get("person", 0.0)
+
+    def _quadratic_forms(self, tau_image: float, tau_person: float) -> Tuple[np.ndarray, np.ndarray, float, float]:
+        """
+        :return: X^T H^-1 X, X^T H^-1 y, y^T H^-1 y and log det H, with H = V / sigma^2
+        """
+        sums = self._person_sums
+        # Person blocks of n rows: (I + tau_p 1 1^T)^-1 = I - tau_p / (1 + n tau_p) 1 1^T
+        scale = 1 + self.person_counts * tau_person
+        cross = self._cross - (sums * (tau_person / scale)[:, None]).T @ sums
+        # Image term: rank one update of the block diagonal inverse, whose product with 1 is 1 / (1 + n tau_p) per row
+        image_sums = np.add.reduceat(sums / scale[:, None], self._image_starts, axis=0)
+        image_scale = 1 + tau_image * np.add.reduceat(self.person_counts / scale, self._image_starts)
+        cross -= (image_sums * (tau_image / image_scale)[:, None]).T @ image_sums
+        log_det = np.log(scale).sum() + np.log(image_scale).sum()
+        return cross[:-1, :-1], cross[:-1, -1], cross[-1, -1], log_det
+
+    def _profiled_reml(self, log_ratios: np.ndarray) -> Tuple[float, np.ndarray, np.ndarray, float]:
+        """
+        :return: -2 restricted log-likelihood with sigma^2 profiled out, the GLS coefficients, the Cholesky factor of
+                 X^T H^-1 X and the residual quadratic form
+        """
+        xhx, xhy, yhy, log_det = self._quadratic_forms(*self._ratios(log_ratios))
+        factor = np.linalg.cholesky(xhx)
+        coefficients = np.linalg.solve(factor.T, np.linalg.solve(factor, xhy))
+        residual = yhy - xhy @ coefficients
+        df = self.n - self.n_terms
+        criterion = (df * (1 + np.log(2 * np.pi * residual / df)) + log_det
+                     + 2 * np.log(np.diagonal(factor)).sum())
+        return criterion, coefficients, factor, residual
+
+    @profiled("stats.mixed_effects")
+    def fit(self) -> MixedModelFit:
+        """
+        REML estimate of the log variance ratios (bounded quasi-Newton search), then GLS fixed effects
+        """
+        from scipy.optimize import minimize
+
+        start = np.full(len(self.random_effects), np.log(0.5))
+        result = minimize(lambda log_ratios: self._profiled_reml(log_ratios)[0], start, method="L-BFGS-B",
+                          bounds=[LOG_RATIO_BOUNDS] * len(self.random_effects))
+        criterion, coefficients, factor, residual = self._profiled_reml(result.x)
+        sigma2 = residual / (self.n - self.n_terms)
+        inverse_factor = np.linalg.inv(factor)
+        tau_image, tau_person = self._ratios(result.x)
+        variances = {effect: sigma2 * tau for effect, tau in [("image", tau_image), ("person", tau_person)]
+                     if effect in self.random_effects}
+        variances["residual"] = sigma2
+        return MixedModelFit(
+            terms=self.terms,
+            factor_columns=self.factor_columns,
+            coefficients=coefficients,
+            covariance=sigma2 * inverse_factor.T @ inverse_factor,
+            variances=variances,
+            n=self.n,
+            n_persons=self.n_persons,
+            n_images=self.n_images,
+            reml=-criterion / 2,
+            converged=bool(result.success),
+        )
+
+
+def mixed_effects(samples: Dict[str, np.ndarray], factors: List[str],
+                  random_effects: Optional[List[str]] = None) -> MixedModelFit:
+    """
+    Fit the mixed-effects model of the NME on the keypoint and factors (see MixedEffectsModel)
+    """
+    return MixedEffectsModel(samples, factors, random_effects).fit()
@@ -0,0 +1,41 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Optional, Tuple, Type
+
+from analysis.data.data_loader import DataLoader
+from analysis.data.shared_samples import SharedColumn, SharedSamples
+from analysis.stats.discrete_group_factors import DiscreteGroupFactors
+
+# A statistical job: (analysis class, factor, method name, keypoint id)
+Job = Tuple[Type[DiscreteGroupFactors], str, str, Optional[int]]
+
+_shared_samples: Optional[SharedSamples] = None
+
+
+def _attach_worker(handle: Dict[str, SharedColumn]):
+    global _shared_samples
+    _shared_samples = SharedSamples.attach(handle)
+
+
+def _run_job(job: Job) -> Tuple[Job, Any]:
+    analysis_cls, factor, method, kp_id = job
+    analysis = analysis_cls(_shared_samples, factor)
+    if kp_id is None:
+        return job, getattr(analysis, method)()
+    return job, getattr(analysis, method)(kp_id)
+
+
+def run_statistics(data_loader: DataLoader, jobs: Iterable[Job], max_workers: Optional[int] = None) -> Dict[Job, Any]:
+    """
+    Run the statistical jobs in a process pool. The sample columns are published once in shared memory,
+    workers attach to them by name so only the job tuples and the results are pickled.
+    :param data_loader: loaded data
+    :param jobs: (analysis class, factor, method name, keypoint id or None) tuples
+    :param max_workers: number of worker processes, defaults to the number of CPUs
+    """
+    jobs = list(jobs)
+    max_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (4 * max_workers))
+    with data_loader.publish_samples() as shared:
+        with ProcessPoolExecutor(max_workers, initializer=_attach_worker, initargs=(shared.handle,)) as pool:
+            return dict(pool.map(_run_job, jobs, chunksize=chunksize))
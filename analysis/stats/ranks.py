@@ -0,0 +1,81 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+P_VALUE_CORRECTIONS = ["bonferroni", "holm", "fdr_bh"]
+
+
+class SharedRanks:
+    """
+    One sort of every sample by (keypoint, NME), from which the midranks of any subset of the samples (a factor's
+    available groups, a pair of groups...) are derived per keypoint with cumulative counts instead of a new sort.
+    """
+
+    def __init__(self, samples: Dict[str, np.ndarray]):
+        """
+        :param samples: per-sample columns, see DataLoader.get_samples
+        """
+        kp_ids = samples["kp_id"]
+        self.kp_labels = np.unique(kp_ids)
+        slots = np.searchsorted(self.kp_labels, kp_ids)
+        self.order = np.lexsort((samples["nme"], slots))
+        self.slots = slots[self.order]
+        values = samples["nme"][self.order]
+
+        new_run = np.ones(len(values), dtype=bool)
+        new_run[1:] = (self.slots[1:] != self.slots[:-1]) | (values[1:] != values[:-1])
+        self._run_ids = np.cumsum(new_run) - 1
+        self._run_starts = np.flatnonzero(new_run)
+        self._run_slots = self.slots[self._run_starts]
+        self._kp_starts = np.searchsorted(self.slots, np.arange(len(self.kp_labels)))
+
+    @property
+    def n_keypoints(self) -> int:
+        return len(self.kp_labels)
+
+    def sorted_column(self, column: np.ndarray) -> np.ndarray:
+        return column[self.order]
+
+    def ranks(self, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Midranks within each keypoint of the samples selected by `mask`, ties get the mean of their ranks
+        :param mask: selected samples, in sorted order (see sorted_column)
+        :return: the ranks (in sorted order, meaningless outside of the mask), the number of selected samples and the
+                 tie correction term sum(t^3 - t) of each keypoint
+        """
+        selected = mask.astype(np.int64)
+        exclusive = np.cumsum(selected) - selected
+        run_counts = np.bincount(self._run_ids, weights=selected, minlength=len(self._run_starts))
+        kp_before = np.append(exclusive, selected.sum())[self._kp_starts]
+        ranks = (exclusive[self._run_starts][self._run_ids] - kp_before[self.slots]
+                 + (run_counts[self._run_ids] + 1) / 2)
+        counts = np.bincount(self.slots, weights=selected, minlength=self.n_keypoints)
+        ties = np.bincount(self._run_slots, weights=run_counts ** 3 - run_counts, minlength=self.n_keypoints)
+        return ranks, counts, ties
+
+
+def adjust_p_values(p_values: np.ndarray, method: str = "holm") -> np.ndarray:
+    """
+    Multiple comparison correction of every row (one family of tests) at once, NaN p-values are not counted
+    :param method: bonferroni, holm (step-down) or fdr_bh (Benjamini-Hochberg), same results as statsmodels'
+                   multipletests
+    """
+    if method not in P_VALUE_CORRECTIONS:
+        raise ValueError(f"Invalid p-value correction: {method}, expected one of {P_VALUE_CORRECTIONS}")
+    p_values = np.atleast_2d(np.asarray(p_values, dtype=np.float64))
+    n_tests = (~np.isnan(p_values)).sum(axis=1, keepdims=True)
+    if method == "bonferroni":
+        return np.minimum(p_values * n_tests, 1)
+
+    order = np.argsort(p_values, axis=1)  # NaN last
+    sorted_p = np.take_along_axis(p_values, order, axis=1)
+    position = np.arange(p_values.shape[1])[None, :]
+    if method == "holm":
+        adjusted = np.maximum.accumulate(sorted_p * (n_tests - position), axis=1)
+    else:
+        scaled = np.where(np.isnan(sorted_p), np.inf, sorted_p * n_tests / (position + 1))
+        adjusted = np.minimum.accumulate(scaled[:, ::-1], axis=1)[:, ::-1]
+    adjusted = np.where(np.isnan(sorted_p), np.nan, np.minimum(adjusted, 1))
+    result = np.empty_like(adjusted)
+    np.put_along_axis(result, order, adjusted, axis=1)
+    return result
@@ -0,0 +1,223 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+
+import numpy as np
+
+from analysis.data.datatypes import FACTORS
+from analysis.data.locations import KEYPOINTS
+from analysis.profiling import profiled
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def subsample(samples: Dict[str, np.ndarray], indices: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    :param indices: one row of an index matrix of StratifiedSampler
+    :return: the sample columns of the drawn samples, for any function taking DataLoader.get_samples columns
+    """
+    return {column: values[indices] for column, values in samples.items()}
+
+
+class StratifiedSampler:
+    """
+    Strata of the samples: (keypoint, cell), a cell being a group of the factor or a combination of groups of several
+    factors. The sample indices are sorted by stratum once, then any number of balanced or target-distribution
+    subsamples are drawn at once as an (n_draws, n_drawn) index matrix into the sample columns. The columns of the
+    matrix are grouped by stratum, with the same strata at the same columns in every draw, so the per-stratum
+    statistics of all the draws are reductions over fixed column ranges (see stratum_sums).
+    """
+
+    def __init__(self, samples: Dict[str, np.ndarray], factors: Union[str, List[str]], kp_id: Optional[int] = None):
+        """
+        :param samples: per-sample columns, see DataLoader.get_samples
+        :param factors: factor, or factors whose group combinations are balanced jointly
+        :param kp_id: only this keypoint if given, every keypoint is stratified separately otherwise
+        """
+        self._factors = [factors] if isinstance(factors, str) else list(factors)
+        self._shape = tuple(len(FACTORS[factor]) for factor in self._factors)
+        self.n_cells = int(np.prod(self._shape))
+        self.kp_labels = np.array(sorted(KEYPOINTS.keys()) if kp_id is None else [kp_id])
+
+        valid = np.isin(samples["kp_id"], self.kp_labels)
+        for factor in self._factors:
+            valid &= samples[factor] >= 0
+        indices = np.flatnonzero(valid)
+        cells = np.ravel_multi_index(tuple(samples[factor][indices].astype(np.int64) for factor in self._factors),
+                                     self._shape)
+        kp_slots = np.searchsorted(self.kp_labels, samples["kp_id"][indices])
+        strata = kp_slots * self.n_cells + cells
+
+        order = np.argsort(strata, kind="stable")
+        self._indices = indices[order]
+        self._strata = strata[order]
+        n_strata = len(self.kp_labels) * self.n_cells
+        self.counts = np.bincount(strata, minlength=n_strata).reshape(len(self.kp_labels), self.n_cells)
+        self._offsets = np.concatenate(([0], np.cumsum(self.counts.ravel())))
+
+    def cells(self) -> List[tuple]:
+        """
+        :return: the groups of every cell, one per factor, in cell order
+        """
+        return [tuple(FACTORS[factor][code] for factor, code in zip(self._factors, codes))
+                for codes in np.ndindex(*self._shape)]
+
+    def _normalized_target(self, target: Optional[Union[Dict, np.ndarray]]) -> np.ndarray:
+        """
+        :return: (n_keypoints, n_cells) target proportions, restricted to the cells with samples on every keypoint
+        """
+        if target is None:
+            proportions = np.ones(self.n_cells)
+        elif isinstance(target, dict):
+            cell_index = {cell if len(cell) > 1 else cell[0]: index for index, cell in enumerate(self.cells())}
+            proportions = np.zeros(self.n_cells)
+            for cell, proportion in target.items():
+                proportions[cell_index[cell]] = proportion
+        else:
+            proportions = np.asarray(target, dtype=np.float64).ravel()
+        proportions = np.where(self.counts > 0, proportions[None, :], 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return proportions / proportions.sum(axis=1, keepdims=True)
+
+    def stratum_sizes(self, size: Optional[int] = None, target: Optional[Union[Dict, np.ndarray]] = None,
+                      replace: bool = False) -> np.ndarray:
+        """
+        :param size: number of samples drawn per keypoint, by default the largest size without replacement (for a
+                     balanced draw, number of non empty cells times the smallest of their counts)
+        :param target: proportions of the cells (cell, or group tuple for several factors -> proportion, or an array
+                       in cell order), balanced over the non empty cells of each keypoint if None
+        :return: (n_keypoints, n_cells) number of samples drawn from every stratum
+        """
+        proportions = self._normalized_target(target)
+        if size is None:
+            smallest = np.where(self.counts > 0, self.counts, np.iinfo(np.int64).max).min(axis=1)
+            sizes = np.where(self.counts > 0, smallest[:, None], 0)
+            if target is None:
+                return sizes
+            # Largest size of every keypoint whose target strata all fit in its samples
+            with np.errstate(invalid="ignore", divide="ignore"):
+                ratios = np.where(proportions > 0, self.counts / np.where(proportions > 0, proportions, 1), np.inf)
+            sizes = ratios.min(axis=1)
+            size = np.where(np.isfinite(sizes), np.floor(sizes), 0).astype(np.int64)
+        size = np.broadcast_to(size, (len(self.kp_labels),))
+        expected = np.nan_to_num(proportions * size[:, None])
+        sizes = np.floor(expected).astype(np.int64)
+        # Largest remainders, so every keypoint draws exactly `size` samples
+        missing = size - sizes.sum(axis=1)
+        ranks = np.argsort(np.argsort(-(expected - sizes), axis=1, kind="stable"), axis=1)
+        sizes += (ranks < missing[:, None]) & (proportions > 0)
+        if not replace and (sizes > self.counts).any():
+            raise ValueError("Some strata have fewer samples than drawn, draw with replacement or a smaller size")
+        return sizes
+
+    @profiled("resampling.draw")
+    def draw(self, n_draws: int, size: Optional[int] = None, target: Optional[Union[Dict, np.ndarray]] = None,
+             replace: bool = False, seed: int = 0) -> np.ndarray:
+        """
+        Balanced (or target-distribution) subsamples, all drawn at once
+        :param size: number of samples drawn per keypoint (see stratum_sizes)
+        :param target: proportions of the cells (see stratum_sizes), balanced if None
+        :param replace: draw with replacement (bootstrap) instead of without
+        :return: (n_draws, n_drawn) sample indices, the columns of every stratum are contiguous (see stratum_offsets)
+        """
+        sizes = self.stratum_sizes(size, target, replace).ravel()
+        starts = np.repeat(self._offsets[:-1], sizes)
+        rng = np.random.default_rng(seed)
+        if replace:
+            counts = np.repeat(self.counts.ravel(), sizes)
+            positions = starts + (rng.random((n_draws, len(starts))) * counts).astype(np.int64)
+        else:
+            # Random order within every stratum: the strata are sorted, so adding a [0, 1) key only shuffles them
+            permutations = np.argsort(self._strata + rng.random((n_draws, len(self._strata))), axis=1)
+            ranks = np.arange(len(starts)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            positions = permutations[:, starts + ranks]
+        return self._indices[positions]
+
+    def stratum_offsets(self, size: Optional[int] = None, target: Optional[Union[Dict, np.ndarray]] = None,
+                        replace: bool = False) -> np.ndarray:
+        """
+        :return: (n_keypoints * n_cells + 1) first column of every stratum in the index matrices of draw with the same
+                 arguments
+        """
+        return np.concatenate(([0], np.cumsum(self.stratum_sizes(size, target, replace).ravel())))
+
+    @staticmethod
+    def stratum_sums(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        :param values: (n_draws, n_drawn) values of the drawn samples, e.g. nme[indices]
+        :param offsets: stratum_offsets of the draws
+        :return: (n_draws, n_strata) sum of the values of every stratum in every draw, 0 for the empty strata
+        """
+        sums = np.concatenate((np.zeros((len(values), 1)), np.cumsum(values, axis=1)), axis=1)
+        return sums[:, offsets[1:]] - sums[:, offsets[:-1]]
+
+    def stratum_totals(self, values: np.ndarray) -> np.ndarray:
+        """
+        :param values: per-sample values aligned with the sample columns
+        :return: (n_keypoints, n_cells) sum of the values of all the samples of every stratum
+        """
+        return np.bincount(self._strata, weights=values[self._indices], minlength=self.counts.size).reshape(
+            self.counts.shape)
+
+    def stratum_weights(self, target: Optional[Union[Dict, np.ndarray]] = None) -> np.ndarray:
+        """
+        Importance weights reweighting every keypoint to the target distribution of the cells without drawing:
+        target proportion / observed proportion of the cell, the weights of a keypoint summing to its sample count
+        :return: (n_keypoints, n_cells) weight of the samples of every stratum
+        """
+        proportions = self._normalized_target(target)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.nan_to_num(proportions * self.counts.sum(axis=1, keepdims=True) / self.counts)
+
+    def weights(self, n_samples: int, target: Optional[Union[Dict, np.ndarray]] = None) -> np.ndarray:
+        """
+        :param n_samples: length of the sample columns
+        :return: (n_samples,) stratum_weights of every sample, 0 for the samples outside the strata
+        """
+        weights = np.zeros(n_samples)
+        weights[self._indices] = self.stratum_weights(target).ravel()[self._strata]
+        return weights
+
+
+@profiled("resampling.balanced_means")
+def balanced_means(samples: Dict[str, np.ndarray], factor: str, adjust_for: Optional[List[str]] = None,
+                   n_draws: int = 200, size: Optional[int] = None, confidence: float = 0.95,
+                   seed: int = 0) -> "pd.DataFrame":
+    """
+    Mean NME of every (keypoint, group of the factor) over repeated subsamples balanced over the groups, and over the
+    groups of the adjust_for factors within each group (e.g. the skintone groups compared at the same age
+    distribution), with the percentile interval of the draws. The importance weighted mean of all the samples, to
+    the same balanced distribution, is given next to it.
+    :param size: number of samples drawn per keypoint, the largest balanced size without replacement by default
+    :return: kp_id, group, n (all the samples), n_drawn (per draw), mean, mean_low, mean_high, weighted_mean
+    """
+    import pandas as pd
+
+    sampler = StratifiedSampler(samples, [factor, *(adjust_for or [])])
+    n_keypoints, n_groups = len(sampler.kp_labels), len(FACTORS[factor])
+    shape = (n_keypoints, n_groups, sampler.n_cells // n_groups)
+    indices = sampler.draw(n_draws, size, seed=seed)
+    offsets = sampler.stratum_offsets(size)
+    drawn = np.diff(offsets).reshape(shape).sum(axis=-1)
+    sums = sampler.stratum_sums(samples["nme"][indices], offsets).reshape(n_draws, *shape).sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / drawn
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail], axis=0)
+
+    stratum_weights = sampler.stratum_weights()
+    weighted_sums = (stratum_weights * sampler.stratum_totals(samples["nme"])).reshape(shape).sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weighted_means = weighted_sums / (stratum_weights * sampler.counts).reshape(shape).sum(axis=-1)
+
+    counts = sampler.counts.reshape(shape).sum(axis=-1)
+    kp_slot, code = np.nonzero(drawn > 0)
+    return pd.DataFrame({
+        "kp_id": sampler.kp_labels[kp_slot],
+        "group": np.array(FACTORS[factor], dtype=object)[code],
+        "n": counts[kp_slot, code],
+        "n_drawn": drawn[kp_slot, code],
+        "mean": means[:, kp_slot, code].mean(axis=0),
+        "mean_low": low[kp_slot, code],
+        "mean_high": high[kp_slot, code],
+        "weighted_mean": weighted_means[kp_slot, code],
+    })
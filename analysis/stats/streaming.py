@@ -0,0 +1,164 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class Moments:
+    """
+    Count, mean and sum of squared deviations (M2) of many cells, updated by batches and mergeable (Chan et al.
+    parallel variance), so shards can be accumulated separately and combined without keeping their values
+    """
+
+    def __init__(self, n_cells: int):
+        self.count = np.zeros(n_cells, dtype=np.int64)
+        self.mean = np.zeros(n_cells)
+        self.m2 = np.zeros(n_cells)
+
+    def update(self, cells: np.ndarray, values: np.ndarray):
+        """
+        :param cells: cell index of every value
+        """
+        batch = Moments(len(self.count))
+        batch.count = np.bincount(cells, minlength=len(self.count))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            batch.mean = np.nan_to_num(np.bincount(cells, weights=values, minlength=len(self.count)) / batch.count)
+        batch.m2 = np.bincount(cells, weights=(values - batch.mean[cells]) ** 2, minlength=len(self.count))
+        self.merge(batch)
+
+    def merge(self, other: "Moments"):
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(count > 0, other.count / count, 0)
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * weight
+        self.count = count
+
+    def variance(self, ddof: int = 1) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch (Karnin, Lang and Liberty): a hierarchy of compactors where level h holds items of weight
+    2^h. A full level is sorted and every other item (random offset) is promoted to the next level. The rank error
+    is about 1.7 / k of the count for any number of items, sketches of disjoint data merge level by level, and the
+    quantiles are exact while the sketch holds fewer than k items.
+    """
+
+    def __init__(self, k: int = 1024, seed: Optional[int] = None):
+        self.k = k
+        self.count = 0
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[level])
+            # An odd item out stays at its level
+            even = len(items) - len(items) % 2
+            promoted = items[self._rng.integers(2):even:2]
+            self.levels[level + 1] = np.concatenate((self.levels[level + 1], promoted))
+            self.levels[level] = items[even:]
+            # Capacities of the lower levels shrink when a level is added
+            level = 0
+
+    def update(self, values: np.ndarray):
+        if len(values):
+            self.levels[0] = np.concatenate((self.levels[0], np.asarray(values, dtype=np.float64)))
+            self.count += len(values)
+            self._compress()
+
+    def merge(self, other: "QuantileSketch"):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], items))
+        self.count += other.count
+        self._compress()
+
+    def quantiles(self, q: np.ndarray) -> np.ndarray:
+        """
+        Weighted version of np.quantile (linear interpolation), identical to it while no item was compacted
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        items, ends = items[order], np.cumsum(weights[order])
+        # Rank r (0 based) belongs to the first item whose cumulative weight exceeds it
+        position = q * (ends[-1] - 1)
+        low = items[np.searchsorted(ends, np.floor(position), side="right")]
+        high = items[np.searchsorted(ends, np.ceil(position), side="right")]
+        return low + (high - low) * (position - np.floor(position))
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {
+            "items": np.concatenate(self.levels),
+            "level_sizes": np.array([len(items) for items in self.levels]),
+            "count_k": np.array([self.count, self.k]),
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray], seed: Optional[int] = None) -> "QuantileSketch":
+        count, k = (int(value) for value in state["count_k"])
+        sketch = cls(k, seed)
+        sketch.count = count
+        sketch.levels = np.split(state["items"], np.cumsum(state["level_sizes"])[:-1])
+        return sketch
+
+
+class StreamingSummary:
+    """
+    Mergeable summary (count, mean, std and quartiles) of the values of many cells: Moments for the exact moments
+    and one QuantileSketch per cell for the quartiles
+    """
+
+    def __init__(self, n_cells: int, k: int = 1024, seed: Optional[int] = None):
+        self.moments = Moments(n_cells)
+        rng = np.random.default_rng(seed)
+        self.sketches = [QuantileSketch(k, int(cell_seed)) for cell_seed in rng.integers(2 ** 31, size=n_cells)]
+
+    def update(self, cells: np.ndarray, values: np.ndarray):
+        """
+        :param cells: cell index of every value
+        """
+        self.moments.update(cells, values)
+        order = np.argsort(cells, kind="stable")
+        boundaries = np.searchsorted(cells[order], np.arange(len(self.sketches) + 1))
+        for cell in np.flatnonzero(np.diff(boundaries)):
+            self.sketches[cell].update(values[order[boundaries[cell]:boundaries[cell + 1]]])
+
+    def merge(self, other: "StreamingSummary"):
+        self.moments.merge(other.moments)
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+
+    def quantiles(self, q: np.ndarray) -> np.ndarray:
+        """
+        :return: (n_cells, len(q)) quantiles of every cell, NaN for empty cells
+        """
+        return np.stack([sketch.quantiles(q) for sketch in self.sketches])
+
+    def summary(self) -> Dict[str, np.ndarray]:
+        """
+        :return: n, mean, std, q1, med, q3 of every cell
+        """
+        q1, med, q3 = self.quantiles(np.array([0.25, 0.5, 0.75])).T
+        with np.errstate(invalid="ignore"):
+            mean = np.where(self.moments.count > 0, self.moments.mean, np.nan)
+        return {"n": self.moments.count, "mean": mean, "std": np.sqrt(self.moments.variance()), "q1": q1, "med": med,
+                "q3": q3}
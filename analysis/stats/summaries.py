@@ -0,0 +1,172 @@
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import numpy as np
+
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from analysis.profiling import profiled
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Keypoint label of the summaries computed over all keypoints (same data as DataLoader.get_all_group_errors)
+ALL_KEYPOINTS = -1
+
+
+def summarize_segments(values: np.ndarray, segments: np.ndarray, n_segments: int, whis: float = 1.5,
+                       max_fliers: int = 0) -> Dict[str, Any]:
+    """
+    Box plot summaries of every segment of `values` in one vectorized pass (a single sort of the whole array).
+    Quantiles use the same linear interpolation as np.quantile and the whiskers follow the matplotlib convention
+    (most extreme samples within `whis` IQR of the quartiles, never inside the box).
+    :param values: flat sample values
+    :param segments: segment id of each value, in [0, n_segments)
+    :param n_segments: number of segments
+    :param whis: whisker reach, in IQR
+    :param max_fliers: maximum number of outliers kept per segment, evenly spread over the sorted outliers
+    :return: dict of (n_segments,) arrays: n, mean, q1, med, q3, whislo, whishi, and the per segment fliers list
+    """
+    order = np.lexsort((values, segments))
+    sorted_values = values[order]
+    sorted_segments = segments[order]
+
+    n = np.bincount(segments, minlength=n_segments)
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(segments, weights=values, minlength=n_segments) / n
+
+    # Trailing NaN so that the positions of trailing empty segments stay in bounds
+    padded = np.append(sorted_values, np.nan)
+
+    def quantile(q: float) -> np.ndarray:
+        position = q * np.maximum(n - 1, 0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(n - 1, 0))
+        low_values = padded[starts + lower]
+        interpolated = low_values + (position - lower) * (padded[starts + upper] - low_values)
+        return np.where(n > 0, interpolated, np.nan)
+
+    q1, med, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    iqr = q3 - q1
+    below_high = sorted_values <= (q3 + whis * iqr)[sorted_segments]
+    above_low = sorted_values >= (q1 - whis * iqr)[sorted_segments]
+
+    whishi = np.full(n_segments, np.nan)
+    whislo = np.full(n_segments, np.nan)
+    np.fmax.at(whishi, sorted_segments[below_high], sorted_values[below_high])
+    np.fmin.at(whislo, sorted_segments[above_low], sorted_values[above_low])
+    # The whiskers never end inside the box, and fall back to the quartiles when no sample lies within the limits
+    whishi = np.fmax(whishi, q3)
+    whislo = np.fmin(whislo, q1)
+
+    fliers: List[np.ndarray] = [np.empty(0)] * n_segments
+    if max_fliers > 0:
+        outside = (sorted_values < whislo[sorted_segments]) | (sorted_values > whishi[sorted_segments])
+        flier_segments = sorted_segments[outside]
+        flier_values = sorted_values[outside]
+        flier_counts = np.bincount(flier_segments, minlength=n_segments)
+        # Rank of each outlier within its segment, keep every `step`-th one
+        flier_starts = np.concatenate(([0], np.cumsum(flier_counts)[:-1]))
+        ranks = np.arange(len(flier_values)) - flier_starts[flier_segments]
+        steps = np.maximum(1, np.ceil(flier_counts / max_fliers)).astype(np.int64)
+        kept = ranks % steps[flier_segments] == 0
+        bounds = np.cumsum(np.bincount(flier_segments[kept], minlength=n_segments))
+        fliers = np.split(flier_values[kept], bounds[:-1])
+
+    return {"n": n, "mean": mean, "q1": q1, "med": med, "q3": q3, "whislo": whislo, "whishi": whishi,
+            "fliers": fliers}
+
+
+class BoxSummaries:
+    """
+    Precomputed box plot summaries per (model, factor, group, keypoint), computed once per factor for all models,
+    groups and keypoints (plus ALL_KEYPOINTS) and cached. Plots and tables draw from these instead of raw samples.
+    """
+
+    def __init__(self, data_loaders: Dict[str, DataLoader], whis: float = 1.5, max_fliers: int = 0):
+        self._data_loaders = data_loaders
+        self._whis = whis
+        self._max_fliers = max_fliers
+        self._cache: Dict[str, "pd.DataFrame"] = {}
+
+    @profiled("summaries.compute")
+    def _compute(self, factor: str) -> "pd.DataFrame":
+        import pandas as pd
+
+        groups = FACTORS[factor]
+        frames = []
+        for model, data_loader in self._data_loaders.items():
+            samples = data_loader.get_samples()
+            valid = samples[factor] >= 0
+            nmes = samples["nme"][valid]
+            codes = samples[factor][valid].astype(np.int64)
+            kp_ids = samples["kp_id"][valid].astype(np.int64)
+
+            kp_labels = np.unique(kp_ids)
+            kp_slots = np.searchsorted(kp_labels, kp_ids)
+            n_slots = len(kp_labels) + 1  # Last slot of every group is ALL_KEYPOINTS
+            # Each sample is counted in its (group, keypoint) segment and in its (group, all keypoints) segment
+            segments = np.concatenate((codes * n_slots + kp_slots, codes * n_slots + len(kp_labels)))
+            summaries = summarize_segments(
+                np.concatenate((nmes, nmes)), segments, len(groups) * n_slots, self._whis, self._max_fliers
+            )
+
+            frame = pd.DataFrame({key: value for key, value in summaries.items() if key != "fliers"})
+            frame["fliers"] = summaries["fliers"]
+            frame["model"] = model
+            frame["factor"] = factor
+            frame["group"] = np.repeat(np.array(groups, dtype=object), n_slots)
+            frame["kp_id"] = np.tile(np.append(kp_labels, ALL_KEYPOINTS), len(groups))
+            frames.append(frame[frame["n"] > 0])
+
+        columns = ["model", "factor", "group", "kp_id", "n", "mean", "q1", "med", "q3", "whislo", "whishi", "fliers"]
+        return pd.concat(frames, ignore_index=True)[columns]
+
+    def get(self, factor: str) -> "pd.DataFrame":
+        if factor not in self._cache:
+            self._cache[factor] = self._compute(factor)
+        return self._cache[factor]
+
+    def bxp_stats(self, model: str, factor: str, kp_id: int = ALL_KEYPOINTS) -> Dict[Any, dict]:
+        """
+        Summaries of each group in the format of matplotlib's Axes.bxp, in FACTORS order
+        """
+        frame = self.get(factor)
+        frame = frame[(frame["model"] == model) & (frame["kp_id"] == kp_id)]
+        return {
+            row.group: {
+                "label": getattr(row.group, "figure_label", str(row.group)),
+                "mean": row.mean, "med": row.med, "q1": row.q1, "q3": row.q3,
+                "whislo": row.whislo, "whishi": row.whishi, "fliers": row.fliers,
+            }
+            for row in frame.itertuples()
+        }
+
+    def to_frame(self, factors: Optional[List[str]] = None) -> "pd.DataFrame":
+        import pandas as pd
+
+        factors = factors or [factor for factor in FACTORS.keys() if factor != "location"]
+        frame = pd.concat([self.get(factor) for factor in factors], ignore_index=True)
+        frame["group"] = [getattr(group, "name", str(group)) for group in frame["group"]]
+        return frame.drop(columns="fliers")
+
+    def to_csv(self, path: str, factors: Optional[List[str]] = None):
+        self.to_frame(factors).to_csv(path, index=False)
+
+
+def summarize_groups(data: Dict[Any, np.ndarray], whis: float = 1.5) -> Dict[Any, dict]:
+    """
+    Box plot summaries of already separated group arrays (e.g. DataLoader.get_all_group_errors), bxp format
+    """
+    groups = list(data.keys())
+    values = np.concatenate([np.asarray(data[group], dtype=np.float64) for group in groups])
+    segments = np.repeat(np.arange(len(groups)), [len(data[group]) for group in groups])
+    summaries = summarize_segments(values, segments, len(groups), whis)
+    return {
+        group: {
+            "label": getattr(group, "figure_label", str(group)),
+            **{key: summaries[key][i] for key in ["mean", "med", "q1", "q3", "whislo", "whishi"]},
+            "fliers": summaries["fliers"][i],
+        }
+        for i, group in enumerate(groups)
+    }
@@ -1,21 +1,61 @@
-from typing import Dict
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, Union
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 from analysis.data.datatypes import Age, DiscreteFactorEnum, Sex, Skintone
+from analysis.stats.summaries import summarize_groups
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+BINARY_GROUP_COLORS = {True: (0.3, 0.5, 0.7), False: (0.7, 0.4, 0.3)}
+
+
+def group_color(group: Any):
+    if isinstance(group, DiscreteFactorEnum):
+        return group.color
+    return BINARY_GROUP_COLORS.get(group, (0.6, 0.6, 0.6))
+
+
+def group_label(group: Any) -> str:
+    if isinstance(group, DiscreteFactorEnum):
+        return group.figure_label
+    return str(group)
+
+
+def factor_title(demographic_factor: Union[DiscreteFactorEnum, str]) -> str:
+    if isinstance(demographic_factor, str):
+        return demographic_factor.capitalize()
+    return demographic_factor.get_property_str().capitalize()
 
 
 def display_demog_box_plot(data: Dict[DiscreteFactorEnum, np.ndarray], demographic_factor: DiscreteFactorEnum):
-    factors = list(data.keys())
-    values = [data[f] for f in factors]
-    colors = [f.color for f in factors]
-    labels = [f.figure_label for f in factors]
+    display_demog_box_plot_from_summaries(summarize_groups(data), demographic_factor)
+
+
+def display_demog_box_plot_from_summaries(
+    summaries: Dict[Any, dict], demographic_factor: Union[DiscreteFactorEnum, str], ax=None, show: bool = True
+):
+    """
+    Draw the box plot of precomputed group summaries (see analysis.stats.summaries), without touching raw samples
+    :param summaries: group -> summary in the matplotlib bxp format
+    :param demographic_factor: factor datatype, or factor name for the factors without one (e.g. lighting)
+    :param ax: axes to draw on, a new figure is created if None
+    :param show: block on plt.show() once drawn
+    """
+    import matplotlib.pyplot as plt
+
+    factors = list(summaries.keys())
+    stats = [summaries[f] for f in factors]
+    colors = [group_color(f) for f in factors]
+    labels = [group_label(f) for f in factors]
 
-    fig, ax = plt.subplots(figsize=(1.5 * len(factors), 6))
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(1.5 * len(factors), 6))
 
-    bp = ax.boxplot(
-        values,
+    bp = ax.bxp(
+        stats,
         patch_artist=True,
         boxprops={"linestyle": "-", "linewidth": 2},
         medianprops={"linestyle": "-", "linewidth": 2, "color": "black"},
@@ -28,19 +68,138 @@ def display_demog_box_plot(data: Dict[DiscreteFactorEnum, np.ndarray], demograph
     for patch, color in zip(bp["boxes"], colors):
         patch.set_facecolor(color)
 
-    for i, vals in enumerate(values):
-        mean = np.mean(vals)
-        median = np.median(vals)
+    for i, group_stats in enumerate(stats):
+        mean = group_stats["mean"]
+        median = group_stats["med"]
         ax.text(i + 1, mean, f"Mean: {mean:.2f}", ha="center", va="bottom", fontsize=9, color="black")
         ax.text(i + 1, median, f"Median: {median:.2f}", ha="center", va="top", fontsize=9, color="black")
 
     ax.set_xticks(range(1, len(labels) + 1))
     ax.set_xticklabels(labels)
     ax.set_ylabel("Normalized Mean Error (NME)")
-    ax.set_title(f"{demographic_factor.get_property_str().capitalize()} Distributions")
+    ax.set_title(f"{factor_title(demographic_factor)} Distributions")
 
     legend_handles = [plt.Line2D([0], [0], color=color, lw=8, label=label) for color, label in zip(colors, labels)]
     ax.legend(handles=legend_handles, title="Legend", loc="upper right")
 
     plt.tight_layout()
-    plt.show()
+    if show:
+        plt.show()
+    return ax
+
+
+def display_keypoint_box_plots(
+    summaries: Dict[int, Dict[Any, dict]], demographic_factor: Union[DiscreteFactorEnum, str], n_cols: int = 6
+):
+    """
+    Grid of small box plots, one panel per keypoint, from precomputed group summaries
+    :param summaries: keypoint id -> group -> summary in the matplotlib bxp format
+    :return: the figure
+    """
+    import matplotlib.pyplot as plt
+
+    n_rows = int(np.ceil(len(summaries) / n_cols))
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(2.5 * n_cols, 2.5 * n_rows), sharey=True, squeeze=False)
+    for ax, (kp_id, kp_summaries) in zip(axes.flat, summaries.items()):
+        groups = list(kp_summaries.keys())
+        bp = ax.bxp([kp_summaries[g] for g in groups], patch_artist=True, showmeans=True, meanline=True,
+                    showfliers=False, medianprops={"color": "black"}, meanprops={"color": "black"})
+        for patch, group in zip(bp["boxes"], groups):
+            patch.set_facecolor(group_color(group))
+        ax.set_title(f"Keypoint {kp_id}", fontsize=9)
+        ax.set_xticks([])
+    for ax in list(axes.flat)[len(summaries):]:
+        ax.set_visible(False)
+
+    groups = list(next(iter(summaries.values())).keys()) if summaries else []
+    legend_handles = [plt.Line2D([0], [0], color=group_color(g), lw=8, label=group_label(g)) for g in groups]
+    fig.legend(handles=legend_handles, loc="lower right")
+    fig.suptitle(f"{factor_title(demographic_factor)} NME per keypoint")
+    fig.tight_layout()
+    return fig
+
+
+def display_ced_curves(thresholds: np.ndarray, curves: Dict[Tuple[str, Any], np.ndarray],
+                       demographic_factor: Union[DiscreteFactorEnum, str], ax=None, show: bool = True):
+    """
+    Draw cumulative error distribution curves (see analysis.stats.ced), colored by group, one line style per model
+    :param curves: (model, group) -> fraction of the NMEs below each threshold
+    :param ax: axes to draw on, a new figure is created if None
+    :param show: block on plt.show() once drawn
+    """
+    import matplotlib.pyplot as plt
+
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(8, 6))
+
+    models = list(dict.fromkeys(model for model, _ in curves.keys()))
+    line_styles = ["-", "--", ":", "-."]
+    for (model, group), curve in curves.items():
+        label = group_label(group) if group is not None else "All"
+        if len(models) > 1:
+            label = f"{model} - {label}"
+        ax.plot(thresholds, curve, color=group_color(group), linestyle=line_styles[models.index(model) % 4],
+                linewidth=2, label=label)
+
+    ax.set_xlim(thresholds[0], thresholds[-1])
+    ax.set_ylim(0, 1)
+    ax.set_xlabel("Normalized Mean Error (NME)")
+    ax.set_ylabel("Proportion of keypoints")
+    ax.set_title(f"{factor_title(demographic_factor)} Cumulative Error Distribution")
+    ax.grid(True, alpha=0.3)
+    ax.legend(title="Legend", loc="lower right")
+
+    plt.tight_layout()
+    if show:
+        plt.show()
+    return ax
+
+
+def display_error_field(keypoints: Dict[int, Tuple[float, float]], iod: float, field: "pd.DataFrame",
+                        background: Optional[np.ndarray] = None, exaggeration: float = 10.0, title: str = "",
+                        ax=None, show: bool = True):
+    """
+    Draw mean error vectors and their ellipses (see analysis.stats.error_field) on a reference face
+    :param keypoints: kp id -> (x, y) ground truth position on the reference face, in pixels
+    :param iod: IOD of the reference face, converts the IOD normalized errors to pixels
+    :param field: rows of ErrorField.ellipses (group, kp_id, mean_dx, mean_dy, major, minor, angle) to draw
+    :param background: reference image, keypoints only if None
+    :param exaggeration: magnification of the vectors and ellipses
+    :param ax: axes to draw on, a new figure is created if None
+    :param show: block on plt.show() once drawn
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
+
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(8, 8))
+    if background is not None:
+        ax.imshow(background)
+    else:
+        ax.invert_yaxis()
+        ax.set_aspect("equal")
+
+    positions = np.array(list(keypoints.values()), dtype=np.float64)
+    ax.scatter(positions[:, 0], positions[:, 1], s=12, color="white", edgecolors="black", zorder=3)
+    scale = iod * exaggeration
+    for row in field.itertuples():
+        if row.kp_id not in keypoints:
+            continue
+        x, y = keypoints[row.kp_id]
+        color = group_color(row.group)
+        ax.annotate("", xy=(x + row.mean_dx * scale, y + row.mean_dy * scale), xytext=(x, y),
+                    arrowprops={"arrowstyle": "->", "color": color, "lw": 2}, zorder=4)
+        ax.add_patch(Ellipse((x + row.mean_dx * scale, y + row.mean_dy * scale), 2 * row.major * scale,
+                             2 * row.minor * scale, angle=np.degrees(row.angle), fill=False, color=color, lw=1.5))
+
+    groups = list(dict.fromkeys(field["group"]))
+    legend_handles = [plt.Line2D([0], [0], color=group_color(g), lw=4, label=group_label(g)) for g in groups]
+    ax.legend(handles=legend_handles, title=f"Mean error x{exaggeration:g}", loc="upper right")
+    ax.set_title(title)
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+    plt.tight_layout()
+    if show:
+        plt.show()
+    return ax
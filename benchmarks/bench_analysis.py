@@ -0,0 +1,217 @@
+import argparse
+import json
+
+from analysis.configs import DATA
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from benchmarks.registry import benchmark
+from benchmarks.synthetic import get_scaled_dataset, override_config, silenced
+
+SCALES = (1, 10, 100)
+
+
+def load_data_loader(scale: int) -> DataLoader:
+    with override_config(DATA, **get_scaled_dataset(scale)), silenced():
+        return DataLoader()
+
+
+@benchmark("parse_fairset_json", SCALES)
+def bench_parse_fairset(scale: int):
+    annotations_file = get_scaled_dataset(scale)["annotations_file"]
+
+    def parse():
+        with open(annotations_file, "r") as file:
+            return json.load(file)
+
+    return parse
+
+
+@benchmark("load_fairset_store", SCALES)
+def bench_load_fairset_store(scale: int):
+    from analysis.data.dataset_store import DatasetStore, write_store
+    from benchmarks import synthetic
+
+    annotations_file = get_scaled_dataset(scale)["annotations_file"]
+    store_file = f"{synthetic._scaled_dir.name}/fairset_x{scale}.npz"
+    write_store(annotations_file, store_file)
+    return lambda: DatasetStore(store_file).images()
+
+
+@benchmark("data_loader_construction", SCALES)
+def bench_data_loader(scale: int):
+    get_scaled_dataset(scale)
+    return lambda: load_data_loader(scale)
+
+
+@benchmark("preprocess_errors", SCALES)
+def bench_preprocess_errors(scale: int):
+    data_loader = load_data_loader(scale)
+    return data_loader._preprocess_errors
+
+
+@benchmark("errors_by_group", SCALES)
+def bench_errors_by_group(scale: int):
+    data_loader = load_data_loader(scale)
+    kp_ids = data_loader.get_keypoint_ids()
+    factors = [factor for factor in FACTORS.keys() if factor != "location"]
+
+    def retrieve():
+        for factor in factors:
+            for group in FACTORS[factor]:
+                data_loader.get_errors_by_group(factor, group)
+                for kp_id in kp_ids:
+                    data_loader.get_errors_by_group(factor, group, kp_id)
+
+    return retrieve
+
+
+@benchmark("errors_by_factor", SCALES)
+def bench_errors_by_factor(scale: int):
+    data_loader = load_data_loader(scale)
+    factors = [factor for factor in FACTORS.keys() if factor != "location"]
+
+    def retrieve():
+        for factor in factors:
+            data_loader.get_errors_by_factor(factor)
+
+    return retrieve
+
+
+@benchmark("demographics_per_keypoint_stats", (1, 10))
+def bench_demographics_per_keypoint(scale: int):
+    from analysis.scripts import demographics_per_keypoint
+
+    files = get_scaled_dataset(scale)
+    args = argparse.Namespace(factor="age", all=True, prerequisites=True, descriptive=False, save=None,
+                              profile=None)
+
+    def stats_loop():
+        with override_config(DATA, **files), silenced():
+            demographics_per_keypoint.main(args)
+
+    return stats_loop
+
+
+@benchmark("box_summaries", SCALES)
+def bench_box_summaries(scale: int):
+    from analysis.stats.summaries import BoxSummaries
+
+    data_loader = load_data_loader(scale)
+    factors = [factor for factor in FACTORS.keys() if factor != "location"]
+
+    def summarize():
+        summaries = BoxSummaries({"estimations": data_loader}, max_fliers=50)
+        for factor in factors:
+            summaries.get(factor)
+
+    return summarize
+
+
+@benchmark("non_parametric_report", SCALES)
+def bench_non_parametric(scale: int):
+    from analysis.stats.discrete_groups.non_parametric_analysis import non_parametric_report
+
+    data_loader = load_data_loader(scale)
+    factors = [factor for factor in FACTORS.keys() if factor != "location"]
+    return lambda: non_parametric_report(data_loader, factors)
+
+
+@benchmark("effect_sizes", SCALES)
+def bench_effect_sizes(scale: int):
+    from analysis.stats.effect_sizes import effect_sizes
+
+    data_loader = load_data_loader(scale)
+    factors = [factor for factor in FACTORS.keys() if factor != "location"]
+
+    def compute():
+        for factor in factors:
+            effect_sizes(data_loader.get_samples(), factor)
+
+    return compute
+
+
+@benchmark("covariate_regression", SCALES)
+def bench_covariate_regression(scale: int):
+    import numpy as np
+
+    from analysis.data.covariates import COVARIATES
+    from analysis.stats.continuous_factors import ContinuousFactorAnalysis
+
+    data_loader = load_data_loader(scale)
+    # The synthetic copies have no bounding boxes, the timing does not depend on the covariate values
+    rng = np.random.default_rng(0)
+    n_samples = len(data_loader.get_samples()["nme"])
+    covariates = {covariate: rng.lognormal(size=n_samples) for covariate in COVARIATES}
+    analysis = ContinuousFactorAnalysis(data_loader, covariates)
+    return analysis.regression
+
+
+@benchmark("error_normalizers", SCALES)
+def bench_error_normalizers(scale: int):
+    from analysis.data.normalizers import NORMALIZERS, compute_normalizers, gather_faces, normalized_errors
+
+    data_loader = load_data_loader(scale)
+    faces = gather_faces(data_loader.get_annotations(), data_loader.get_estimations(), {})
+
+    def normalize():
+        lengths = compute_normalizers(faces)
+        return [normalized_errors(faces, normalizer, lengths) for normalizer in NORMALIZERS]
+
+    return normalize
+
+
+@benchmark("balanced_resampling", SCALES)
+def bench_balanced_resampling(scale: int):
+    from analysis.stats.resampling import balanced_means
+
+    data_loader = load_data_loader(scale)
+    return lambda: balanced_means(data_loader.get_samples(), "skintone", ["age"], n_draws=100)
+
+
+@benchmark("mixed_effects", (1, 10))
+def bench_mixed_effects(scale: int):
+    from analysis.stats.mixed_effects import mixed_effects
+
+    data_loader = load_data_loader(scale)
+    return lambda: [mixed_effects(data_loader.get_samples(), [factor]) for factor in ["age", "sex", "skintone"]]
+
+
+@benchmark("streaming_summaries", SCALES)
+def bench_streaming_summaries(scale: int):
+    from analysis.stats.sharded import FACTOR_OFFSETS, _error_cells
+    from analysis.stats.streaming import StreamingSummary
+
+    data_loader = load_data_loader(scale)
+
+    def accumulate():
+        summary = StreamingSummary(FACTOR_OFFSETS["total"], seed=0)
+        summary.update(*_error_cells(data_loader.get_samples()))
+        return summary.summary()
+
+    return accumulate
+
+
+@benchmark("ced_metrics", SCALES)
+def bench_ced_metrics(scale: int):
+    from analysis.stats.ced import CEDCurves
+
+    data_loader = load_data_loader(scale)
+
+    def compute():
+        ced = CEDCurves({"model": data_loader})
+        return ced.curves(), ced.metrics()
+
+    return compute
+
+
+@benchmark("error_field", SCALES)
+def bench_error_field(scale: int):
+    from analysis.stats.error_field import ErrorField
+
+    data_loader = load_data_loader(scale)
+
+    def compute():
+        field = ErrorField({"model": data_loader})
+        return field.ellipses(), field.hotelling()
+
+    return compute
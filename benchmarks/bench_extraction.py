@@ -0,0 +1,112 @@
+import os
+import tempfile
+
+import numpy as np
+
+from benchmarks.registry import benchmark
+from benchmarks.synthetic import synthetic_crowd, synthetic_dense_landmarks
+
+# Number of faces on the synthetic crowd image for each scale
+CROWD_SIZES = {1: 4, 10: 16, 100: 64}
+IMAGE_SIZE = (1920, 1080)
+
+
+@benchmark("associate_bboxes_to_annotations", tuple(CROWD_SIZES.keys()))
+def bench_association(scale: int):
+    from analysis.data.datatypes import BoundingBox
+    from sample_extraction.utils import associate_bboxes_to_annotations
+
+    annotated, estimated = synthetic_crowd(CROWD_SIZES[scale], *IMAGE_SIZE)
+    annotated = [BoundingBox(*bbox) for bbox in annotated]
+    estimated = [BoundingBox(*bbox) for bbox in estimated]
+    return lambda: associate_bboxes_to_annotations(estimated, annotated)
+
+
+@benchmark("keypoint_mapping_reduction", (1, 10, 100))
+def bench_keypoint_mapping(scale: int):
+    from sample_extraction.inference_cache import RawInference
+    from sample_extraction.mediapipe_extraction import estimate
+
+    raw = RawInference(synthetic_dense_landmarks(scale), IMAGE_SIZE[::-1])
+    return lambda: estimate(raw)
+
+
+@benchmark("remap_from_inference_cache", (1, 10, 100))
+def bench_remap_from_cache(scale: int):
+    """
+    Re-mapping of 100 cached images with `scale` faces each, without any inference
+    """
+    from sample_extraction.inference_cache import InferenceCache, RawInference
+    from sample_extraction.mediapipe_extraction import estimate
+
+    folder = tempfile.mkdtemp(prefix="fairset_cache_bench_")
+    model_path = os.path.join(folder, "model.task")
+    with open(model_path, "wb") as file:
+        file.write(b"stub model")
+    cache = InferenceCache(os.path.join(folder, "cache"), model_path, {"num_faces": scale}, "RGB")
+    image_paths = []
+    for i in range(100):
+        image_paths.append(os.path.join(folder, f"{i}.png"))
+        with open(image_paths[-1], "wb") as file:
+            file.write(np.random.default_rng(i).bytes(64 * 1024))
+        landmarks = np.concatenate((synthetic_dense_landmarks(scale, seed=i), np.zeros((scale, 478, 1))), axis=2)
+        cache.put(image_paths[-1], RawInference(landmarks, IMAGE_SIZE[::-1]))
+
+    def remap():
+        for image_path in image_paths:
+            estimate(cache.get(image_path))
+
+    return remap
+
+
+def _synthetic_jpegs(n_images: int) -> list:
+    import cv2
+
+    folder = tempfile.mkdtemp(prefix="fairset_image_cache_bench_")
+    rng = np.random.default_rng(0)
+    image_paths = []
+    for i in range(n_images):
+        image_paths.append(os.path.join(folder, f"{i}.jpg"))
+        noise = rng.integers(0, 256, (IMAGE_SIZE[1] // 16, IMAGE_SIZE[0] // 16, 3), dtype=np.uint8)
+        cv2.imwrite(image_paths[-1], cv2.resize(noise, (IMAGE_SIZE[0] // 2, IMAGE_SIZE[1] // 2)))
+    return image_paths
+
+
+@benchmark("decode_images", (1, 10))
+def bench_decode_images(scale: int):
+    """
+    Decoding of 20 * `scale` synthetic 960x540 JPEG images, the baseline of decoded_image_cache
+    """
+    from sample_extraction.mediapipe_extraction import decode_image
+
+    image_paths = _synthetic_jpegs(20 * scale)
+    return lambda: sum(int(decode_image(image_path).mean()) for image_path in image_paths)
+
+
+@benchmark("decoded_image_cache", (1, 10))
+def bench_decoded_image_cache(scale: int):
+    """
+    The same frames as decode_images read from the decoded image cache, built before the timing
+    """
+    from sample_extraction.image_cache import DecodedImageCache
+    from sample_extraction.mediapipe_extraction import decode_image
+
+    image_paths = _synthetic_jpegs(20 * scale)
+    cache = DecodedImageCache(os.path.join(os.path.dirname(image_paths[0]), "cache"))
+    cache.build(image_paths, decode_image)
+    return lambda: sum(int(cache.get(image_path).mean()) for image_path in image_paths)
+
+
+@benchmark("mapping_optimizer", (1, 10))
+def bench_mapping_optimizer(scale: int):
+    """
+    Mapping search of every FAIRSET keypoint over 150 * `scale` synthetic faces (default neighbourhood and subsets)
+    """
+    from sample_extraction.mapping_optimizer import N_KEYPOINTS, MappingSamples, optimize_mapping
+
+    n_faces = 150 * scale
+    landmarks = synthetic_dense_landmarks(n_faces) * IMAGE_SIZE[1]
+    ground_truth = landmarks[:, :N_KEYPOINTS] + np.random.default_rng(0).normal(0, 1, (n_faces, N_KEYPOINTS, 2))
+    iod = np.full(n_faces, 50.0)
+    samples = MappingSamples(landmarks, ground_truth, iod, np.arange(n_faces) // 2)
+    return lambda: optimize_mapping(samples)
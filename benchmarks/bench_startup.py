@@ -0,0 +1,67 @@
+import json
+import subprocess
+import sys
+from typing import List, Tuple
+
+from benchmarks.registry import benchmark
+
+HEAVY_MODULES = ["cv2", "matplotlib", "mediapipe", "pandas", "scipy", "statsmodels"]
+
+# Entry point module -> total import time budget in seconds (from `-X importtime`). None of these core modules may
+# import a heavy dependency, those are deferred to the drawing, plotting and test functions that need them.
+STARTUP_BUDGETS = {
+    "analysis.data.data_loader": 0.4,
+    "analysis.data.incremental": 0.4,
+    "analysis.data.shared_samples": 0.4,
+    "analysis.stats.discrete_groups.n_group_analysis": 0.4,
+    "analysis.stats.discrete_groups.binary_group_analysis": 0.4,
+    "analysis.stats.parallel": 0.4,
+    "analysis.stats.summaries": 0.4,
+    "analysis.utils": 0.4,
+    "sample_extraction.utils": 0.4,
+}
+
+
+def measure_import(module: str) -> Tuple[float, List[str]]:
+    """
+    Import `module` in a fresh interpreter with -X importtime
+    :return: the total import time in seconds and the heavy modules that got imported
+    """
+    code = f"import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                             check=True)
+    total_us = 0
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us = line.split(":", 1)[1].split("|")[0].strip()
+            if self_us.isdigit():
+                total_us += int(self_us)
+    loaded = json.loads(process.stdout.strip().splitlines()[-1])
+    return total_us / 1e6, [heavy for heavy in HEAVY_MODULES if heavy in loaded]
+
+
+def check_budgets() -> List[str]:
+    failures = []
+    for module, budget in STARTUP_BUDGETS.items():
+        duration, heavy = measure_import(module)
+        if heavy:
+            failures.append(f"{module} imports heavy dependencies at startup: {', '.join(heavy)}")
+        if duration > budget:
+            failures.append(f"{module} import takes {duration:.3f}s, over its {budget:.3f}s budget")
+    return failures
+
+
+def _register(module: str):
+    @benchmark(f"startup_{module}")
+    def bench_startup(scale: int):
+        return lambda: measure_import(module)
+
+
+for _module in STARTUP_BUDGETS.keys():
+    _register(_module)
+
+
+if __name__ == "__main__":
+    failures = check_budgets()
+    print("\n".join(failures) if failures else "All startup budgets respected")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,26 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Sequence
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Called once per scale outside of the timing, returns the callable to time
+    setup: Callable[[int], Callable[[], object]]
+    scales: Sequence[int] = (1,)
+
+
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+
+def benchmark(name: str, scales: Sequence[int] = (1,)):
+    """
+    Register a benchmark. The decorated function receives the scale and returns the zero-argument callable to time.
+    Raising ImportError in the setup marks the benchmark as skipped (missing optional dependency).
+    """
+
+    def decorator(setup: Callable[[int], Callable[[], object]]):
+        BENCHMARKS[name] = Benchmark(name, setup, scales)
+        return setup
+
+    return decorator
@@ -0,0 +1,112 @@
+import argparse
+import importlib
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, List, Optional
+
+from benchmarks.registry import BENCHMARKS
+
+BENCHMARK_MODULES = ["benchmarks.bench_analysis", "benchmarks.bench_extraction", "benchmarks.bench_startup"]
+
+
+def time_callable(func: Callable[[], object], repeat: int, budget: float) -> List[float]:
+    """
+    Time `func` up to `repeat` times, stopping early once `budget` seconds were spent (at least one run)
+    """
+    timings = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+        if time.perf_counter() - start > budget:
+            break
+    return timings
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(selection: Optional[List[str]] = None, scales: Optional[List[int]] = None, repeat: int = 5,
+        budget: float = 10.0) -> dict:
+    for module in BENCHMARK_MODULES:
+        importlib.import_module(module)
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if selection and not any(pattern in name for pattern in selection):
+            continue
+        results[name] = {}
+        for scale in bench.scales:
+            if scales and scale not in scales:
+                continue
+            print(f"{name} x{scale}...", end=" ", flush=True, file=sys.stderr)
+            try:
+                func = bench.setup(scale)
+            except ImportError as e:
+                results[name][str(scale)] = {"skipped": str(e)}
+                print(f"skipped ({e})", file=sys.stderr)
+                continue
+            timings = time_callable(func, repeat, budget)
+            results[name][str(scale)] = {
+                "min": min(timings),
+                "median": statistics.median(timings),
+                "mean": statistics.mean(timings),
+                "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+                "runs": len(timings),
+            }
+            print(f"{min(timings):.4f}s", file=sys.stderr)
+
+    return {
+        "commit": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "benchmarks": results,
+    }
+
+
+def compare(current: dict, previous: dict, threshold: float = 1.25) -> List[str]:
+    """
+    Compare the min timings of two result files, returns the report lines. Ratios above `threshold` are regressions.
+    """
+    lines = []
+    for name, scales in current["benchmarks"].items():
+        for scale, result in scales.items():
+            before = previous["benchmarks"].get(name, {}).get(scale, {})
+            if "min" not in result or "min" not in before:
+                continue
+            ratio = result["min"] / before["min"]
+            flag = "REGRESSION" if ratio > threshold else ("improved" if ratio < 1 / threshold else "")
+            lines.append(f"{name:<40} x{scale:<4} {before['min']:.4f}s -> {result['min']:.4f}s ({ratio:.2f}x) {flag}")
+    return lines
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the FAIRSET evaluation and extraction benchmarks")
+    parser.add_argument("-o", "--output", default="benchmarks.json", help="JSON file the results are written to")
+    parser.add_argument("-k", "--select", nargs="+", help="Only run the benchmarks whose name contains one of these")
+    parser.add_argument("-s", "--scales", nargs="+", type=int, help="Only run these dataset scales (1, 10, 100)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Maximum number of timed runs per benchmark")
+    parser.add_argument("-b", "--budget", type=float, default=10.0, help="Time budget in seconds per benchmark")
+    parser.add_argument("-c", "--compare", help="Previous results JSON file to compare against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args.select, args.scales, args.repeat, args.budget)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            print("\n".join(compare(results, json.load(file))))
@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from analysis.configs import DATA
+
+
+def scale_dataset(annotations_file: str, estimations_file: str, exclude_file: str, scale: int, output_dir: Path,
+                  seed: int = 0) -> Dict[str, str]:
+    """
+    Write a synthetic version of the dataset with every image replicated `scale` times.
+    The estimations of the copies are jittered by a few pixels so the error distributions are not exact duplicates.
+    :return: DATA-like dict pointing to the generated files
+    """
+    if scale == 1:
+        return {"annotations_file": annotations_file, "estimations_file": estimations_file,
+                "exclude_images_file": exclude_file}
+
+    rng = np.random.default_rng(seed)
+    with open(annotations_file, "r") as file:
+        annotations = json.load(file)
+    with open(estimations_file, "r") as file:
+        estimations = json.load(file)
+    excluded = list(np.loadtxt(exclude_file, dtype=str)) if exclude_file else []
+
+    scaled_annotations, scaled_estimations, scaled_excluded = {}, {}, []
+    for copy in range(scale):
+        prefix = f"copy{copy}_" if copy else ""
+        for image_name, metadata in annotations.items():
+            scaled_annotations[prefix + image_name] = metadata
+        for image_name, persons in estimations.items():
+            scaled_estimations[prefix + image_name] = {
+                person_id: {
+                    kp_id: {
+                        "x": kp["x"] + (int(rng.integers(-2, 3)) if copy else 0),
+                        "y": kp["y"] + (int(rng.integers(-2, 3)) if copy else 0),
+                    }
+                    for kp_id, kp in keypoints.items()
+                }
+                for person_id, keypoints in persons.items()
+            }
+        scaled_excluded.extend(prefix + image_name for image_name in excluded)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    files = {
+        "annotations_file": str(output_dir / f"fairset_x{scale}.json"),
+        "estimations_file": str(output_dir / f"estimations_x{scale}.json"),
+        "exclude_images_file": str(output_dir / f"excluded_x{scale}.txt"),
+    }
+    with open(files["annotations_file"], "w") as file:
+        json.dump(scaled_annotations, file)
+    with open(files["estimations_file"], "w") as file:
+        json.dump(scaled_estimations, file)
+    with open(files["exclude_images_file"], "w") as file:
+        file.write("\n".join(scaled_excluded))
+    return files
+
+
+_scaled_cache: Dict[int, Dict[str, str]] = {}
+_scaled_dir = None
+
+
+def get_scaled_dataset(scale: int) -> Dict[str, str]:
+    global _scaled_dir
+    if scale not in _scaled_cache:
+        if _scaled_dir is None:
+            _scaled_dir = tempfile.TemporaryDirectory(prefix="fairset_bench_")
+        _scaled_cache[scale] = scale_dataset(
+            DATA["annotations_file"], DATA["estimations_file"], DATA.get("exclude_images_file"), scale,
+            Path(_scaled_dir.name)
+        )
+    return _scaled_cache[scale]
+
+
+@contextmanager
+def override_config(config: dict, **values):
+    previous = dict(config)
+    config.update(values)
+    try:
+        yield
+    finally:
+        config.clear()
+        config.update(previous)
+
+
+@contextmanager
+def silenced():
+    with open(os.devnull, "w") as devnull:
+        with redirect_stdout(devnull):
+            yield
+
+
+def synthetic_crowd(n_faces: int, width: int = 1920, height: int = 1080, jitter: float = 0.1,
+                    seed: int = 0) -> Tuple[List[Tuple[int, int, int, int]], List[Tuple[int, int, int, int]]]:
+    """
+    Random annotated face boxes on a crowd image and their jittered, shuffled estimations, as (x, y, w, h) tuples
+    """
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(20, 120, n_faces)
+    xs = rng.integers(0, width - sizes)
+    ys = rng.integers(0, height - sizes)
+    annotated = [(int(x), int(y), int(s), int(s)) for x, y, s in zip(xs, ys, sizes)]
+    estimated = [
+        (int(x + rng.normal(0, jitter * s)), int(y + rng.normal(0, jitter * s)), int(s * rng.uniform(0.9, 1.1)),
+         int(s * rng.uniform(0.9, 1.1)))
+        for x, y, s in zip(xs, ys, sizes)
+    ]
+    order = rng.permutation(n_faces)
+    return annotated, [estimated[i] for i in order]
+
+
+def synthetic_dense_landmarks(n_faces: int, n_landmarks: int = 478, seed: int = 0) -> np.ndarray:
+    """
+    Normalized (x, y) dense landmarks, shaped (n_faces, n_landmarks, 2), as a stubbed landmarker would return them
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0.2, 0.8, (n_faces, 1, 2))
+    return np.clip(centers + rng.normal(0, 0.05, (n_faces, n_landmarks, 2)), 0, 1)
@@ -1,18 +1,21 @@
 import argparse
-import importlib
 import io
 import json
 import os
 import re
 import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from enum import Enum, auto
 from itertools import chain
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
+import numpy as np
 import requests
 import unzip_http
 
@@ -22,6 +25,11 @@ WIDER_FACE_VAL = "https://huggingface.co/datasets/CUHK-CSE/wider_face/resolve/ma
 
 AMAZON_LABELS = "https://github.com/amazon-science/widerface-demographics/archive/refs/heads/main.zip"
 
+# Columns of a face line of wider_face_*_bbx_gt.txt
+WIDER_FACE_COLUMNS = ["x", "y", "w", "h", "blur", "expression", "illumination", "invalid", "occlusion", "pose"]
+# Columns of the Amazon demographics CSVs identifying a face -> WIDER FACE ground truth names
+DEMOGRAPHICS_KEYS = {"image_path": "image", "bbox_x": "x", "bbox_y": "y", "bbox_w": "w", "bbox_h": "h"}
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Download and prepare FairSet dataset")
@@ -56,6 +64,9 @@ def parse_args():
     parser.add_argument(
         "-o", "--output", action="store", default="assets", type=str, help="Directory to download the dataset to"
     )
+    parser.add_argument(
+        "-j", "--jobs", action="store", default=4, type=int, help="Maximum number of stages running at the same time"
+    )
 
     return parser.parse_args()
 
@@ -114,8 +125,9 @@ def list_fairset_imgs(source: FairsetSourceType):
 
 def get_missing_fairset_imgs(assets_dir: Path, source: FairsetSourceType) -> List[str]:
     files = list_fairset_imgs(source)
-    if assets_dir.exists():
-        return list(set(files) - set(os.listdir(assets_dir)))
+    if not assets_dir.exists():
+        return files
+    return list(set(files) - set(os.listdir(assets_dir)))
 
 
 def dwnld_fairset(data_dir: Path, download_type: FairsetDwnld, files: List[str] = None):
@@ -170,7 +182,7 @@ def dwnld_widerface(data_dir: Path, remote_data: List, force: bool = False):
     :param force: force download even if the dataset seems already present
     """
     widerface_imgs = get_missing_fairset_imgs(data_dir, FairsetSourceType.WIDERFACE)
-    if force or not data_dir.exists() or len(widerface_imgs) > 0:
+    if force or len(widerface_imgs) > 0:
         is_remote = all(
             [is_path_remote(url) for url in remote_data]
         )  # TODO: fails if the user provides a mix of URL and local zips
@@ -180,76 +192,119 @@ def dwnld_widerface(data_dir: Path, remote_data: List, force: bool = False):
         )
 
 
+def alexa_annots_missing(amazon_dir: Path) -> bool:
+    return not amazon_dir.exists() or len(os.listdir(amazon_dir)) == 0
+
+
 def dwnld_alexa_annots(amazon_dir: Path, force: bool = False):
     """
     Download Amazon Alexa demographics annotations for Widerface
     :param amazon_dir: path to download the annotations to
     :param force: force download even if the annotations seem already present
     """
-    if force or not amazon_dir.exists() or len(os.listdir(amazon_dir)) == 0:
+    if force or alexa_annots_missing(amazon_dir):
         wget_zip(AMAZON_LABELS, amazon_dir)
         return True
     return False
 
 
-def patch_alexa_merging_script(module: Path):
+def parse_widerface_gt(gt_file: Path) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Patch the Amazon Alexa script to merge Amazon annotations with Widerface ones
-    :param module: path to the merging script
+    Parse a WIDER FACE ground truth file: blocks of an image path, a face count and one line per face (a single line
+    of zeros for images without faces, which is skipped)
+    :return: the image path and the index within its image of every face, and the (n_faces, 10) WIDER_FACE_COLUMNS
     """
-    cwd = Path(os.getcwd())
-    os.chdir(cwd / module.parent)
-
-    with open(module.stem + ".py", "r+") as f:
-        script = f.read().split("\n")
-
-        script.insert(15, "\tskip_image = False")
-        script.insert(19, "\t\t\tskip_image = False")
-        script.insert(21, "\t\tif skip_image:\n\t\t\tcontinue")
-        script.insert(24, "\t\t\tif num_users == 0:\n\t\t\t\tskip_image = True")
-
-        f.seek(0)
-        f.write("\n".join(script))  # should overwrite since new content is longer than previous script
-
-    os.chdir(cwd)
-
-
-def merge_alexa_annots(assets_dir: Path, amazon_dir: Path, wf_labels_dir: Path, patch=True):
+    lines = gt_file.read_text().split("\n")
+    images, counts, face_lines = [], [], []
+    i = 0
+    while i + 1 < len(lines) and lines[i].strip():
+        n_faces = int(lines[i + 1])
+        images.append(lines[i].strip())
+        counts.append(n_faces)
+        face_lines.extend(lines[i + 2:i + 2 + n_faces])
+        i += 2 + max(n_faces, 1)
+
+    counts = np.array(counts, dtype=np.int64)
+    faces = np.array(" ".join(face_lines).split(), dtype=np.int64).reshape(-1, len(WIDER_FACE_COLUMNS))
+    face_index = np.arange(len(faces)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(np.array(images, dtype=object), counts), face_index, faces
+
+
+def load_demographics(demographics_file: Path):
+    """
+    Load an Amazon demographics CSV (annotations/demographics_{train,val}.csv), keyed by the image path and the box
+    of every annotated face (DEMOGRAPHICS_KEYS, renamed to the WIDER FACE names)
+    """
+    import pandas as pd
 
-    module = Path(f"{amazon_dir}/widerface-demographics-main/scripts/update_demographics_for_annotations")
-    if patch:
-        patch_alexa_merging_script(module)
+    demographics = pd.read_csv(demographics_file)
+    missing = [column for column in DEMOGRAPHICS_KEYS if column not in demographics.columns]
+    if missing:
+        raise Exception(f"{demographics_file} has no {missing} columns (columns: {list(demographics.columns)}), "
+                        "the Amazon demographics layout has changed.")
+    demographics = demographics.rename(columns=DEMOGRAPHICS_KEYS)
+    demographics["image"] = demographics["image"].astype(str).str.replace(r"^.*images/", "", regex=True)
+    return demographics.drop_duplicates(list(DEMOGRAPHICS_KEYS.values()), keep="first")
 
-    importlib.invalidate_caches()
-    amazon = importlib.import_module(re.sub("(\\\\|\/)", ".", str(module)), package=__name__)
 
-    (annotations_dir := assets_dir / "alexa").mkdir(parents=True, exist_ok=True)
-    amz_args = [
-        amazon_dir / "widerface-demographics-main/annotations/demographics_train.csv",
-        wf_labels_dir / "wider_face_train_bbx_gt.txt",
-        annotations_dir / "train.csv",
-    ]
-
-    # Merge training and validation annotations
-    for _ in range(2):
-        amazon.add_demographic_annotations(*amz_args)
-        amz_args = [Path(str(arg).replace("train", "val")) for arg in amz_args]
+def merge_split(demographics_file: Path, gt_file: Path):
+    """
+    Every WIDER FACE box of the split with its Amazon demographics, in the ground truth order. The demographics are
+    joined on the image path and the box coordinates.
+    """
+    import pandas as pd
+
+    images, face_index, faces = parse_widerface_gt(gt_file)
+    boxes = pd.DataFrame(faces, columns=WIDER_FACE_COLUMNS)
+    boxes.insert(0, "face", face_index)
+    boxes.insert(0, "image", images)
+    demographics = load_demographics(demographics_file)
+    keys = list(DEMOGRAPHICS_KEYS.values())
+    merged = boxes.merge(demographics, on=keys, how="left", sort=False, validate="many_to_one", indicator=True)
+    matched = (merged.pop("_merge") == "both").sum()
+    if not matched:
+        raise Exception(f"No face of {gt_file} matches the demographics of {demographics_file}, they cannot be "
+                        "merged.")
+    if matched < len(demographics):
+        print(f"\033[93m{len(demographics) - matched} of the {len(demographics)} faces of {demographics_file} match "
+              f"no box of {gt_file}\033[0m")
+    # Boxes without demographics would turn the integer columns into floats
+    integer_columns = [column for column in demographics.columns if pd.api.types.is_integer_dtype(demographics[column])]
+    merged[integer_columns] = merged[integer_columns].astype("Int64")
+    return merged
+
+
+def merge_alexa_annots(annotations_dir: Path, amazon_dir: Path, wf_labels_dir: Path, splits: Optional[Dict] = None):
+    """
+    Merge the Amazon Alexa demographics with the WIDER FACE boxes of the train and val splits (parsed concurrently)
+    into a single annotations.csv
+    :param annotations_dir: output directory
+    :param amazon_dir: directory of the extracted Amazon repository
+    :param wf_labels_dir: directory of the extracted WIDER FACE ground truth
+    :param splits: split name -> (demographics CSV, ground truth file), train and val by default
+    """
+    import pandas as pd
 
-    # Combine the train and valid files
-    with open(annotations_dir / "val.csv", "r") as fval:
-        with open(annotations_dir / "train.csv", "a") as ftrain:
-            lines = [f.replace("images/", "") for f in fval.readlines()[1:]]
-            ftrain.write("".join(lines))
+    if splits is None:
+        splits = {
+            split: (
+                amazon_dir / f"widerface-demographics-main/annotations/demographics_{split}.csv",
+                wf_labels_dir / f"wider_face_{split}_bbx_gt.txt",
+            )
+            for split in ["train", "val"]
+        }
+    with ThreadPoolExecutor(len(splits)) as pool:
+        merged = list(pool.map(lambda files: merge_split(*files), splits.values()))
 
-    shutil.move(annotations_dir / "train.csv", annotations_dir / "annotations.csv")
-    (annotations_dir / "val.csv").unlink()
+    annotations_dir.mkdir(parents=True, exist_ok=True)
+    pd.concat(merged, ignore_index=True).to_csv(annotations_dir / "annotations.csv", index=False)
 
 
 def dwnld_dad3d(data_dir: Path, dad3d_dir: str, force: bool = False):
     dad3dheads_imgs = get_missing_fairset_imgs(data_dir, FairsetSourceType.DAD3DHEADS)
     data_dir /= "dad3dheads"
 
-    if force or not data_dir.parent.exists() or len(dad3dheads_imgs) > 0:
+    if force or len(dad3dheads_imgs) > 0:
         is_remote = is_path_remote(dad3d_dir)
 
         # Download the DAD3D-Heads dataset from the given URL or local zip file
@@ -258,6 +313,67 @@ def dwnld_dad3d(data_dir: Path, dad3d_dir: str, force: bool = False):
         )
 
 
+@dataclass
+class Stage:
+    name: str
+    description: str
+    run: Callable[[], Any]
+    depends: Tuple[str, ...] = ()
+
+
+class StageProgress:
+    """
+    Single progress display of the concurrent stages
+    """
+
+    def __init__(self, n_stages: int):
+        self._n_stages = n_stages
+        self._n_done = 0
+        self._starts: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def started(self, stage: Stage):
+        with self._lock:
+            self._starts[stage.name] = time.perf_counter()
+            print(f"--> {stage.description}...")
+
+    def finished(self, stage: Stage):
+        with self._lock:
+            self._n_done += 1
+            elapsed = time.perf_counter() - self._starts[stage.name]
+            print(f"<-- [{self._n_done}/{self._n_stages}] {stage.name} done in {elapsed:.1f}s")
+
+
+def run_stages(stages: List[Stage], max_workers: int = 4) -> Dict[str, Any]:
+    """
+    Run every stage as soon as the stages it depends on are done, at most max_workers at a time, so that network
+    fetches and local extractions overlap
+    :return: stage name -> result
+    """
+    pending = {stage.name: stage for stage in stages}
+    unknown = {depend for stage in stages for depend in stage.depends} - set(pending)
+    if unknown:
+        raise ValueError(f"Unknown stage dependencies: {sorted(unknown)}")
+
+    progress = StageProgress(len(stages))
+    results, running = {}, {}
+    with ThreadPoolExecutor(max_workers) as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(depend in results for depend in stage.depends):
+                    progress.started(stage)
+                    running[pool.submit(stage.run)] = stage
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Cyclic stage dependencies: {sorted(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage.name] = future.result()
+                progress.finished(stage)
+    return results
+
+
 def cleanup(data_dir: Path, wf_labels_dir: Path, amazon_dir: Path):
     directories = [child for child in data_dir.iterdir() if child.is_dir()]
 
@@ -286,28 +402,50 @@ if __name__ == "__main__":
     wf_labels_dir = alexa_dir / "wider_face_split"
 
     #  Download the FAIRSET subsets from Widerface and DAD3D-Heads
-    print("\n--> Downloading WIDERFACE subset...")
-    dwnld_widerface(data_dir, args.widerface, args.force)
-
-    print("--> Downloading/extracting DAD3D-Heads subset...")
-    dwnld_dad3d(data_dir, args.dad3d, args.force)
-
-    # Download the Amazon Alexa Widerface annotations
-    if args.alexa:
-        print("--> Downloading Alexa annotations...")
-
-        # Download the Amazon Alexa demographics annotations
-        fresh_dwnld = dwnld_alexa_annots(alexa_dir, args.force or args.regenerate)
-
-        if fresh_dwnld:  # Download the widerface annotations
-            wget_zip(WIDER_FACE_ANNOTATIONS, wf_labels_dir.parent)
-
-        if fresh_dwnld:  # Merge the Amazon Alexa annotations with the WIDERFACE ones
-            print("--> Generating the full Alexa annotations...")
-            merge_alexa_annots(assets_dir, alexa_dir, wf_labels_dir, patch=fresh_dwnld)
+    stages = [
+        Stage(
+            "widerface",
+            "Downloading WIDERFACE subset",
+            lambda: dwnld_widerface(data_dir, args.widerface, args.force),
+        ),
+        Stage(
+            "dad3d",
+            "Downloading/extracting DAD3D-Heads subset",
+            lambda: dwnld_dad3d(data_dir, args.dad3d, args.force),
+        ),
+    ]
 
-    print("--> Cleaning up...")
-    cleanup(data_dir, wf_labels_dir, alexa_dir / "widerface-demographics-main")
+    # Download the Amazon Alexa demographics and the Widerface annotations concurrently, then merge them
+    if args.alexa and (args.force or args.regenerate or alexa_annots_missing(alexa_dir)):
+        stages += [
+            Stage(
+                "alexa",
+                "Downloading Alexa annotations",
+                lambda: dwnld_alexa_annots(alexa_dir, args.force or args.regenerate),
+            ),
+            Stage(
+                "widerface_annotations",
+                "Downloading WIDERFACE annotations",
+                lambda: wget_zip(WIDER_FACE_ANNOTATIONS, wf_labels_dir.parent),
+            ),
+            Stage(
+                "merge",
+                "Generating the full Alexa annotations",
+                lambda: merge_alexa_annots(alexa_dir, alexa_dir, wf_labels_dir),
+                ("alexa", "widerface_annotations"),
+            ),
+        ]
+
+    stages.append(
+        Stage(
+            "cleanup",
+            "Cleaning up",
+            lambda: cleanup(data_dir, wf_labels_dir, alexa_dir / "widerface-demographics-main"),
+            tuple(stage.name for stage in stages),
+        )
+    )
+    print()
+    run_stages(stages, args.jobs)
 
     if (len_dwnld := len(list(data_dir.iterdir()))) == FAIRSET_SIZE:
         print(f"\033[92mALL GOOD\033[0m")
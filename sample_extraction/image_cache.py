@@ -0,0 +1,147 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from analysis.profiling import PROFILER
+
+PIXELS_FILE = "pixels.bin"
+INDEX_FILE = "index.json"
+
+
+def _file_signature(image_path: str) -> Dict[str, int]:
+    stat = os.stat(image_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class DecodedImageCache:
+    """
+    Decoded RGB uint8 frames of the images, concatenated in a single raw file with a JSON index (image path -> byte
+    offset, shape and the size and modification time of the encoded file when it was decoded). The frames are read
+    as read-only views of a memory map of the file, so nothing is decoded nor copied on a hit.
+    An entry is stale as soon as the size or modification time of its image changes. Stale and new images are decoded
+    again and appended by build, the space of the replaced frames is reclaimed when it exceeds the live frames.
+    """
+
+    def __init__(self, folder: str):
+        """
+        :param folder: folder of the cache, created if missing
+        """
+        self._folder = folder
+        self._pixels_path = os.path.join(folder, PIXELS_FILE)
+        self._index_path = os.path.join(folder, INDEX_FILE)
+        self._pixels: Optional[np.memmap] = None
+        os.makedirs(folder, exist_ok=True)
+        self._index: Dict[str, dict] = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as file:
+                self._index = json.load(file)
+
+    @staticmethod
+    def _key(image_path: str) -> str:
+        return os.path.abspath(image_path)
+
+    def is_fresh(self, image_path: str) -> bool:
+        entry = self._index.get(self._key(image_path))
+        if entry is None or not os.path.exists(image_path):
+            return False
+        signature = _file_signature(image_path)
+        return entry["size"] == signature["size"] and entry["mtime_ns"] == signature["mtime_ns"]
+
+    def _pixel_map(self) -> Optional[np.memmap]:
+        if self._pixels is None and os.path.exists(self._pixels_path) and os.path.getsize(self._pixels_path):
+            self._pixels = np.memmap(self._pixels_path, dtype=np.uint8, mode="r")
+        return self._pixels
+
+    def get(self, image_path: str) -> Optional[np.ndarray]:
+        """
+        :return: read-only (height, width, 3) view of the cached frame, None if the image is missing or stale
+        """
+        if not self.is_fresh(image_path):
+            PROFILER.count("image_cache.misses")
+            return None
+        PROFILER.count("image_cache.hits")
+        entry = self._index[self._key(image_path)]
+        n_bytes = int(np.prod(entry["shape"]))
+        return self._pixel_map()[entry["offset"]:entry["offset"] + n_bytes].reshape(entry["shape"])
+
+    def build(self, image_paths: List[str], decode: Callable[[str], np.ndarray],
+              max_workers: Optional[int] = None) -> int:
+        """
+        Decode the missing and stale images in parallel and append them to the cache. The decoder runs in threads:
+        OpenCV releases the GIL while decoding.
+        :param decode: decoder of an image file to an RGB uint8 frame, e.g. decode_image
+        :return: number of images decoded
+        """
+        stale = [path for path in dict.fromkeys(image_paths) if not self.is_fresh(path)]
+        if not stale:
+            return 0
+        self._pixels = None  # The file is grown or rewritten below
+        stale_keys = {self._key(path) for path in stale}
+        live_bytes = sum(int(np.prod(entry["shape"])) for key, entry in self._index.items() if key not in stale_keys)
+        if os.path.exists(self._pixels_path) and os.path.getsize(self._pixels_path) > 2 * live_bytes:
+            self._compact(stale_keys)
+
+        workers = max_workers or os.cpu_count() or 1
+        with PROFILER.span("image_cache.build", images=len(stale)), open(self._pixels_path, "ab") as pixels:
+            offset = pixels.tell()
+            with ThreadPoolExecutor(workers) as executor:
+                # Bounded chunks, so at most a few decoded frames wait to be written at once
+                for start in range(0, len(stale), 4 * workers):
+                    chunk = stale[start:start + 4 * workers]
+                    signatures = [_file_signature(path) for path in chunk]
+                    for path, signature, frame in zip(chunk, signatures, executor.map(decode, chunk)):
+                        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+                        pixels.write(frame.tobytes())
+                        self._index[self._key(path)] = {"offset": offset, "shape": list(frame.shape), **signature}
+                        offset += frame.nbytes
+            pixels.flush()
+            os.fsync(pixels.fileno())
+        self._write_index()
+        return len(stale)
+
+    def _compact(self, dropped: set):
+        """
+        Rewrite the pixels file with only the live frames, dropping the replaced frames and the given entries
+        """
+        with PROFILER.span("image_cache.compact"):
+            self._index = {key: entry for key, entry in self._index.items() if key not in dropped}
+            source = np.memmap(self._pixels_path, dtype=np.uint8, mode="r")
+            temporary_path = f"{self._pixels_path}.tmp"
+            offset = 0
+            with open(temporary_path, "wb") as pixels:
+                for entry in sorted(self._index.values(), key=lambda entry: entry["offset"]):
+                    n_bytes = int(np.prod(entry["shape"]))
+                    pixels.write(source[entry["offset"]:entry["offset"] + n_bytes].tobytes())
+                    entry["offset"] = offset
+                    offset += n_bytes
+            del source
+            os.replace(temporary_path, self._pixels_path)
+            self._write_index()
+
+    def _write_index(self):
+        # Written next to the index then renamed so an interrupted build never leaves a truncated index
+        temporary_path = f"{self._index_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self._index, file)
+        os.replace(temporary_path, self._index_path)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+def cached_decoder(cache: Optional[DecodedImageCache],
+                   decode: Callable[[str], np.ndarray]) -> Callable[[str], np.ndarray]:
+    """
+    :return: decoder reading the frames from the cache, falling back to decode for the images missing or stale in it
+    """
+    if cache is None:
+        return decode
+
+    def read(image_path: str) -> np.ndarray:
+        frame = cache.get(image_path)
+        return frame if frame is not None else decode(image_path)
+
+    return read
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+
+from analysis.profiling import PROFILER
+
+# Version of the entry format, part of the key so entries of an older format are never read
+ENTRY_FORMAT = 2
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class RawInference:
+    """
+    Raw model output of one image: every detected face with all its dense landmarks, before any keypoint mapping
+    :param landmarks: (n_faces, n_landmarks, n_coordinates) normalized landmarks, as returned by the model
+    :param image_shape: (height, width) of the image the inference ran on
+    """
+    landmarks: np.ndarray
+    image_shape: Tuple[int, int]
+
+    @property
+    def n_faces(self) -> int:
+        return len(self.landmarks)
+
+
+class InferenceCache:
+    """
+    Content-addressed store of raw inference results. An entry is keyed by the hash of the image bytes, the hash of
+    the model file, the inference options and the channel order of the frames, so changing any of them never returns
+    a stale result. Entries are
+    compressed npz chunks sharded by the first two characters of their key, holding the landmarks exactly as returned
+    by the model (float32), so a cache hit maps to the same keypoints as the inference that filled it.
+    """
+
+    def __init__(self, folder: str, model_path: str, options: dict, input_color: str):
+        """
+        :param folder: root folder of the cache, created if missing
+        :param model_path: model file, hashed once so that a new model version gets its own entries
+        :param options: inference options changing the model output (e.g. number of faces), must be JSON serializable
+        :param input_color: channel order of the frames the model runs on (e.g. "RGB")
+        """
+        self._folder = folder
+        self._prefix = (f"{ENTRY_FORMAT}:{hash_file(model_path)}:{json.dumps(options, sort_keys=True)}:"
+                        f"{input_color}")
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, image_path: str) -> str:
+        return hashlib.sha256(f"{hash_file(image_path)}:{self._prefix}".encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self._folder, key[:2], f"{key}.npz")
+
+    def get(self, image_path: str, key: Optional[str] = None) -> Optional[RawInference]:
+        """
+        :param key: key of the image if already computed, avoids hashing the image twice
+        :return: the cached raw inference, None if the image was never inferred with this model and options
+        """
+        path = self._entry_path(key or self.key(image_path))
+        if not os.path.exists(path):
+            PROFILER.count("inference_cache.misses")
+            return None
+        PROFILER.count("inference_cache.hits")
+        with np.load(path) as entry:
+            return RawInference(entry["landmarks"], tuple(int(size) for size in entry["image_shape"]))
+
+    def put(self, image_path: str, raw: RawInference, key: Optional[str] = None):
+        path = self._entry_path(key or self.key(image_path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written next to the entry then renamed so an interrupted run never leaves a truncated entry
+        temporary_path = f"{path[:-len('.npz')]}.tmp.npz"
+        np.savez_compressed(temporary_path, landmarks=np.asarray(raw.landmarks, dtype=np.float32),
+                            image_shape=np.array(raw.image_shape, dtype=np.int32))
+        os.replace(temporary_path, path)
@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from analysis.configs import DATA, MEDIAPIPE
+from analysis.profiling import PROFILER, profiled
+from sample_extraction.inference_cache import InferenceCache
+from sample_extraction.mediapipe_extraction import (INPUT_COLOR,
+                                                    KEYPOINT_MAPPING,
+                                                    LANDMARKER_OPTIONS,
+                                                    estimate)
+from sample_extraction.utils import (associate_bboxes_to_annotations,
+                                     get_data_path, load_fairset_annotations)
+
+N_KEYPOINTS = max(KEYPOINT_MAPPING.keys()) + 1
+LEFT_EYE, RIGHT_EYE = 7, 11  # Same keypoints as Person.iod
+
+
+@dataclass
+class MappingSamples:
+    """
+    Associated (dense estimation, ground truth) faces
+    :param landmarks: (n_faces, n_landmarks, 2) dense landmark pixel coordinates
+    :param ground_truth: (n_faces, N_KEYPOINTS, 2) FAIRSET keypoints, NaN where not annotated
+    :param iod: (n_faces,) ground truth inter-ocular distance
+    :param image: (n_faces,) image index, the train/validation split is done per image
+    """
+    landmarks: np.ndarray
+    ground_truth: np.ndarray
+    iod: np.ndarray
+    image: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.iod)
+
+    def offsets(self, kp_id: int) -> np.ndarray:
+        """
+        (n_annotated_faces, n_landmarks, 2) offsets from the ground truth of `kp_id` to every dense landmark, in IOD.
+        Any mapping summing its weights to 1 has the normalized error of the same combination of these offsets.
+        """
+        annotated = ~np.isnan(self.ground_truth[:, kp_id, 0])
+        return ((self.landmarks[annotated] - self.ground_truth[annotated, kp_id, None])
+                / self.iod[annotated, None, None])
+
+    def select(self, mask: np.ndarray) -> "MappingSamples":
+        return MappingSamples(self.landmarks[mask], self.ground_truth[mask], self.iod[mask], self.image[mask])
+
+
+@profiled("mapping.collect")
+def collect_samples(cache: InferenceCache, image_paths: List[str], annotations: dict,
+                    min_iou: float) -> MappingSamples:
+    """
+    Associate the cached raw inferences of every annotated image to the FAIRSET faces, same as the extraction
+    """
+    landmarks, ground_truth, iods, images = [], [], [], []
+    for image_index, image_path in enumerate(image_paths):
+        image_name = os.path.basename(image_path)
+        raw = cache.get(image_path) if image_name in annotations else None
+        if raw is None or not raw.n_faces:
+            continue
+        height, width = raw.image_shape
+        persons = list(annotations[image_name].values())
+        estimations = estimate(raw)
+        association_indices, ious = associate_bboxes_to_annotations(
+            [bbox for bbox, _ in estimations], [person["bbox"] for person in persons]
+        )
+        for row, col in association_indices:
+            if ious[row][col] <= min_iou:
+                continue
+            person_ground_truth = np.full((N_KEYPOINTS, 2), np.nan)
+            for kp in persons[col]["keypoints"]:
+                person_ground_truth[int(kp.id)] = (kp.x, kp.y)
+            iod = np.hypot(*(person_ground_truth[LEFT_EYE] - person_ground_truth[RIGHT_EYE]))
+            if not iod > 0:
+                continue
+            landmarks.append(raw.landmarks[row, :, :2] * np.array([width, height]))
+            ground_truth.append(person_ground_truth)
+            iods.append(iod)
+            images.append(image_index)
+    if not landmarks:
+        raise Exception("No cached inference could be associated to the annotations, run the extraction first")
+    return MappingSamples(np.array(landmarks), np.array(ground_truth), np.array(iods), np.array(images))
+
+
+def split_by_image(image: np.ndarray, validation_fraction: float = 0.2, seed: int = 0) -> np.ndarray:
+    """
+    :return: training mask, whole images are held out so faces of a same picture never end up on both sides
+    """
+    images = np.unique(image)
+    rng = np.random.default_rng(seed)
+    validation_images = rng.choice(images, int(round(validation_fraction * len(images))), replace=False)
+    return ~np.isin(image, validation_images)
+
+
+def subset_weights(n_candidates: int, max_size: int) -> np.ndarray:
+    """
+    (n_subsets, n_candidates) uniform averaging weights of every subset of 1 to `max_size` candidates
+    """
+    subsets = [subset for size in range(1, max_size + 1) for subset in combinations(range(n_candidates), size)]
+    weights = np.zeros((len(subsets), n_candidates))
+    for row, subset in enumerate(subsets):
+        weights[row, list(subset)] = 1 / len(subset)
+    return weights
+
+
+def mapping_nmes(weights: np.ndarray, offsets: np.ndarray, chunk_size: int = 1024) -> np.ndarray:
+    """
+    Mean NME of each mapping over all faces, as one matrix product per chunk of mappings
+    :param weights: (n_mappings, n_candidates) combination weights, each row summing to 1
+    :param offsets: (n_faces, n_candidates, 2) normalized offsets of the candidates (MappingSamples.offsets)
+    """
+    n_faces, n_candidates, _ = offsets.shape
+    flat = offsets.transpose(1, 0, 2).reshape(n_candidates, n_faces * 2)
+    nmes = np.empty(len(weights))
+    for start in range(0, len(weights), chunk_size):
+        errors = (weights[start:start + chunk_size] @ flat).reshape(-1, n_faces, 2)
+        nmes[start:start + chunk_size] = np.sqrt((errors ** 2).sum(axis=2)).mean(axis=1)
+    return nmes
+
+
+def affine_least_squares(offsets: np.ndarray, ridge: float = 1e-3) -> np.ndarray:
+    """
+    Weights summing to 1 minimizing the squared normalized error, closed form w = A⁻¹1 / 1ᵀA⁻¹1 with the
+    (ridge regularized) normal matrix A of the offsets
+    """
+    n_faces, n_candidates, _ = offsets.shape
+    normal = np.einsum("nkc,njc->kj", offsets, offsets) / n_faces
+    normal += ridge * np.trace(normal) / n_candidates * np.eye(n_candidates)
+    solution = np.linalg.solve(normal, np.ones(n_candidates))
+    return solution / solution.sum()
+
+
+def optimize_keypoint(train: np.ndarray, validation: np.ndarray, n_candidates: int, subsets: np.ndarray,
+                      ridge: float, current: Optional[List[int]] = None) -> dict:
+    """
+    Best averaged subset (exhaustive over the neighbourhood) and best weighted combination of the `n_candidates`
+    dense landmarks closest to the ground truth on the training faces. Both are fitted on the training faces only
+    and the returned mapping is the one with the lowest validation NME.
+    :param train: training offsets of this keypoint (MappingSamples.offsets)
+    :param validation: validation offsets of this keypoint
+    :param current: current mapping of the keypoint, evaluated as a baseline
+    """
+    candidates = np.argsort(np.sqrt((train ** 2).sum(axis=2)).mean(axis=0))[:n_candidates]
+
+    subset_train = mapping_nmes(subsets, train[:, candidates])
+    best_subset = subsets[np.argmin(subset_train)]
+    weights = affine_least_squares(train[:, candidates], ridge)
+
+    subset_mapping = sorted(int(index) for index in candidates[best_subset > 0])
+    weighted_mapping = {int(index): round(float(weight), 4) for index, weight in zip(candidates, weights)
+                        if abs(weight) >= 1e-4}
+    result = {
+        "n_train": len(train),
+        "n_validation": len(validation),
+        "subset": subset_mapping,
+        "subset_nme": float(mapping_nmes(best_subset[None], validation[:, candidates])[0]),
+        "weighted": weighted_mapping,
+        "weighted_nme": float(mapping_nmes(weights[None], validation[:, candidates])[0]),
+        "current_nme": None,
+    }
+    if current:
+        current_weights = np.full((1, len(current)), 1 / len(current))
+        result["current_nme"] = float(mapping_nmes(current_weights, validation[:, current])[0])
+    weighted_is_better = result["weighted_nme"] < result["subset_nme"]
+    result["mapping"] = weighted_mapping if weighted_is_better else subset_mapping
+    result["nme"] = result["weighted_nme"] if weighted_is_better else result["subset_nme"]
+    return result
+
+
+def optimize_mapping(samples: MappingSamples, n_candidates: int = 12, max_subset_size: int = 4,
+                     validation_fraction: float = 0.2, ridge: float = 1e-3, seed: int = 0) -> Dict[int, dict]:
+    """
+    Optimize the mapping of every FAIRSET keypoint, see optimize_keypoint
+    :return: FAIRSET keypoint id -> optimization result, keypoints without annotated faces on both sides are missing
+    """
+    is_train = split_by_image(samples.image, validation_fraction, seed)
+    if is_train.all() or not is_train.any():
+        raise ValueError(f"A validation fraction of {validation_fraction} of {len(np.unique(samples.image))} images "
+                         "leaves no image for training or validation")
+    train_samples, validation_samples = samples.select(is_train), samples.select(~is_train)
+    subsets = subset_weights(min(n_candidates, samples.landmarks.shape[1]), max_subset_size)
+
+    results = {}
+    for kp_id in range(N_KEYPOINTS):
+        with PROFILER.span("mapping.optimize_keypoint"):
+            train, validation = train_samples.offsets(kp_id), validation_samples.offsets(kp_id)
+            if not len(train) or not len(validation):
+                continue
+            results[kp_id] = optimize_keypoint(train, validation, n_candidates, subsets, ridge,
+                                               KEYPOINT_MAPPING.get(kp_id))
+    return results
+
+
+def load_mapping(mapping_file: str) -> Dict[int, Union[List[int], Dict[int, float]]]:
+    """
+    :return: the mapping of a table written by this script, usable as KEYPOINT_MAPPING (JSON turns the keypoint and
+             dense landmark ids into strings, they are converted back to int)
+    """
+    with open(mapping_file, "r") as file:
+        mapping = json.load(file)["mapping"]
+    return {
+        int(kp_id): ({int(index): weight for index, weight in dense.items()} if isinstance(dense, dict)
+                     else [int(index) for index in dense])
+        for kp_id, dense in mapping.items()
+    }
+
+
+def main(args):
+    cache = InferenceCache(MEDIAPIPE["cache_folder"], MEDIAPIPE["model_path"], LANDMARKER_OPTIONS, INPUT_COLOR)
+    annotations = load_fairset_annotations(args.annotations)
+    samples = collect_samples(cache, get_data_path(MEDIAPIPE["images_folder"]), annotations,
+                              MEDIAPIPE.get("min_iou", 0.4))
+    print(f"{len(samples)} associated faces from {len(np.unique(samples.image))} cached images")
+
+    results = optimize_mapping(samples, args.candidates, args.max_size, args.validation, args.ridge, args.seed)
+
+    print("| Keypoint | Current NME | Best subset NME | Weighted NME | Chosen mapping |")
+    print("|----------|-------------|-----------------|--------------|----------------|")
+    for kp_id, result in results.items():
+        current = "-" if result["current_nme"] is None else f"{result['current_nme']:.4f}"
+        print(f"| {kp_id} | {current} | {result['subset_nme']:.4f} | {result['weighted_nme']:.4f} "
+              f"| {result['mapping']} |")
+
+    with open(args.output, "w") as file:
+        json.dump({"mapping": {kp_id: result["mapping"] for kp_id, result in results.items()},
+                   "results": results}, file, indent=4)
+    print(f"Mapping table written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Search the dense landmark combinations best matching each FAIRSET keypoint, from the inference "
+                    "cache (see the MEDIAPIPE config)"
+    )
+    parser.add_argument("-a", "--annotations", default=DATA["bbox_file"],
+                        help="FAIRSET annotations with the person bounding boxes (default: bbox_file from DATA)")
+    parser.add_argument("-o", "--output", default="keypoint_mapping.json", help="Output mapping table (JSON)")
+    parser.add_argument("-k", "--candidates", type=int, default=12,
+                        help="Number of closest dense landmarks searched per keypoint")
+    parser.add_argument("-m", "--max-size", type=int, default=4, help="Maximum size of the averaged subsets")
+    parser.add_argument("-v", "--validation", type=float, default=0.2, help="Fraction of the images held out")
+    parser.add_argument("--ridge", type=float, default=1e-3, help="Ridge regularization of the weighted mappings")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the train/validation split")
+    main(parser.parse_args())
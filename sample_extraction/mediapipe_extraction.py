@@ -1,22 +1,25 @@
 import json
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import cv2
-import mediapipe as mp
 import numpy as np
-from mediapipe.python import Image
-from mediapipe.tasks.python.components.containers.landmark import (
-    Landmark, NormalizedLandmark)
-from mediapipe.tasks.python.core.base_options import BaseOptions
-from mediapipe.tasks.python.vision import (FaceLandmarker,
-                                           FaceLandmarkerOptions, RunningMode)
 
 from analysis.configs import MEDIAPIPE
 from analysis.data.datatypes import BoundingBox, Keypoint
+from analysis.profiling import (PROFILER, enable_from_config,
+                                export_from_config)
+from sample_extraction.image_cache import DecodedImageCache, cached_decoder
+from sample_extraction.inference_cache import InferenceCache, RawInference
 from sample_extraction.utils import (associate_bboxes_to_annotations,
                                      display_annotated_image,
-                                     get_average_keypoint, get_bbox_from_kps,
-                                     get_data_path, load_fairset_annotations)
+                                     get_bbox_from_landmarks, get_data_path,
+                                     load_fairset_annotations,
+                                     reduce_landmarks)
+
+# Landmarker options changing the raw output, part of the inference cache key
+LANDMARKER_OPTIONS = {"running_mode": "IMAGE", "num_faces": 10}
+# Channel order of the frames given to the landmarker, part of the inference cache key
+INPUT_COLOR = "RGB"
 
 KEYPOINT_MAPPING = {
     0: [285, 336],
@@ -56,35 +59,111 @@ KEYPOINT_MAPPING = {
 }
 
 
-def mediapipe_results_to_2d_keypoints(
-    mp_landmarks: List[NormalizedLandmark], max_width: int, max_height: int
-) -> List[Keypoint]:
-    keypoints: List[Keypoint] = []
-    for i, landmark in enumerate(mp_landmarks):
-        keypoints.append(Keypoint(id=i, x=int(max_width * landmark.x), y=int(max_height * landmark.y)))
-    return keypoints
+def mediapipe_results_to_2d_keypoints(landmarks: np.ndarray, max_width: int, max_height: int) -> np.ndarray:
+    """
+    :param landmarks: (..., n_landmarks, >= 2) normalized dense landmarks
+    :return: (..., n_landmarks, 2) integer pixel coordinates
+    """
+    return (landmarks[..., :2] * np.array([max_width, max_height])).astype(int)
+
+
+def create_landmarker():
+    from mediapipe.tasks.python.core.base_options import BaseOptions
+    from mediapipe.tasks.python.vision import (FaceLandmarker,
+                                               FaceLandmarkerOptions,
+                                               RunningMode)
+
+    options = FaceLandmarkerOptions(
+        base_options=BaseOptions(model_asset_path=MEDIAPIPE["model_path"]),
+        running_mode=getattr(RunningMode, LANDMARKER_OPTIONS["running_mode"]),
+        num_faces=LANDMARKER_OPTIONS["num_faces"])
+    return FaceLandmarker.create_from_options(options)
+
 
+def infer(frame: np.ndarray, landmarker) -> RawInference:
+    """
+    Raw landmarker output of one image: (n_faces, n_landmarks, 3) normalized (x, y, z) landmarks
+    """
+    import mediapipe as mp
+    from mediapipe.python import Image
 
-def estimate(frame: np.ndarray, landmarker):
     mp_image = Image(image_format=mp.ImageFormat.SRGB, data=frame)
     mp_result = landmarker.detect(mp_image)
-    results: List[Tuple[BoundingBox, List[Keypoint]]] = []
-
-    for mp_kps in mp_result.face_landmarks:
-        kps = mediapipe_results_to_2d_keypoints(mp_kps, frame.shape[1], frame.shape[0])
-        bbox = get_bbox_from_kps(kps, frame.shape[1], frame.shape[0])
-        results.append((bbox, kps))
-    return results
+    landmarks = np.array([[(lm.x, lm.y, lm.z) for lm in mp_kps] for mp_kps in mp_result.face_landmarks],
+                         dtype=np.float32).reshape(len(mp_result.face_landmarks), -1, 3)
+    return RawInference(landmarks, frame.shape[:2])
+
+
+def estimate(raw: RawInference) -> List[Tuple[BoundingBox, List[Keypoint]]]:
+    """
+    Detected faces of a raw inference, as their bounding box and FAIRSET keypoints (KEYPOINT_MAPPING reduction)
+    """
+    height, width = raw.image_shape
+    if not raw.n_faces:
+        return []
+    landmarks = mediapipe_results_to_2d_keypoints(raw.landmarks, width, height)
+    kp_ids, reduced = reduce_landmarks(landmarks, KEYPOINT_MAPPING)
+    return [
+        (get_bbox_from_landmarks(face_landmarks, width, height),
+         [Keypoint(int(x), int(y), kp_id) for kp_id, (x, y) in zip(kp_ids, face_keypoints)])
+        for face_landmarks, face_keypoints in zip(landmarks, reduced)
+    ]
+
+
+def associate(estimations: List[Tuple[BoundingBox, List[Keypoint]]], image_annotations: dict,
+              min_iou: float) -> dict:
+    """
+    Non-interactive association of the estimated faces of an image to its annotated persons: the associations under
+    min_iou are rejected instead of being displayed for review
+    :param image_annotations: person id -> {"bbox", "keypoints"}, see load_fairset_annotations
+    :return: person id -> keypoint id -> {"x", "y"}, in the estimations file format
+    """
+    if not len(estimations):
+        return {}
+    person_ids = list(image_annotations.keys())
+    association_indices, ious = associate_bboxes_to_annotations(
+        [bbox for bbox, _ in estimations], [annotation["bbox"] for annotation in image_annotations.values()]
+    )
+    return {
+        person_ids[col]: {kp.id: {"x": kp.x, "y": kp.y} for kp in estimations[row][1]}
+        for row, col in association_indices
+        if ious[row][col] > min_iou
+    }
+
+
+def decode_image(image_path: str) -> np.ndarray:
+    """
+    :return: the frame of the image, in INPUT_COLOR order
+    """
+    with PROFILER.span("extraction.decode"):
+        im = cv2.imread(image_path)
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    return im
+
+
+def open_image_cache(image_paths: List[str]) -> Optional[DecodedImageCache]:
+    """
+    :return: the decoded frames cache of MEDIAPIPE["image_cache_folder"], with the missing and stale images of
+             image_paths decoded, None if the cache is disabled
+    """
+    if not MEDIAPIPE.get("image_cache_folder"):
+        return None
+    image_cache = DecodedImageCache(MEDIAPIPE["image_cache_folder"])
+    decoded = image_cache.build(image_paths, decode_image)
+    print(f"Decoded image cache: {decoded} images decoded, {len(image_cache) - decoded} reused")
+    return image_cache
 
 
 if __name__ == "__main__":
-    options = FaceLandmarkerOptions(
-        base_options=BaseOptions(model_asset_path=MEDIAPIPE["model_path"]),
-        running_mode=RunningMode.IMAGE, num_faces=10)
-    landmarker = FaceLandmarker.create_from_options(options)
+    enable_from_config()
+    landmarker = None  # Only created on the first cache miss
+    cache: Optional[InferenceCache] = None
+    if MEDIAPIPE.get("cache_folder"):
+        cache = InferenceCache(MEDIAPIPE["cache_folder"], MEDIAPIPE["model_path"], LANDMARKER_OPTIONS, INPUT_COLOR)
 
     images = get_data_path(MEDIAPIPE["images_folder"])
     annotations = load_fairset_annotations()
+    read_frame = cached_decoder(open_image_cache(images), decode_image)
 
     results = {}
 
@@ -93,43 +172,59 @@ if __name__ == "__main__":
             continue
 
         print(i, images[i])
-        im = cv2.imread(images[i])
-        cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        im = None
+        cache_key = cache.key(images[i]) if cache is not None else None
+        raw = cache.get(images[i], cache_key) if cache is not None else None
+        if raw is None:
+            if MEDIAPIPE.get("cache_only", False):
+                print(f"No cached inference for image {images[i]}, skipped")
+                continue
+            im = read_frame(images[i])
+            if landmarker is None:
+                landmarker = create_landmarker()
+            with PROFILER.span("extraction.inference"):
+                raw = infer(im, landmarker)
+            if cache is not None:
+                cache.put(images[i], raw, cache_key)
 
         results[images[i].split("/")[-1]] = {}
 
-        estimations = estimate(im, landmarker)
+        estimations = estimate(raw)
         if not len(estimations):
             print(f"No estimations were found for image {images[i]}")
+            PROFILER.count("extraction.images_without_estimations")
             continue
         images_annotations: dict = annotations[images[i].split("/")[-1]]
 
-        association_indices, ious = associate_bboxes_to_annotations(
-            [bbox for bbox, _ in estimations], [annotation["bbox"] for annotation in images_annotations.values()]
-        )
+        with PROFILER.span("extraction.association"):
+            association_indices, ious = associate_bboxes_to_annotations(
+                [bbox for bbox, _ in estimations], [annotation["bbox"] for annotation in images_annotations.values()]
+            )
         for row, col in association_indices:
-            kps = []
-            for custom_idx, mp_indices in KEYPOINT_MAPPING.items():
-                if len(mp_indices):
-                    kps.append(
-                        get_average_keypoint([kp for kp in estimations[row][1] if kp.id in mp_indices], custom_idx)
-                    )
+            kps = estimations[row][1]
 
             association_accepted = ious[row][col] > MEDIAPIPE.get("min_iou", 0.4)
             if not association_accepted:
-                display_image = list(images_annotations.values())[col]["bbox"].annotate_image(np.array(im), (0, 255, 0))
+                if im is None:
+                    im = read_frame(images[i])
+                display_image = list(images_annotations.values())[col]["bbox"].annotate_image(
+                    cv2.cvtColor(im, cv2.COLOR_RGB2BGR), (0, 255, 0))
                 key = display_annotated_image(display_image, kps, estimations[row][0])
                 if key == ord("a"):
                     association_accepted = True
 
             if association_accepted:
+                PROFILER.count("extraction.accepted_associations")
                 results[images[i].split("/")[-1]][list(images_annotations.keys())[col]] = {
                     kp.id: {"x": kp.x, "y": kp.y} for kp in kps
                 }
             else:
+                PROFILER.count("extraction.rejected_associations")
                 print(
                     f"Association for image {images[i]} and annotation {list(images_annotations.keys())[col]} was rejected."
                 )
 
-    with open(MEDIAPIPE["output_file"], "w") as file:
-        json.dump(results, file, indent=4)
+    with PROFILER.span("extraction.write"):
+        with open(MEDIAPIPE["output_file"], "w") as file:
+            json.dump(results, file, indent=4)
+    export_from_config()
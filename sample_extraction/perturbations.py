@@ -0,0 +1,123 @@
+import os
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+import cv2
+import numpy as np
+
+from analysis.data.datatypes import BoundingBox
+
+# Severity of the unperturbed images, evaluated in the same sweep as the reference
+CLEAN = ("none", 0)
+
+
+def adjust_brightness(frame: np.ndarray, factor: float, rng: np.random.Generator,
+                      bboxes: List[BoundingBox]) -> np.ndarray:
+    return cv2.convertScaleAbs(frame, alpha=factor)
+
+
+def adjust_gamma(frame: np.ndarray, gamma: float, rng: np.random.Generator, bboxes: List[BoundingBox]) -> np.ndarray:
+    table = np.round(255 * (np.arange(256) / 255) ** gamma).astype(np.uint8)
+    return cv2.LUT(frame, table)
+
+
+def blur(frame: np.ndarray, sigma: float, rng: np.random.Generator, bboxes: List[BoundingBox]) -> np.ndarray:
+    return cv2.GaussianBlur(frame, (0, 0), sigma)
+
+
+def compress_jpeg(frame: np.ndarray, quality: int, rng: np.random.Generator,
+                  bboxes: List[BoundingBox]) -> np.ndarray:
+    """
+    JPEG round trip in memory
+    """
+    _, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return cv2.imdecode(encoded, cv2.IMREAD_UNCHANGED)
+
+
+def downscale(frame: np.ndarray, factor: float, rng: np.random.Generator, bboxes: List[BoundingBox]) -> np.ndarray:
+    """
+    Lower the resolution, then resize back so the keypoints stay in the coordinates of the annotations
+    """
+    height, width = frame.shape[:2]
+    small = cv2.resize(frame, (max(1, round(width * factor)), max(1, round(height * factor))),
+                       interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def occlude(frame: np.ndarray, fraction: float, rng: np.random.Generator, bboxes: List[BoundingBox]) -> np.ndarray:
+    """
+    Hide a fraction of the area of every face box behind a patch of random color, at a random position in the box
+    """
+    occluded = frame.copy()
+    height, width = frame.shape[:2]
+    for bbox in bboxes:
+        patch_w, patch_h = max(1, round(bbox.w * np.sqrt(fraction))), max(1, round(bbox.h * np.sqrt(fraction)))
+        x = bbox.x + int(rng.integers(0, max(1, bbox.w - patch_w + 1)))
+        y = bbox.y + int(rng.integers(0, max(1, bbox.h - patch_h + 1)))
+        x1, y1 = min(max(x, 0), width), min(max(y, 0), height)
+        x2, y2 = min(max(x + patch_w, 0), width), min(max(y + patch_h, 0), height)
+        occluded[y1:y2, x1:x2] = rng.integers(0, 256, size=frame.shape[2:] or 1, dtype=np.uint8)
+    return occluded
+
+
+# Perturbation -> function(frame, severity, rng, face boxes) returning a new frame
+PERTURBATIONS: Dict[str, Callable[[np.ndarray, float, np.random.Generator, List[BoundingBox]], np.ndarray]] = {
+    "brightness": adjust_brightness,
+    "gamma": adjust_gamma,
+    "blur": blur,
+    "jpeg": compress_jpeg,
+    "downscale": downscale,
+    "occlusion": occlude,
+}
+
+
+def _name_seed(name: str) -> int:
+    return zlib.crc32(name.encode())
+
+
+@dataclass
+class PerturbedImage:
+    image_name: str
+    perturbation: str
+    severity: float
+    frame: np.ndarray
+
+
+def perturbed_images(image_paths: List[str], decode: Callable[[str], np.ndarray],
+                     severities: Dict[str, List[float]], bboxes: Optional[Dict[str, List[BoundingBox]]] = None,
+                     seed: int = 0, include_clean: bool = True) -> Iterator[PerturbedImage]:
+    """
+    Stream the perturbations of every image without writing them: each image is decoded once and all its perturbed
+    copies are yielded before the next one is decoded.
+    The random generator of every (image, perturbation, severity) is seeded from their names and the severity rank, so
+    a copy does not depend on the other perturbations or on the images evaluated with it.
+    :param severities: perturbation (see PERTURBATIONS) -> severities
+    :param bboxes: image name -> face boxes, for the occlusions
+    :param include_clean: also yield the unperturbed image, as CLEAN
+    """
+    unknown = set(severities.keys()) - set(PERTURBATIONS.keys())
+    if unknown:
+        raise ValueError(f"Unknown perturbations {sorted(unknown)}, expected some of {list(PERTURBATIONS.keys())}")
+    bboxes = bboxes or {}
+    for image_path in image_paths:
+        image_name = os.path.basename(image_path)
+        frame = decode(image_path)
+        if include_clean:
+            yield PerturbedImage(image_name, *CLEAN, frame)
+        for perturbation, levels in severities.items():
+            for severity_index, severity in enumerate(levels):
+                rng = np.random.default_rng((seed, _name_seed(image_name), _name_seed(perturbation), severity_index))
+                perturbed = PERTURBATIONS[perturbation](frame, severity, rng, bboxes.get(image_name, []))
+                yield PerturbedImage(image_name, perturbation, severity, perturbed)
+
+
+def batched(images: Iterator[PerturbedImage], batch_size: int) -> Iterator[List[PerturbedImage]]:
+    batch = []
+    for image in images:
+        batch.append(image)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
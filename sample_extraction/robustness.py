@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from analysis.configs import DATA, MEDIAPIPE, ROBUSTNESS
+from analysis.data.data_loader import DataLoader
+from analysis.data.datatypes import FACTORS
+from analysis.profiling import PROFILER, enable_from_config, export_from_config
+from sample_extraction.inference_cache import RawInference
+from sample_extraction.image_cache import cached_decoder
+from sample_extraction.mediapipe_extraction import (associate, create_landmarker, decode_image, estimate, infer,
+                                                    open_image_cache)
+from sample_extraction.perturbations import CLEAN, PERTURBATIONS, batched, perturbed_images
+from sample_extraction.utils import get_data_path, load_fairset_annotations
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Estimations of every (perturbation, severity), each in the estimations file format
+EstimationSets = Dict[Tuple[str, float], dict]
+
+
+def mediapipe_estimator() -> Callable[[List[np.ndarray]], List[RawInference]]:
+    """
+    MediaPipe has no batched inference, the landmarker runs on the frames of a batch one after the other
+    """
+    landmarker = create_landmarker()
+    return lambda frames: [infer(frame, landmarker) for frame in frames]
+
+
+def estimate_perturbations(image_paths: List[str], annotations: dict, severities: Dict[str, List[float]],
+                           estimator: Callable[[List[np.ndarray]], List[RawInference]], batch_size: int = 16,
+                           seed: int = 0, min_iou: float = 0.4,
+                           decode: Callable[[str], np.ndarray] = decode_image) -> EstimationSets:
+    """
+    Estimate the keypoints of the annotated images under every perturbation and severity, streamed in memory: every
+    image is decoded once for the whole sweep, its perturbed copies are sent to the estimator in batches and only the
+    associated keypoints are kept
+    :param annotations: see load_fairset_annotations (with the person bounding boxes)
+    :param severities: perturbation -> severities, see ROBUSTNESS["perturbations"]
+    :param estimator: raw inferences of a batch of frames
+    :param decode: RGB frame of an image file, e.g. a cached_decoder
+    :return: the estimation sets, CLEAN for the unperturbed images
+    """
+    image_paths = [path for path in image_paths if os.path.basename(path) in annotations]
+    bboxes = {name: [person["bbox"] for person in persons.values()] for name, persons in annotations.items()}
+    sets: EstimationSets = {}
+    for batch in batched(perturbed_images(image_paths, decode, severities, bboxes, seed), batch_size):
+        with PROFILER.span("robustness.inference", batch_size=len(batch)):
+            raws = estimator([image.frame for image in batch])
+        with PROFILER.span("robustness.association"):
+            for image, raw in zip(batch, raws):
+                estimations = sets.setdefault((image.perturbation, image.severity), {})
+                estimations[image.image_name] = associate(estimate(raw), annotations[image.image_name], min_iou)
+        PROFILER.count("robustness.perturbed_images", len(batch))
+    return sets
+
+
+def robustness_frame(sets: EstimationSets, factor: str) -> "pd.DataFrame":
+    """
+    Evaluate every estimation set with the statistical biases of the clean images, so the systematic shifts caused by
+    a perturbation are not removed
+    :return: perturbation, severity, group, n, mean_nme of every group under every set, with the shift of the mean NME
+             from the clean images and the gap between the best and worst groups of the set
+    """
+    import pandas as pd
+
+    clean_biases = DataLoader(sets[CLEAN]).get_statistical_biases()
+    rows = []
+    for (perturbation, severity), estimations in sets.items():
+        with PROFILER.span("robustness.evaluation", perturbation=perturbation, severity=severity):
+            data_loader = DataLoader(estimations, statistical_biases=clean_biases)
+        for group in FACTORS[factor]:
+            errors = data_loader.get_errors_by_group(factor, group)
+            rows.append({
+                "perturbation": perturbation,
+                "severity": severity,
+                "group": getattr(group, "name", str(group)),
+                "n": len(errors),
+                "mean_nme": errors.mean() if len(errors) else np.nan,
+            })
+    frame = pd.DataFrame(rows)
+    clean = frame[frame["perturbation"] == CLEAN[0]].set_index("group")["mean_nme"]
+    frame["shift"] = frame["mean_nme"] - frame["group"].map(clean)
+    means = frame.groupby(["perturbation", "severity"])["mean_nme"]
+    frame["gap"] = means.transform("max") - means.transform("min")
+    return frame
+
+
+def main(args):
+    enable_from_config(args.profile)
+    severities = {perturbation: ROBUSTNESS["perturbations"][perturbation] for perturbation in args.perturbations}
+    annotations = load_fairset_annotations(args.annotations)
+    image_paths = get_data_path(MEDIAPIPE["images_folder"])
+    decode = cached_decoder(open_image_cache(image_paths), decode_image)
+    sets = estimate_perturbations(image_paths, annotations, severities, mediapipe_estimator(), args.batch_size,
+                                  args.seed, MEDIAPIPE.get("min_iou", 0.4), decode)
+
+    if args.save_estimations:
+        output_dir = Path(args.save_estimations)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for (perturbation, severity), estimations in sets.items():
+            with open(output_dir / f"{perturbation}_{severity}.json", "w") as file:
+                json.dump(estimations, file, indent=4)
+
+    frame = robustness_frame(sets, args.factor)
+    print(frame.to_string(index=False, float_format="{:.4f}".format))
+    if args.output:
+        frame.to_csv(args.output, index=False)
+        print(f"Robustness table written to {args.output}")
+    export_from_config()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate the keypoint errors per group under seeded image perturbations of increasing severity, "
+                    "generated in memory (see the ROBUSTNESS config)"
+    )
+    parser.add_argument("-a", "--annotations", default=DATA["bbox_file"],
+                        help="FAIRSET annotations with the person bounding boxes (default: bbox_file from DATA)")
+    parser.add_argument("-p", "--perturbations", nargs="+", choices=list(PERTURBATIONS.keys()),
+                        default=list(ROBUSTNESS["perturbations"].keys()), help="Perturbations to sweep (default: all)")
+    parser.add_argument("-f", "--factor", choices=[factor for factor in FACTORS.keys() if factor != "location"],
+                        default="skintone", help="Demographic factor (default: skintone)")
+    parser.add_argument("-b", "--batch-size", type=int, default=ROBUSTNESS["batch_size"],
+                        help="Perturbed images sent to the estimator at once")
+    parser.add_argument("--seed", type=int, default=ROBUSTNESS["seed"], help="Seed of the perturbations")
+    parser.add_argument("-o", "--output", default=None, help="Write the robustness table to this CSV file")
+    parser.add_argument("--save-estimations", default=None,
+                        help="Also write the estimations of every perturbation and severity to this folder")
+    parser.add_argument("--profile", default=None, help="Record the stage timings and write them to this file")
+    main(parser.parse_args())
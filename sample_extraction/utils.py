@@ -1,16 +1,17 @@
-import json
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 
-import cv2
 import numpy as np
 from munkres import Munkres
 
 from analysis.configs import DATA
+from analysis.data.dataset_store import read_annotations
 from analysis.data.datatypes import BoundingBox, Keypoint
 
 
 def display_annotated_image(image: np.ndarray, kps: List[Keypoint], bbox: Optional[BoundingBox] = None):
+    import cv2
+
     if bbox is not None:
         image = bbox.annotate_image(image)  # Green box
     for kp in kps:
@@ -32,10 +33,53 @@ def get_bbox_from_kps(kps: List[Keypoint], max_width: int, max_height: int):
     return BoundingBox.from_pt1_pt2_format(min(kps_xs), min(kps_ys), max(kps_xs), max(kps_ys))
 
 
+def get_bbox_from_landmarks(landmarks: np.ndarray, max_width: int, max_height: int) -> BoundingBox:
+    """
+    Same as get_bbox_from_kps, on a (n_landmarks, 2) pixel coordinates array
+    """
+    xs = landmarks[:, 0][(landmarks[:, 0] > 0) & (landmarks[:, 0] < max_width)]
+    ys = landmarks[:, 1][(landmarks[:, 1] > 0) & (landmarks[:, 1] < max_height)]
+    return BoundingBox.from_pt1_pt2_format(int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+
+
 def get_average_keypoint(kps: List[Keypoint], new_idx: int = -1) -> Keypoint:
     return Keypoint(int(sum(kp.x for kp in kps) / len(kps)), int(sum(kp.y for kp in kps) / len(kps)), new_idx)
 
 
+def reduce_keypoints(kps: List[Keypoint], mapping: Dict[int, List[int]]) -> List[Keypoint]:
+    """
+    Reduce the dense keypoints of a model to the FAIRSET keypoints by averaging the mapped indices
+    :param kps: dense keypoints estimated by the model
+    :param mapping: FAIRSET keypoint id -> list of dense keypoint ids, empty lists are skipped
+    """
+    reduced = []
+    for custom_idx, dense_indices in mapping.items():
+        if len(dense_indices):
+            reduced.append(get_average_keypoint([kp for kp in kps if kp.id in dense_indices], custom_idx))
+    return reduced
+
+
+def reduce_landmarks(
+    landmarks: np.ndarray, mapping: Dict[int, Union[List[int], Dict[int, float]]]
+) -> Tuple[List[int], np.ndarray]:
+    """
+    Vectorized reduce_keypoints for all faces at once: one matrix product with the mapping averaging weights
+    :param landmarks: (n_faces, n_landmarks, 2) integer pixel coordinates of the dense landmarks
+    :param mapping: FAIRSET keypoint id -> list of dense keypoint ids (averaged) or dense keypoint id -> weight dict
+                    (weighted combination, see mapping_optimizer.py), empty entries are skipped
+    :return: the FAIRSET keypoint ids and their (n_faces, n_keypoints, 2) integer pixel coordinates
+    """
+    kp_ids = [kp_id for kp_id, dense_indices in mapping.items() if len(dense_indices)]
+    weights = np.zeros((len(kp_ids), landmarks.shape[1]))
+    for row, kp_id in enumerate(kp_ids):
+        if isinstance(mapping[kp_id], dict):
+            weights[row, list(mapping[kp_id].keys())] = list(mapping[kp_id].values())
+        else:
+            weights[row, np.unique(mapping[kp_id])] = 1
+    sums = np.einsum("kl,flc->fkc", weights, landmarks.astype(np.float64))
+    return kp_ids, (sums / weights.sum(axis=1)[None, :, None]).astype(int)
+
+
 def associate_bboxes_to_annotations(bboxes: List[BoundingBox], annotation_bboxes: List[BoundingBox]) -> List[int]:
     cost_matrix = []
     rel_distances = []
@@ -54,9 +98,11 @@ def associate_bboxes_to_annotations(bboxes: List[BoundingBox], annotation_bboxes
         return indices, [[1 - cost for cost in row] for row in cost_matrix]
 
 
-def load_fairset_annotations():
-    with open(DATA["annotations_file"], "r") as file:
-        annotations_dict = json.load(file)
+def load_fairset_annotations(annotations_file: Optional[str] = None):
+    """
+    :param annotations_file: FAIRSET file (JSON or store) with the person bounding boxes, DATA["bbox_file"] by default
+    """
+    annotations_dict = read_annotations(annotations_file or DATA["bbox_file"])
     fairset_annotations = {}
     for image_name, metadata in annotations_dict.items():
         fairset_annotations[image_name] = {